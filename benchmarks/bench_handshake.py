@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""Benchmark the server CPU cost of TLS handshakes with RSA and ECDSA.
+
+Writes a ``bench.pem.rsa``/``bench.pem.ecdsa`` bundle, as deployed by
+`certbot_haproxy.deploy` for paired lineages, starts a local HAProxy that
+serves it and performs N full handshakes that negotiate an RSA and an ECDSA
+certificate respectively. The CPU time the server process spent is read from
+``/proc``, so this needs Linux::
+
+    python3 benchmarks/bench_handshake.py [--count 500] [--haproxy haproxy]
+
+When no HAProxy binary is found, a Python server built on the same OpenSSL
+serves the bundle instead, which shows the same relative gain.
+"""
+import argparse
+import os
+import shutil
+import socket
+import ssl
+import subprocess
+import sys
+import tempfile
+import time
+
+from certbot_haproxy import util
+
+CIPHERS = (
+    ('rsa', 'ECDHE-RSA-AES128-GCM-SHA256'),
+    ('ecdsa', 'ECDHE-ECDSA-AES128-GCM-SHA256'),
+)
+
+HAPROXY_CONFIG = """
+global
+    nbthread 1
+    tune.ssl.cachesize 0
+
+defaults
+    mode tcp
+    timeout client 5s
+
+frontend bench
+    bind 127.0.0.1:%(port)d ssl crt %(directory)s/bench.pem
+    tcp-request session reject
+"""
+
+PYTHON_SERVER = """
+import socket, ssl, sys
+context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+context.options |= ssl.OP_NO_TICKET
+for path in sys.argv[2:]:
+    context.load_cert_chain(path)
+listener = socket.socket()
+listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+listener.bind(('127.0.0.1', int(sys.argv[1])))
+listener.listen(128)
+while True:
+    connection, _ = listener.accept()
+    try:
+        context.wrap_socket(connection, server_side=True).close()
+    except (ssl.SSLError, OSError):
+        connection.close()
+"""
+
+
+def free_port():
+    """A free TCP port on the loopback interface."""
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def write_bundle(directory):
+    """Write a self-signed RSA and ECDSA bundle, return the file paths."""
+    paths = []
+    for key_type, extension in (('rsa', '.rsa'), ('ec', '.ecdsa')):
+        key, cert = util.create_self_signed_cert(
+            key_type=key_type, domains=['bench.example'],
+            commonName=u'bench.example')
+        path = os.path.join(directory, 'bench.pem' + extension)
+        with open(path, 'wb') as pem:
+            pem.write(key + cert)
+        paths.append(path)
+    return paths
+
+
+def start_server(directory, paths, port, haproxy):
+    """Start HAProxy, or the Python server, serving the bundle."""
+    if haproxy:
+        config = os.path.join(directory, 'haproxy.cfg')
+        with open(config, 'w') as cfg:
+            cfg.write(HAPROXY_CONFIG % {'port': port, 'directory': directory})
+        command = [haproxy, '-db', '-f', config]
+    else:
+        command = [sys.executable, '-c', PYTHON_SERVER, str(port)] + paths
+    process = subprocess.Popen(command)
+    deadline = time.time() + 10
+    while time.time() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except socket.error:
+            time.sleep(0.05)
+    process.kill()
+    raise RuntimeError("The server did not start")
+
+
+def cpu_seconds(pid):
+    """User and system CPU time of a process and its threads."""
+    with open('/proc/%d/stat' % pid) as stat:
+        fields = stat.read().rsplit(')', 1)[1].split()
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf('SC_CLK_TCK'))
+
+
+def handshakes(port, ciphers, count):
+    """Perform `count` full TLS 1.2 handshakes with the given cipher."""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    context.check_hostname = False
+    context.verify_mode = ssl.CERT_NONE
+    context.maximum_version = ssl.TLSVersion.TLSv1_2
+    context.set_ciphers(ciphers)
+    for _ in range(count):
+        sock = socket.create_connection(('127.0.0.1', port))
+        try:
+            context.wrap_socket(sock, server_hostname='bench.example').close()
+        except (ssl.SSLError, socket.error):
+            sock.close()
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=500)
+    parser.add_argument('--haproxy', default=shutil.which('haproxy'),
+                        help="HAProxy binary (default: from $PATH).")
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    port = free_port()
+    process = None
+    try:
+        paths = write_bundle(directory)
+        process = start_server(directory, paths, port, args.haproxy)
+        print('%d handshakes per key type against %s' % (
+            args.count, 'HAProxy' if args.haproxy else 'a Python server'))
+        baseline = None
+        for label, ciphers in CIPHERS:
+            handshakes(port, ciphers, 10)  # warm up
+            cpu = cpu_seconds(process.pid)
+            start = time.time()
+            handshakes(port, ciphers, args.count)
+            duration = time.time() - start
+            cpu = cpu_seconds(process.pid) - cpu
+            per_handshake = cpu * 1000.0 / args.count
+            baseline = baseline or per_handshake
+            print('%-6s %8.3f ms server CPU/handshake %8.0f handshakes/s'
+                  ' %6.1fx' % (label, per_handshake, args.count / duration,
+                               baseline / per_handshake
+                               if per_handshake else float('inf')))
+    finally:
+        if process is not None:
+            process.kill()
+            process.wait()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
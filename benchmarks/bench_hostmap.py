@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""Model routing by per-domain ACLs versus a host map at 10k domains.
+
+HAProxy evaluates ``use_backend <backend> if <acl>`` rules in order and each
+``hdr(host) -i <domain>`` ACL compares the Host header with its domain, so
+routing a request costs a comparison per rule up to the matching one. A
+``map()`` lookup is a single tree lookup. This models both in Python, with the
+configuration parsed and the map built by `certbot_haproxy.hostmap`, for hosts
+spread evenly over the rules::
+
+    python3 benchmarks/bench_hostmap.py [--domains 10000]
+
+This is a model of the algorithms, it does not run HAProxy. Neither the
+absolute numbers nor the ratio are HAProxy's: its ACL matching and its map
+trees have other constant costs than a Python loop and a dict. The model only
+shows how the two grow with the number of domains. To measure HAProxy itself,
+load a configuration from `certbot_haproxy.fixtures` and one with the map of
+``certbot-haproxy-hostmap generate`` with an HTTP load generator.
+"""
+import argparse
+import random
+import sys
+import timeit
+
+from certbot_haproxy import haproxycfg
+from certbot_haproxy import hostmap
+
+
+def make_config(count):
+    """An HAProxy configuration with `count` domain ACLs."""
+    lines = ['frontend http-in', '    bind *:80']
+    for index in range(count):
+        lines.append('    acl host_%d hdr(host) -i d%d.example.com'
+                     % (index, index))
+    for index in range(count):
+        lines.append('    use_backend backend_%d if host_%d'
+                     % (index % 50, index))
+    return lines
+
+
+def route_acls(rules, host):
+    """Evaluate the rules in order, as HAProxy does."""
+    host = host.lower()
+    for domain, backend in rules:
+        if host == domain:
+            return backend
+    return None
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--domains', type=int, default=10000)
+    parser.add_argument('--requests', type=int, default=2000)
+    args = parser.parse_args(argv)
+
+    acls = haproxycfg.parse_domain_acls(make_config(args.domains))
+    rules = [(acl.domain, acl.backend) for acl in acls]
+    entries = hostmap.build_map(acls)
+    hosts = [random.choice(rules)[0].upper()
+             for _ in range(args.requests)]
+
+    acl_time = timeit.timeit(
+        lambda: [route_acls(rules, host) for host in hosts], number=1)
+    map_time = timeit.timeit(
+        lambda: [entries.get(host.lower()) for host in hosts], number=1)
+
+    print('%d domains, %d requests' % (args.domains, args.requests))
+    print('%-14s %12.3f us/request' % (
+        'ACL chain', acl_time / args.requests * 1e6))
+    print('%-14s %12.3f us/request' % (
+        'host map', map_time / args.requests * 1e6))
+    print('model speed-up: %.0fx (not measured with HAProxy)'
+          % (acl_time / map_time))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""Benchmark validating combined PEM files before deploying them.
+
+Writes N combined PEMs signed by a throw-away CA and times
+`certbot_haproxy.pemcheck.check_files` without cache, with a warm cache, and
+with a single worker::
+
+    python3 benchmarks/bench_pemcheck.py [--count 2000] [--workers 4]
+"""
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+from OpenSSL import crypto
+
+from certbot_haproxy import pemcheck
+
+
+def make_pems(directory, count):
+    """Write `count` combined PEMs with a shared key to `directory`."""
+    ca_key = crypto.PKey()
+    ca_key.generate_key(crypto.TYPE_RSA, 2048)
+    ca = crypto.X509()
+    ca.get_subject().commonName = u'Benchmark CA'
+    ca.set_issuer(ca.get_subject())
+    ca.set_pubkey(ca_key)
+    ca.gmtime_adj_notBefore(0)
+    ca.gmtime_adj_notAfter(86400 * 90)
+    ca.sign(ca_key, 'sha256')
+    # Key generation is not what is measured, share one leaf key.
+    key = crypto.PKey()
+    key.generate_key(crypto.TYPE_RSA, 2048)
+    key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+    ca_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, ca)
+
+    paths = []
+    for index in range(count):
+        cert = crypto.X509()
+        cert.get_subject().commonName = u'd%d.example.com' % index
+        cert.set_serial_number(index + 1)
+        cert.set_issuer(ca.get_subject())
+        cert.set_pubkey(key)
+        cert.gmtime_adj_notBefore(0)
+        cert.gmtime_adj_notAfter(86400 * 90)
+        cert.sign(ca_key, 'sha256')
+        path = os.path.join(directory, 'd%d.pem' % index)
+        with open(path, 'wb') as pem:
+            pem.write(key_pem)
+            pem.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+            pem.write(ca_pem)
+        paths.append(path)
+    return paths
+
+
+def timed(function, *args, **kwargs):
+    """Return the duration of a call in seconds."""
+    start = time.time()
+    function(*args, **kwargs)
+    return time.time() - start
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=2000)
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    try:
+        paths = make_pems(directory, args.count)
+        cache = pemcheck.CheckCache()
+        single = timed(pemcheck.check_files, paths, workers=1)
+        cold = timed(pemcheck.check_files, paths, cache=cache,
+                     workers=args.workers)
+        warm = timed(pemcheck.check_files, paths, cache=cache,
+                     workers=args.workers)
+    finally:
+        shutil.rmtree(directory)
+
+    print('%d files' % args.count)
+    for label, duration in (('1 worker', single), ('pool', cold),
+                            ('pool, cached', warm)):
+        print('%-14s %8.2fs %10.0f files/s' % (
+            label, duration, args.count / duration))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,89 @@
+#!/usr/bin/env python3
+"""Benchmark the HAProxy runtime API client against a local fake server.
+
+Compares a new connection per command (what ad-hoc ``socat`` scripts do) with
+the pooled, pipelined `RuntimeClient` and `AsyncRuntimeClient`, for N
+``add map`` commands. ``--delay`` adds a processing delay per command on the
+server side::
+
+    python3 benchmarks/bench_runtime.py [--count 5000] [--delay 0]
+"""
+import argparse
+import asyncio
+import os
+import shutil
+import socket
+import sys
+import tempfile
+import time
+
+from certbot_haproxy import runtime
+from certbot_haproxy.tests.test_runtime import FakeRuntimeServer
+
+
+def one_connection_per_command(path, commands):
+    """Send every command over a new, non-interactive connection."""
+    for command in commands:
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(path)
+        sock.sendall(command.encode('utf-8') + b'\n')
+        while sock.recv(65536):
+            pass
+        sock.close()
+
+
+def pipelined(path, commands):
+    """Send all commands with the synchronous client."""
+    with runtime.RuntimeClient(path) as client:
+        client.execute_many(commands)
+    return client.metrics.summary()
+
+
+def pipelined_async(path, commands, tasks=4):
+    """Send the commands from several tasks with the asyncio client."""
+    async def _run():
+        async with runtime.AsyncRuntimeClient(path, pool_size=tasks) as client:
+            size = len(commands) // tasks + 1
+            await asyncio.gather(*[
+                client.execute_many(commands[index:index + size])
+                for index in range(0, len(commands), size)
+            ])
+        return client.metrics.summary()
+    return asyncio.run(_run())
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--count', type=int, default=5000)
+    parser.add_argument('--delay', type=float, default=0)
+    args = parser.parse_args(argv)
+
+    directory = tempfile.mkdtemp()
+    path = os.path.join(directory, 'admin.sock')
+    server = FakeRuntimeServer(path, delay=args.delay)
+    commands = ['add map hosts.map d%d.example.com nodes' % index
+                for index in range(args.count)]
+    try:
+        print('%d commands' % args.count)
+        for label, function in (
+                ('connection per command', one_connection_per_command),
+                ('pooled, pipelined', pipelined),
+                ('asyncio, 4 tasks', pipelined_async)):
+            start = time.time()
+            summary = function(path, commands)
+            duration = time.time() - start
+            line = '%-24s %8.2fs %10.0f commands/s' % (
+                label, duration, args.count / duration)
+            if summary:
+                line += '   p50 %.2fms p99 %.2fms' % (
+                    summary['add map']['p50'] * 1000,
+                    summary['add map']['p99'] * 1000)
+            print(line)
+    finally:
+        server.stop()
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+"""Benchmark memory and lookup cost of pending challenge tokens.
+
+Compares the set of `HTTP01Resource` tuples the standalone authenticator
+serves from with the `certbot_haproxy.tokenstore.TokenStore`, for 1k, 10k and
+100k pending tokens::
+
+    python3 benchmarks/bench_tokenstore.py [--sizes 1000,10000,100000]
+"""
+import argparse
+import base64
+import os
+import random
+import sys
+import timeit
+import tracemalloc
+
+from acme import challenges
+from acme import standalone as acme_standalone
+
+from certbot_haproxy.tokenstore import TokenStore
+
+HTTP01Resource = acme_standalone.HTTP01RequestHandler.HTTP01Resource
+THUMBPRINT = base64.urlsafe_b64encode(os.urandom(32)).rstrip(b'=').decode()
+
+
+def make_tokens(count):
+    """Generate `count` random tokens."""
+    return [os.urandom(32) for _ in range(count)]
+
+
+def build_set(tokens):
+    """Build the standalone plugin's resource set."""
+    resources = set()
+    for token in tokens:
+        chall = challenges.HTTP01(token=token)
+        validation = chall.encode('token') + '.' + THUMBPRINT
+        resources.add(HTTP01Resource(
+            chall=chall, response=chall.response_cls(), validation=validation))
+    return resources
+
+
+def lookup_set(resources, path):
+    """Lookup as done by `acme.standalone.HTTP01RequestHandler`."""
+    for resource in resources:
+        if resource.chall.path == path:
+            return resource.validation.encode()
+    return None
+
+
+def build_store(tokens):
+    """Build a token store."""
+    store = TokenStore()
+    for token in tokens:
+        encoded = challenges.HTTP01(token=token).encode('token')
+        store.add(encoded, encoded + '.' + THUMBPRINT)
+    return store
+
+
+def measure(build, tokens):
+    """Return the built structure and the memory it allocated."""
+    tracemalloc.start()
+    structure = build(tokens)
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return structure, size
+
+
+def main(argv=None):
+    """Run the benchmark."""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--lookups', type=int, default=200)
+    args = parser.parse_args(argv)
+
+    print('%8s %-10s %12s %14s' % ('tokens', 'structure', 'memory(KiB)',
+                                   'lookup(us)'))
+    for count in [int(size) for size in args.sizes.split(',')]:
+        tokens = make_tokens(count)
+        paths = [challenges.HTTP01(token=token).path
+                 for token in random.sample(tokens, min(args.lookups, count))]
+
+        resources, set_size = measure(build_set, tokens)
+        # The linear scan is slow at large sizes, use fewer lookups.
+        set_paths = paths[:max(1, args.lookups * 1000 // count)]
+        set_time = timeit.timeit(
+            lambda: [lookup_set(resources, path) for path in set_paths],
+            number=1) / len(set_paths)
+        del resources
+
+        store, store_size = measure(build_store, tokens)
+        store_time = timeit.timeit(
+            lambda: [store.get_path(path) for path in paths],
+            number=1) / len(paths)
+        del store
+
+        print('%8d %-10s %12.0f %14.2f' % (
+            count, 'set', set_size / 1024.0, set_time * 1e6))
+        print('%8d %-10s %12.0f %14.2f' % (
+            count, 'tokenstore', store_size / 1024.0, store_time * 1e6))
+
+
+if __name__ == '__main__':
+    sys.exit(main())
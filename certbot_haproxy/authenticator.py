@@ -1,11 +1,15 @@
 """HAProxy Authenticator.
 
 The HAProxy Authenticator is an extension of the "standalone" authenticator
-that is part of certbot. It limits its functionality to only support the
-`http-01` challenge because `tls-sni-01` checks the challenge by connecting to
-port 443.  We can't proxy requests to certbot because we can't see the
-requested uri until the request is decrypted, and we can't do decryption in
-HAProxy because `tls-sni-01` expects to do a TLS handshake.
+that is part of certbot. It limits its functionality to the `http-01` and
+`tls-alpn-01` challenges. `tls-sni-01` is not supported because it checks the
+challenge by connecting to port 443.  We can't proxy requests to certbot
+because we can't see the requested uri until the request is decrypted, and we
+can't do decryption in HAProxy because `tls-sni-01` expects to do a TLS
+handshake. `tls-alpn-01` does not have that problem, HAProxy can route it on
+the ALPN protocol without decrypting it, see `certbot_haproxy.tlsalpn`. It is
+used, and preferred over `http-01`, when `haproxy-tls-alpn-01-port` is set.
+Its listener binds to `haproxy-tls-alpn-01-address` (default: all addresses).
 
 This authenticator creates its own ephemeral TCP listener on the necessary port
 in order to respond to incoming `http-01` challenges from the certificate
@@ -22,7 +26,9 @@ file::
     backend certbot
         log global
         mode http
-        server certbot 127.0.0.1:8000
+        option httpchk GET /.certbot-haproxy/ready
+        default-server inter 2s fastinter 250ms downinter 250ms rise 1 fall 1
+        server certbot 127.0.0.1:8000 check
 
     backend nodes
         log global
@@ -40,22 +46,57 @@ file::
         server node3 127.0.0.1:8080 check
         server node4 127.0.0.1:8080 check
 
+The health check makes HAProxy mark the `certbot` backend as down while the
+listener is not running, so requests fail immediately instead of waiting for
+a connect timeout. The listener answers `/.certbot-haproxy/ready` with
+`503` until all tokens of the current batch are loaded, and `200` after that.
+`/.certbot-haproxy/health` is answered with `200` whenever the listener runs.
+While the backend is down HAProxy answers challenge requests with `503`
+itself, so after loading a batch the authenticator waits
+`haproxy-ready-delay` seconds (default: 0.5) before the CA is asked to
+validate. Set it to at least `downinter` times `rise` of your health check.
+
+Before anything is ordered, the authenticator checks that HAProxy routes the
+challenges of every requested domain to it: it publishes a canary token and
+requests it for each domain from the local HAProxy (see
+`certbot_haproxy.preflight`). Depending on `haproxy-preflight`, misrouted
+domains are only reported (`warn`), removed from the request (`drop`) or
+abort the run (`fail`). `drop` only works for new requests (`certonly -d`):
+`certbot renew` always orders all names of the lineage, so a renewal with
+misrouted domains fails instead, reissue the lineage without them with
+`certbot certonly --cert-name`. The check only covers `http-01`, it is
+skipped when `haproxy-tls-alpn-01-port` is set and `tls-alpn-01` is used.
+
 For instructions on how to make HAProxy serve certificates that were created
 with this authenticator, read the documentation of the
 `.certbot_haproxy.installer`
 """
 import logging
+import time
 
 import zope.component
 import zope.interface
 
 from acme import challenges
 
+from certbot import errors
 from certbot import interfaces
 from certbot.plugins import standalone
 
+from certbot_haproxy import preflight
+from certbot_haproxy import profiling
+from certbot_haproxy import server
+from certbot_haproxy.tlsalpn import ChallengeCertificates
+from certbot_haproxy.tokenstore import TokenStore, DEFAULT_TTL
+
 logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
 
+PREFLIGHT_MODES = ("off", "warn", "drop", "fail")
+
+#: Seconds to wait for HAProxy to mark the `certbot` backend up, one
+#: `downinter` times `rise` of the example health check plus a margin.
+DEFAULT_READY_DELAY = 0.5
+
 
 @zope.interface.implementer(interfaces.IAuthenticator)
 @zope.interface.provider(interfaces.IPluginFactory)
@@ -67,6 +108,17 @@ class HAProxyAuthenticator(standalone.Authenticator):
     def __init__(self, *args, **kwargs):
         super(HAProxyAuthenticator, self).__init__(*args, **kwargs)
         self.config.http01_port = self.conf('haproxy_http_01_port')
+        # Pending tokens are looked up by token instead of kept as a set of
+        # challenge resources, see `certbot_haproxy.tokenstore`.
+        self.tokens = TokenStore(ttl=self.conf('haproxy_token_ttl'))
+        self.http_01_resources = self.tokens
+        # tls-alpn-01 certificates are generated once per challenge and
+        # looked up by server name, see `certbot_haproxy.tlsalpn`.
+        self.certs = ChallengeCertificates()
+        self.servers = server.ServerManager(self.certs, self.tokens)
+        profiling.configure(
+            directory=self.conf('haproxy_profile_dir'),
+            rate=self.conf('haproxy_profile_rate'))
 
     @classmethod
     def add_parser_arguments(cls, add):
@@ -90,18 +142,240 @@ class HAProxyAuthenticator(standalone.Authenticator):
             type=int,
             default=8000
         )
+        add(
+            "haproxy-tls-alpn-01-port",
+            help=(
+                "Port to open internally for tls-alpn-01 challenges, you're"
+                " expected to route TLS connections to port 443 that offer the"
+                " `acme-tls/1` protocol to it. When set, tls-alpn-01 is"
+                " preferred over http-01 (default: tls-alpn-01 disabled)."
+            ),
+            type=int,
+            default=None
+        )
+        add(
+            "haproxy-tls-alpn-01-address",
+            help=(
+                "Address to listen on for tls-alpn-01 challenges"
+                " (default: all addresses)."
+            ),
+            default=""
+        )
+        add(
+            "haproxy-token-ttl",
+            help=(
+                "Seconds after which a challenge token that was not cleaned"
+                " up is no longer served (default=%d)." % DEFAULT_TTL
+            ),
+            type=int,
+            default=DEFAULT_TTL
+        )
+        add(
+            "haproxy-ready-delay",
+            help=(
+                "Seconds to wait after all challenges are loaded before the"
+                " CA is asked to validate them, set this to at least HAProxy's"
+                " `downinter` times `rise` of the certbot backend's health"
+                " check (default=%s)." % DEFAULT_READY_DELAY
+            ),
+            type=float,
+            default=DEFAULT_READY_DELAY
+        )
+        add(
+            "haproxy-preflight",
+            help=(
+                "Check that HAProxy routes the challenges of all domains to"
+                " this plugin before ordering: off, warn (default), drop the"
+                " misrouted domains from the request, or fail. Renewals can't"
+                " drop domains, they fail in drop mode. Only http-01 is"
+                " checked, the check is skipped when tls-alpn-01 is enabled."
+            ),
+            choices=PREFLIGHT_MODES,
+            default="warn"
+        )
+        add(
+            "haproxy-preflight-address",
+            help=(
+                "Address of the HAProxy http frontend to send pre-flight"
+                " requests to (default=%s)." % preflight.DEFAULT_ADDRESS
+            ),
+            default=preflight.DEFAULT_ADDRESS
+        )
+        add(
+            "haproxy-profile-dir",
+            help=(
+                "Write CPU and memory profiles of the plugin's steps to this"
+                " directory, see `certbot_haproxy.profiling`."
+            ),
+            default=None
+        )
+        add(
+            "haproxy-profile-rate",
+            help=(
+                "Fraction of the runs to profile when a profile directory is"
+                " configured (default=1)."
+            ),
+            type=float,
+            default=None
+        )
 
     @property
     def supported_challenges(self):
         """
-            Challenges supported by this plugin: only http-01
-            See introduction for reasoning.
+            Challenges supported by this plugin: http-01, and tls-alpn-01
+            when a port is configured for it. See introduction for reasoning.
 
-            :returns: List of supported challenges
+            :returns: List of supported challenges, in order of preference
             :rtype: list
         """
+        if self.conf('haproxy_tls_alpn_01_port') is not None:
+            return [challenges.TLSALPN01, challenges.HTTP01]
         return [challenges.HTTP01]
 
+    def prepare(self):
+        """
+            Run the pre-flight routing check for the requested domains.
+
+            Plugins are prepared before certbot determines the domains to
+            request, so dropping a domain from `self.config.domains` removes
+            it from the order. That does not hold for `certbot renew`, which
+            orders the names of the lineage.
+
+            The check requests `http-01` challenges, it is skipped when
+            `tls-alpn-01` is enabled because that is preferred.
+
+            :raises errors.PluginError: When domains are not routed to this
+                plugin and `haproxy-preflight` is `fail`, when all of them
+                would be dropped, or when they would be dropped from a
+                renewal.
+        """
+        mode = self.conf('haproxy_preflight')
+        domains = [domain for domain in (self.config.domains or [])
+                   if not domain.startswith('*.')]
+        if mode == "off" or not domains:
+            return
+        if self.conf('haproxy_tls_alpn_01_port') is not None:
+            logger.debug("Skipping the pre-flight check, tls-alpn-01 is"
+                         " preferred over http-01")
+            return
+
+        self._try_run_server()
+        self.tokens.ready = True
+        try:
+            results = preflight.check_routing(
+                domains, self.tokens,
+                address=self.conf('haproxy_preflight_address'))
+        finally:
+            self.tokens.ready = False
+            if not self.tokens:
+                for port in list(self.servers.running()):
+                    self.servers.stop(port)
+
+        failed = [result.domain for result in results if not result.ok]
+        if not failed or mode == "warn":
+            return
+        if mode == "fail" or len(failed) == len(self.config.domains):
+            raise errors.PluginError(
+                "HAProxy does not route challenges for %s to this plugin,"
+                " check the `is_certbot` ACL and `backend certbot` of the"
+                " frontends serving them." % ", ".join(failed))
+        if getattr(self.config, 'verb', None) == "renew":
+            # Certbot renews `lineage.names()`, not `config.domains`.
+            raise errors.PluginError(
+                "HAProxy does not route challenges for %s to this plugin and"
+                " they cannot be dropped from a renewal, reissue the"
+                " certificate without them with `certbot certonly"
+                " --cert-name`." % ", ".join(failed))
+        logger.warning("Dropping %s from the request", ", ".join(failed))
+        self.config.domains[:] = [
+            domain for domain in self.config.domains if domain not in failed
+        ]
+
+    def _try_run_server(self):
+        """Start the http-01 responder, asking to retry if the port is taken."""
+        while True:
+            try:
+                return self.servers.run(
+                    self.config.http01_port, challenges.HTTP01,
+                    listenaddr=self.config.http01_address)
+            except errors.StandaloneBindError as error:
+                standalone._handle_perform_error(  # pylint:disable=protected-access
+                    error)
+
+    @profiling.profiled('authenticator.perform')
+    def perform(self, achalls):
+        """
+            Load the responses to all challenges of a batch, then report the
+            responder as ready to HAProxy's health check.
+
+            :param list achalls: Annotated challenges to perform.
+            :returns: List of challenge responses.
+            :rtype: list
+        """
+        self.tokens.ready = False
+        responses = [self._try_perform_single(achall) for achall in achalls]
+        self.tokens.ready = True
+        ready_delay = self.conf('haproxy_ready_delay')
+        if ready_delay:
+            # Give HAProxy's health check the chance to see the backend
+            # come up before the CA is told to validate.
+            time.sleep(ready_delay)
+        return responses
+
+    def _perform_single(self, achall):
+        """
+            Make the response to a single challenge available.
+
+            .. note:: This overrides a method defined in the parent, the
+                parent also keeps the complete challenge in `self.served`,
+                which we don't need because the token store is the single
+                source of what is being served.
+
+            :param achall: Annotated http-01 or tls-alpn-01 challenge.
+            :returns: The challenge response.
+        """
+        if isinstance(achall.chall, challenges.TLSALPN01):
+            return self._perform_tls_alpn_01(achall)
+        self.servers.run(self.config.http01_port, challenges.HTTP01,
+                         listenaddr=self.config.http01_address)
+        response, validation = achall.response_and_validation()
+        self.tokens.add(achall.chall.encode("token"), validation)
+        return response
+
+    def _perform_tls_alpn_01(self, achall):
+        """
+            Generate and serve the certificate of a tls-alpn-01 challenge.
+
+            :param achall: Annotated tls-alpn-01 challenge.
+            :returns: The challenge response.
+        """
+        self.servers.run(self.conf('haproxy_tls_alpn_01_port'),
+                         challenges.TLSALPN01,
+                         listenaddr=self.conf('haproxy_tls_alpn_01_address'))
+        key_authorization = achall.chall.key_authorization(achall.account_key)
+        self.certs.add(achall.domain, key_authorization)
+        return achall.chall.response(achall.account_key)
+
+    @profiling.profiled('authenticator.cleanup')
+    def cleanup(self, achalls):
+        """
+            Stop serving the given challenges, expire stale tokens and stop
+            the servers when nothing is left to serve.
+
+            :param list achalls: Annotated challenges to clean up.
+        """
+        for achall in achalls:
+            if isinstance(achall.chall, challenges.TLSALPN01):
+                self.certs.discard(achall.domain)
+            else:
+                self.tokens.discard(achall.chall.encode("token"))
+        self.tokens.expire()
+        if not self.tokens and not self.certs:
+            # The order is done, drop the cached challenge certificates.
+            self.certs.clear()
+            for port in list(self.servers.running()):
+                self.servers.stop(port)
+
     @staticmethod
     def more_info():
         """
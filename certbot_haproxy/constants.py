@@ -47,6 +47,12 @@ work too.
 
         .. note:: This directory needs to be writeable by the user that runs
             certbot.
+
+    .. attribute:: CLI_DEFAULTS_OS_NAME['instances_config']
+
+        The profiles of the HAProxy instances on hosts that run several of
+        them, see `certbot_haproxy.instances`. It is only used when the file
+        exists.
 """
 
 import logging
@@ -54,15 +60,32 @@ import re
 from distutils.version import LooseVersion
 from certbot import util
 from certbot import errors
+from certbot_haproxy.profiling import profiled
 from certbot_haproxy.util import MemoiseNoArgs
 
+_DOMAIN_PATTERN = (
+    r'(?:[0-9-a-z](?:[a-z0-9-]{0,61}[a-z0-9]\.)+)'  # (sub-)domain parts
+    r'(?:[0-9-a-z](?:[a-z0-9-]{0,61}[a-z0-9]))'  # TLD part
+)
+
 RE_HAPROXY_DOMAIN_ACL = re.compile(
     r'\s*acl (?P<name>[0-9a-z_\-.]+) '
     r'hdr\(host\) -i '
-    r'(?P<domain>'  # Start group "domain"
-    r'(?:[0-9-a-z](?:[a-z0-9-]{0,61}[a-z0-9]\.)+)'  # (sub-)domain parts
-    r'(?:[0-9-a-z](?:[a-z0-9-]{0,61}[a-z0-9]))'  # TLD part
-    r')'  # End group "domain"
+    r'(?P<domain>' + _DOMAIN_PATTERN + r')'
+)
+
+RE_DOMAIN = re.compile(_DOMAIN_PATTERN + r'$')
+
+RE_HAPROXY_ACL = re.compile(r'\s*acl\s+(?P<name>\S+)')
+
+RE_HAPROXY_USE_BACKEND = re.compile(
+    r'\s*use_backend\s+(?P<backend>\S+)'
+    r'(?:\s+(?P<operator>if|unless)\s+(?P<condition>.+?))?\s*$'
+)
+
+RE_HAPROXY_SECTION = re.compile(
+    r'(?P<section>global|defaults|frontend|backend|listen|userlist|peers|'
+    r'resolvers|mailers|program|cache)(?:\s+(?P<name>\S+))?\s*$'
 )
 
 CLI_DEFAULTS_DEBIAN_BASED_SYSTEMD_OS = dict(
@@ -74,6 +97,8 @@ CLI_DEFAULTS_DEBIAN_BASED_SYSTEMD_OS = dict(
     haproxy_config='/etc/haproxy/haproxy.cfg',
     # Needs to be writeable by the user that will run certbot
     crt_directory='/opt/certbot/haproxy_fullchains',
+    # Profiles of several HAProxy instances, used when the file exists
+    instances_config='/etc/haproxy/certbot-instances.ini',
 )
 
 CLI_DEFAULTS_DEBIAN_BASED_PRE_SYSTEMD_OS = dict(
@@ -85,6 +110,8 @@ CLI_DEFAULTS_DEBIAN_BASED_PRE_SYSTEMD_OS = dict(
     haproxy_config='/etc/haproxy/haproxy.cfg',
     # Needs to be writeable by the user that will run certbot
     crt_directory='/opt/certbot/haproxy_fullchains',
+    # Profiles of several HAProxy instances, used when the file exists
+    instances_config='/etc/haproxy/certbot-instances.ini',
 )
 
 CLI_DEFAULTS = {
@@ -116,6 +143,7 @@ logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
 
 
 @MemoiseNoArgs  # Cache the return value
+@profiled('constants.os_analyse')
 def os_analyse():
     """
         Returns tuple containing the OS distro and version corresponding with
@@ -0,0 +1,725 @@
+"""Deploy certificates to HAProxy.
+
+HAProxy needs the private key and the full chain of a certificate combined in
+one PEM file in its `crt_directory`. This module does what the
+`certbot-deploy-hook-example` script does, for one lineage or for many at
+once, in stages:
+
+  1. **stage**: the combined PEM of every lineage is written to a staging
+     directory next to the `crt_directory`; lineages whose combined PEM is
+     identical to the deployed one are skipped;
+  2. **validate**: the staged files are checked in a process pool (see
+     `certbot_haproxy.pemcheck`), files that fail are held back and reported
+     without affecting the others;
+  3. **commit**: the valid files are moved into the `crt_directory`, each
+     move is atomic;
+  4. **reload**: when anything was committed, the HAProxy configuration is
+     tested with `conftest_cmd` and HAProxy is restarted with `restart_cmd`.
+
+Lineages can be paired per domain to serve ECDSA certificates to the clients
+that support them and RSA certificates to the others, which makes the TLS
+handshake a lot cheaper for the server. Request the certificates with a key
+type suffix in the certificate name. Certbot only generates RSA keys before
+1.10 (``--key-type``), so the ECDSA lineage gets its key with ``--reuse-key``
+(certbot 0.25 and later): request it, put an ECDSA key in its place and renew
+it once. ``reuse_key`` is saved in the renewal configuration, so later
+renewals keep the ECDSA key::
+
+    certbot certonly --cert-name example.com-rsa -d example.com
+    certbot certonly --cert-name example.com-ecdsa -d example.com
+    live=/etc/letsencrypt/live/example.com-ecdsa
+    openssl ecparam -name prime256v1 -genkey | openssl pkey -out ec.pem
+    cp ec.pem "$(readlink -f $live/privkey.pem)"
+    certbot certonly --cert-name example.com-ecdsa -d example.com \\
+        --reuse-key --force-renewal
+
+Lineages named ``<name>``, ``<name>-rsa`` and ``<name>-ecdsa`` belong to the
+same pair, when one of them is deployed the others are as well. A pair is
+deployed as a multi-certificate bundle, ``<name>.pem.rsa`` and
+``<name>.pem.ecdsa`` (see `BUNDLE_EXTENSIONS`), instead of ``<name>.pem``.
+HAProxy loads the bundle for ``crt <name>.pem`` and for a ``crt`` directory
+alike. The files of a bundle are committed and reloaded together: when one of
+them fails the checks both are held back, and a ``<name>.pem`` left from
+before the pairing is removed once the bundle is in place (and vice versa).
+
+Every step is recorded in a journal in the staging directory (see
+`certbot_haproxy.journal`). A run that was interrupted is resumed by the next
+one: intact staged files are not written again and certificates it committed
+are reloaded, even though they are unchanged by then.
+
+It can be used as a deploy hook, in which case the lineage is read from the
+`RENEWED_LINEAGE` environment variable certbot sets::
+
+    certbot renew --deploy-hook certbot-haproxy-deploy
+
+Restarting HAProxy for every renewed certificate is wasteful when many
+certificates are renewed in one run, deploy all of them at once from a post
+hook instead::
+
+    certbot renew --post-hook "certbot-haproxy-deploy --live-dir \\
+        /etc/letsencrypt/live"
+
+The defaults of the `crt_directory`, `haproxy_config`, `conftest_cmd` and
+`restart_cmd` are taken from `certbot_haproxy.constants`.
+
+Hosts that run several HAProxy instances describe them in a profiles file
+(see `certbot_haproxy.instances`), ``--instances`` deploys to all of them in
+one run with `deploy_instances`. The combined PEMs are validated once, and the
+instances are tested and restarted concurrently, so a slow or failing instance
+neither delays nor blocks the others. Its journal stays open and the next run
+reloads it again.
+"""
+import argparse
+import collections
+import logging
+import os
+import subprocess
+import sys
+
+from OpenSSL import crypto
+
+from certbot import errors
+
+from certbot_haproxy import constants
+from certbot_haproxy import instances
+from certbot_haproxy import journal
+from certbot_haproxy import pemcheck
+from certbot_haproxy.profiling import profiled
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: File name of the validation cache in the staging directory.
+CACHE_FILE = 'pemcheck-cache.json'
+
+#: File name of the deploy journal in the staging directory.
+JOURNAL_FILE = 'deploy.journal'
+
+#: Suffixes of lineage names that mark the key type of paired lineages.
+LINEAGE_SUFFIXES = ('-rsa', '-ecdsa')
+
+#: Extensions of the files of a multi-certificate bundle by key type.
+BUNDLE_EXTENSIONS = collections.OrderedDict(
+    [('rsa', '.rsa'), ('ecdsa', '.ecdsa')]
+)
+
+PemFile = collections.namedtuple('PemFile', 'name lineage bundle superseded')
+PemFile.__doc__ = """
+    A combined PEM file to deploy.
+
+    :ivar str name: Name of the file in the certificate directory.
+    :ivar str lineage: Path of the lineage it is combined from.
+    :ivar str bundle: Name the file is loaded by, ``<name>.pem`` for the files
+        of a bundle, the name of the file itself otherwise.
+    :ivar tuple superseded: Names of the files the file replaces.
+"""
+
+DeployResult = collections.namedtuple(
+    'DeployResult', 'committed unchanged rejected reloaded resumed removed'
+)
+DeployResult.__doc__ = """
+    Outcome of a deploy.
+
+    :ivar list committed: Names of the PEM files that were put in place.
+    :ivar list unchanged: Names of the PEM files that were already deployed.
+    :ivar dict rejected: Problems per name of the files that were held back.
+    :ivar bool reloaded: Whether HAProxy was restarted.
+    :ivar list resumed: Names of the PEM files an interrupted run committed
+        or removed without reloading HAProxy.
+    :ivar list removed: Names of the superseded PEM files that were removed.
+"""
+
+InstanceResult = collections.namedtuple(
+    'InstanceResult', 'instance result error'
+)
+InstanceResult.__doc__ = """
+    Outcome of a deploy to one of several instances.
+
+    :ivar instance: The instance.
+    :vartype instance: `.instances.Instance`
+    :ivar result: What was deployed, `None` if nothing could be.
+    :vartype result: `DeployResult`
+    :ivar str error: Why the deploy or the reload failed, `None` if it
+        succeeded.
+"""
+
+
+def staging_directory(crt_directory):
+    """
+        Default staging directory for a `crt_directory`.
+
+        The staging directory is a hidden sibling of the `crt_directory`, so
+        it is on the same file system (which makes moving files atomic) but
+        HAProxy does not load the files in it.
+
+        :param str crt_directory: HAProxy's certificate directory.
+        :rtype: str
+    """
+    crt_directory = os.path.normpath(crt_directory)
+    return os.path.join(
+        os.path.dirname(crt_directory),
+        '.%s.staging' % os.path.basename(crt_directory)
+    )
+
+
+def lineage_name(lineage):
+    """
+        The name of a lineage, which is also the name of its PEM file.
+
+        :param str lineage: Path of the lineage in certbot's live directory.
+        :rtype: str
+    """
+    return os.path.basename(os.path.normpath(lineage))
+
+
+def find_lineages(live_dir):
+    """
+        List all lineages in a live directory.
+
+        :param str live_dir: Certbot's live directory.
+        :rtype: list
+    """
+    return [
+        os.path.join(live_dir, name) for name in sorted(os.listdir(live_dir))
+        if os.path.isfile(os.path.join(live_dir, name, 'privkey.pem'))
+    ]
+
+
+def lineage_key_type(lineage):
+    """
+        The type of the private key of a lineage.
+
+        :param str lineage: Path of the lineage.
+        :returns: ``rsa``, ``ecdsa`` or `None` for other and unreadable keys.
+        :rtype: str
+    """
+    try:
+        with open(os.path.join(lineage, 'privkey.pem'), 'rb') as key:
+            key_type = crypto.load_privatekey(
+                crypto.FILETYPE_PEM, key.read()).type()
+    except (IOError, OSError, crypto.Error):
+        return None
+    if key_type == crypto.TYPE_RSA:
+        return 'rsa'
+    if key_type == crypto.TYPE_EC:
+        return 'ecdsa'
+    return None
+
+
+def pair_name(lineage):
+    """
+        The name shared by paired lineages, without the key type suffix.
+
+        :param str lineage: Path of the lineage.
+        :rtype: str
+    """
+    name = lineage_name(lineage)
+    for suffix in LINEAGE_SUFFIXES:
+        if name.endswith(suffix):
+            return name[:-len(suffix)]
+    return name
+
+
+def pem_files(lineages):
+    """
+        Determine the PEM files to deploy for lineages.
+
+        Lineages that are paired with other lineages in the same live
+        directory are deployed as a bundle, together with those others.
+
+        :param list lineages: Paths of the lineages.
+        :rtype: list of `PemFile`
+    """
+    pairs = collections.OrderedDict()
+    for lineage in lineages:
+        live_dir = os.path.dirname(os.path.normpath(lineage))
+        name = pair_name(lineage)
+        members = pairs.setdefault((live_dir, name), [])
+        for candidate in (name,) + tuple(name + suffix
+                                        for suffix in LINEAGE_SUFFIXES):
+            path = os.path.join(live_dir, candidate)
+            if path not in members and os.path.isfile(
+                    os.path.join(path, 'privkey.pem')):
+                members.append(path)
+        if not members:
+            members.append(lineage)
+
+    files = []
+    for (_, name), members in pairs.items():
+        if len(members) == 1:
+            single = name + '.pem'
+            files.append(PemFile(
+                single, members[0], single,
+                tuple(single + extension
+                      for extension in BUNDLE_EXTENSIONS.values())
+            ))
+            continue
+        bundle = name + '.pem'
+        seen = set()
+        for lineage in members:
+            key_type = lineage_key_type(lineage)
+            if key_type not in BUNDLE_EXTENSIONS or key_type in seen:
+                logger.warning(
+                    "Not deploying %s, the bundle %s already has a %s"
+                    " certificate or it has an unsupported key",
+                    lineage, bundle, key_type)
+                continue
+            seen.add(key_type)
+            files.append(PemFile(bundle + BUNDLE_EXTENSIONS[key_type],
+                                 lineage, bundle, (bundle,)))
+    return files
+
+
+def combine(lineage):
+    """
+        Combine the private key and full chain of a lineage.
+
+        :param str lineage: Path of the lineage.
+        :rtype: bytes
+    """
+    with open(os.path.join(lineage, 'privkey.pem'), 'rb') as key, \
+            open(os.path.join(lineage, 'fullchain.pem'), 'rb') as chain:
+        key_data = key.read()
+        if not key_data.endswith(b'\n'):
+            key_data += b'\n'
+        return key_data + chain.read()
+
+
+def write_file(path, data, mode=0o640):
+    """
+        Write a file and flush it to disk.
+
+        :param str path: Path of the file.
+        :param bytes data: Contents.
+        :param int mode: File permissions.
+    """
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, 'wb') as target:
+        target.write(data)
+        target.flush()
+        os.fsync(target.fileno())
+
+
+def fsync_directory(path):
+    """
+        Flush the entries of a directory, e.g. after moving files into it.
+
+        :param str path: Path of the directory.
+    """
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _read(path):
+    """Contents of a file, `None` if it does not exist."""
+    try:
+        with open(path, 'rb') as source:
+            return source.read()
+    except (IOError, OSError):
+        return None
+
+
+def stage(files, crt_directory, staging_dir, run_journal=None, reuse=None):
+    """
+        Write combined PEMs to the staging directory.
+
+        :param list files: The files to stage, see `pem_files`.
+        :param str crt_directory: HAProxy's certificate directory.
+        :param str staging_dir: The staging directory.
+        :param run_journal: Journal to record the staged files in.
+        :type run_journal: `.journal.Journal`
+        :param dict reuse: Digests by name of files an interrupted run
+            staged, they are not written again when they are intact.
+        :returns: Mapping of the names of changed PEM files on their staged
+            path, and the names of the unchanged PEM files.
+        :rtype: tuple
+    """
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir, 0o750)
+    reuse = reuse or {}
+    staged = collections.OrderedDict()
+    unchanged = []
+    for pem in files:
+        name = pem.name
+        data = combine(pem.lineage)
+        if _read(os.path.join(crt_directory, name)) == data:
+            unchanged.append(name)
+            continue
+        path = os.path.join(staging_dir, name)
+        content_digest = pemcheck.digest(data)
+        if reuse.get(name) != content_digest or _read(path) != data:
+            write_file(path, data)
+        staged[name] = path
+        if run_journal is not None:
+            run_journal.record('stage', name, content_digest)
+    return staged, unchanged
+
+
+def commit(staged_path, crt_directory, name):
+    """
+        Atomically move a staged file into the certificate directory.
+
+        :param str staged_path: Path of the staged file.
+        :param str crt_directory: HAProxy's certificate directory.
+        :param str name: File name in the certificate directory.
+    """
+    os.rename(staged_path, os.path.join(crt_directory, name))
+
+
+def run_command(command):
+    """
+        Run a command, logging its output when it fails.
+
+        :param list command: Command and arguments.
+        :returns: Whether the command exited with status 0.
+        :rtype: bool
+    """
+    logger.debug("Running %s", command)
+    process = subprocess.Popen(
+        command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    output, _ = process.communicate()
+    if process.returncode != 0:
+        logger.error("%s exited with status %d: %s", " ".join(command),
+                     process.returncode, output.decode('utf-8', 'replace'))
+        return False
+    return True
+
+
+def reload_haproxy(haproxy_config, conftest_cmd, restart_cmd):
+    """
+        Test the HAProxy configuration and restart HAProxy.
+
+        :raises errors.PluginError: When the configuration test or the restart
+            fails.
+    """
+    if not run_command(list(conftest_cmd) + [haproxy_config]):
+        raise errors.PluginError(
+            "The HAProxy configuration test failed, HAProxy was not restarted")
+    if not run_command(list(restart_cmd)):
+        raise errors.PluginError("Restarting HAProxy failed")
+
+
+@profiled('deploy.deploy')
+def deploy(lineages, crt_directory, haproxy_config, conftest_cmd,
+           restart_cmd, staging_dir=None, ca_file=None, workers=None,
+           restart=True):
+    """
+        Deploy the certificates of lineages to HAProxy.
+
+        :param list lineages: Paths of the lineages.
+        :param str crt_directory: HAProxy's certificate directory.
+        :param str haproxy_config: Path of the HAProxy configuration.
+        :param list conftest_cmd: Configuration test command.
+        :param list restart_cmd: Restart command.
+        :param str staging_dir: Staging directory, defaults to
+            `staging_directory(crt_directory)`.
+        :param str ca_file: Optional PEM file with trusted roots to verify
+            chains against.
+        :param int workers: Number of validation processes.
+        :param bool restart: Whether to restart HAProxy when files changed.
+        :rtype: `DeployResult`
+        :raises errors.PluginError: When HAProxy could not be restarted.
+    """
+    result, run_journal = commit_lineages(
+        lineages, crt_directory, staging_dir=staging_dir, ca_file=ca_file,
+        workers=workers)
+    if needs_reload(result) and restart:
+        start_reload(run_journal, result)
+        reload_haproxy(haproxy_config, conftest_cmd, restart_cmd)
+        result = result._replace(reloaded=True)
+    run_journal.complete()
+    return result
+
+
+def needs_reload(result):
+    """
+        Whether HAProxy has to be reloaded after a deploy.
+
+        :param result: Result of `commit_lineages`.
+        :type result: `DeployResult`
+        :rtype: bool
+    """
+    return bool(result.committed or result.removed or result.resumed)
+
+
+def start_reload(run_journal, result):
+    """
+        Record that HAProxy is about to be reloaded.
+
+        :param run_journal: Journal of the deploy.
+        :type run_journal: `.journal.Journal`
+        :param result: Result of `commit_lineages`.
+        :type result: `DeployResult`
+    """
+    if result.resumed:
+        logger.info("Reloading for %d certificates of the interrupted"
+                    " deploy", len(result.resumed))
+    run_journal.record('reload')
+    run_journal.sync()
+
+
+def commit_lineages(lineages, crt_directory, staging_dir=None, ca_file=None,
+                    workers=None, cache=None):
+    """
+        Stage, validate and commit the certificates of lineages.
+
+        This is `deploy` without the reload: the journal of the run is left
+        open, the caller reloads HAProxy when `needs_reload` says so and
+        completes the journal after that.
+
+        :param list lineages: Paths of the lineages.
+        :param str crt_directory: HAProxy's certificate directory.
+        :param str staging_dir: Staging directory, defaults to
+            `staging_directory(crt_directory)`.
+        :param str ca_file: Optional PEM file with trusted roots.
+        :param int workers: Number of validation processes.
+        :param cache: Cache of validation results, defaults to the one in the
+            staging directory.
+        :type cache: `.pemcheck.CheckCache`
+        :returns: The result, with `reloaded` set to `False`, and the journal.
+        :rtype: tuple
+    """
+    if staging_dir is None:
+        staging_dir = staging_directory(crt_directory)
+    if not os.path.isdir(staging_dir):
+        os.makedirs(staging_dir, 0o750)
+    journal_path = os.path.join(staging_dir, JOURNAL_FILE)
+    interrupted = journal.recover(journal_path)
+    run_journal = journal.Journal(journal_path)
+    if interrupted is not None:
+        logger.warning(
+            "Resuming interrupted deploy %s, it staged %d and committed %d"
+            " certificates", interrupted.run_id, len(interrupted.staged),
+            len(interrupted.committed))
+        run_journal.begin(interrupted.run_id)
+    else:
+        run_journal.begin()
+
+    files = pem_files(lineages)
+    staged, unchanged = stage(
+        files, crt_directory, staging_dir, run_journal,
+        reuse=interrupted.staged if interrupted is not None else None)
+    run_journal.sync()
+
+    if cache is None:
+        cache = pemcheck.CheckCache(os.path.join(staging_dir, CACHE_FILE))
+    results = pemcheck.check_files(
+        list(staged.values()), ca_file=ca_file, cache=cache, workers=workers)
+    cache.save()
+
+    rejected = {}
+    for (name, path), result in zip(staged.items(), results):
+        if result.problems:
+            logger.error("Not deploying %s: %s", name,
+                         "; ".join(result.problems))
+            rejected[name] = result.problems
+    # The files of a bundle are deployed together or not at all.
+    rejected_bundles = set(pem.bundle for pem in files if pem.name in rejected)
+    for pem in files:
+        if pem.bundle in rejected_bundles and pem.name in staged and \
+                pem.name not in rejected:
+            rejected[pem.name] = ["held back with the rest of bundle %s"
+                                  % pem.bundle]
+    valid = collections.OrderedDict()
+    for (name, path), result in zip(staged.items(), results):
+        if name in rejected:
+            os.remove(path)
+            continue
+        valid[name] = path
+        run_journal.record('commit', name, result.digest)
+    superseded = []
+    for pem in files:
+        if pem.bundle in rejected_bundles:
+            continue
+        for name in pem.superseded:
+            if name not in superseded and \
+                    os.path.exists(os.path.join(crt_directory, name)):
+                superseded.append(name)
+                run_journal.record('remove', name)
+    # The commit records have to be on disk before the first file is moved,
+    # or a crash could leave committed files that are never reloaded.
+    run_journal.sync()
+
+    committed = []
+    for name, path in valid.items():
+        commit(path, crt_directory, name)
+        committed.append(name)
+    removed = []
+    for name in superseded:
+        os.remove(os.path.join(crt_directory, name))
+        removed.append(name)
+    if committed or removed:
+        fsync_directory(crt_directory)
+    resumed = []
+    if interrupted is not None:
+        resumed = [name for name in interrupted.committed
+                   if name not in committed]
+    logger.info("Deployed %d, unchanged %d, rejected %d, removed %d"
+                " certificates", len(committed), len(unchanged),
+                len(rejected), len(removed))
+    return DeployResult(committed, unchanged, rejected, False, resumed,
+                        removed), run_journal
+
+
+@profiled('deploy.deploy_instances')
+def deploy_instances(lineages, instance_profiles, ca_file=None, workers=None,
+                     restart=True,
+                     concurrency=instances.DEFAULT_CONCURRENCY):
+    """
+        Deploy the certificates of lineages to several HAProxy instances.
+
+        The certificates are committed to the instances one after the other,
+        validating each combined PEM only once. The instances that changed
+        are then tested and restarted concurrently. A failure of one instance
+        does not affect the others.
+
+        :param list lineages: Paths of the lineages.
+        :param list instance_profiles: The instances, see
+            `.instances.read_instances`.
+        :param str ca_file: Optional PEM file with trusted roots.
+        :param int workers: Number of validation processes.
+        :param bool restart: Whether to restart instances when files changed.
+        :param int concurrency: Number of instances to reload at once.
+        :returns: Results per instance name.
+        :rtype: `collections.OrderedDict` of `InstanceResult`
+    """
+    results = collections.OrderedDict()
+    journals = {}
+    # The combined PEMs are the same for all instances, so is the outcome of
+    # validating them. The results are shared in memory and every instance
+    # keeps its own cache file, so one broken staging directory does not
+    # fail the others.
+    shared = pemcheck.CheckCache()
+    for instance in instance_profiles:
+        try:
+            cache = pemcheck.CheckCache(os.path.join(
+                staging_directory(instance.crt_directory), CACHE_FILE))
+            cache.entries.update(shared.entries)
+            result, run_journal = commit_lineages(
+                lineages, instance.crt_directory, ca_file=ca_file,
+                workers=workers, cache=cache)
+            shared.entries.update(cache.entries)
+        except (errors.Error, IOError, OSError) as error:
+            logger.error("Deploying to %s failed: %s", instance.name, error)
+            results[instance.name] = InstanceResult(instance, None, str(error))
+            continue
+        results[instance.name] = InstanceResult(instance, result, None)
+        journals[instance.name] = run_journal
+
+    to_reload = [
+        instance for instance in instance_profiles
+        if instance.name in journals and restart and
+        needs_reload(results[instance.name].result)
+    ]
+    for instance in to_reload:
+        start_reload(journals[instance.name], results[instance.name].result)
+    failures = instances.reload_instances(to_reload, concurrency)
+
+    for instance, failure in zip(to_reload, failures):
+        outcome = results[instance.name]
+        if failure is not None:
+            logger.error(failure)
+            # The journal stays open, the next run reloads again.
+            del journals[instance.name]
+            results[instance.name] = outcome._replace(error=failure)
+            continue
+        results[instance.name] = outcome._replace(
+            result=outcome.result._replace(reloaded=True))
+    for run_journal in journals.values():
+        run_journal.complete()
+    return results
+
+
+def main(cli_args=None):
+    """Deploy certificates to HAProxy, see the module documentation."""
+    parser = argparse.ArgumentParser(
+        description="Deploy certbot certificates to HAProxy.")
+    parser.add_argument(
+        '--lineage', action='append', default=[],
+        help="Lineage to deploy, may be repeated. Defaults to the"
+        " RENEWED_LINEAGE environment variable.")
+    parser.add_argument(
+        '--live-dir', help="Deploy all lineages in this live directory.")
+    parser.add_argument('--crt-directory')
+    parser.add_argument('--haproxy-config')
+    parser.add_argument('--staging-dir')
+    parser.add_argument(
+        '--ca-file', help="Verify chains against the roots in this file.")
+    parser.add_argument('--workers', type=int)
+    parser.add_argument('--no-restart', dest='restart', action='store_false')
+    parser.add_argument(
+        '--instances',
+        help="Deploy to all HAProxy instances in this profiles file, see"
+        " certbot_haproxy.instances. Defaults to the instances_config"
+        " constant when that file exists.")
+    parser.add_argument(
+        '--concurrency', type=int, default=instances.DEFAULT_CONCURRENCY,
+        help="Number of instances to reload at once (default: %(default)s).")
+    args = parser.parse_args(cli_args)
+    logging.basicConfig(level=logging.INFO)
+
+    lineages = list(args.lineage)
+    if args.live_dir:
+        lineages.extend(find_lineages(args.live_dir))
+    if not lineages and os.environ.get('RENEWED_LINEAGE'):
+        lineages.append(os.environ['RENEWED_LINEAGE'])
+    if not lineages:
+        logger.info("Nothing to deploy")
+        return 0
+
+    profiles_path = args.instances
+    if profiles_path is None and not (args.crt_directory or
+                                      args.haproxy_config):
+        try:
+            profiles_path = constants.os_constant('instances_config')
+        except errors.Error:
+            profiles_path = None
+        if profiles_path and not os.path.exists(profiles_path):
+            profiles_path = None
+    if profiles_path:
+        return _deploy_instances(args, lineages, profiles_path)
+
+    try:
+        result = deploy(
+            lineages,
+            args.crt_directory or constants.os_constant('crt_directory'),
+            args.haproxy_config or constants.os_constant('haproxy_config'),
+            constants.os_constant('conftest_cmd'),
+            constants.os_constant('restart_cmd'),
+            staging_dir=args.staging_dir, ca_file=args.ca_file,
+            workers=args.workers, restart=args.restart,
+        )
+    except errors.PluginError as error:
+        logger.error(str(error))
+        return 1
+    return 1 if result.rejected else 0
+
+
+def _deploy_instances(args, lineages, profiles_path):
+    """Deploy to the instances in a profiles file, report per instance."""
+    try:
+        instance_profiles = instances.read_instances(profiles_path)
+    except errors.PluginError as error:
+        logger.error(str(error))
+        return 1
+    results = deploy_instances(
+        lineages, instance_profiles, ca_file=args.ca_file,
+        workers=args.workers, restart=args.restart,
+        concurrency=args.concurrency)
+    status = 0
+    for name, outcome in results.items():
+        if outcome.result is not None:
+            logger.info(
+                "%s: deployed %d, unchanged %d, rejected %d, reloaded: %s",
+                name, len(outcome.result.committed),
+                len(outcome.result.unchanged), len(outcome.result.rejected),
+                "yes" if outcome.result.reloaded else "no")
+        if outcome.error is not None or outcome.result.rejected:
+            status = 1
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,389 @@
+"""Synthetic scale fixtures.
+
+Reproducing the behaviour of thousands of certificates and domains locally
+needs as many certificates and a configuration that routes all of those
+domains. This module generates both, without contacting a CA::
+
+    certbot-haproxy-fixtures --count 10000 --sans 1:5 --key-types rsa,ec \\
+        /tmp/fixtures
+
+The output directory then holds:
+
+  - ``ca.pem``: the throw-away CA that signed the certificates, to pass as
+    ``--ca-file`` to ``certbot-haproxy-deploy``;
+  - ``live/<name>/``: a certbot lineage per certificate, with ``cert.pem``,
+    ``chain.pem``, ``fullchain.pem`` and ``privkey.pem``;
+  - ``certs/<name>.pem``: the combined PEM of every lineage, as deployed by
+    `certbot_haproxy.deploy`;
+  - ``crt-list.txt``: an HAProxy crt-list of the combined PEMs with their
+    domains as SNI filters;
+  - ``haproxy.cfg``: a configuration with one ``acl <name> hdr(host) -i
+    <domain>`` line per domain (see `.constants.RE_HAPROXY_DOMAIN_ACL`),
+    ``use_backend`` rules spreading the domains over ``--backends`` backends
+    and a TLS frontend that loads the crt-list.
+
+Certificate ``<index>`` of zone ``<zone>`` is valid for ``site<index>.<zone>``
+and ``--sans`` minus one ``alt<n>.site<index>.<zone>`` names. The SAN count
+is drawn from the given range and the key type is taken round-robin from
+``--key-types``. With ``--spread-days`` the certificates were issued up to
+that many days ago, so their expiry dates are spread as well. The output
+only depends on ``--seed``, apart from the keys and signatures.
+
+Key generation dominates the run time, the certificates are generated in a
+process pool in chunks, each worker writes the files of its chunk.
+``--shared-keys`` lets all certificates of a chunk with the same key type
+share a key, which is a lot faster for RSA and does not matter for parsing
+and load time measurements.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import os
+import random
+import sys
+from concurrent import futures
+
+from OpenSSL import crypto
+
+from certbot_haproxy import util
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Default number of zones the domains are spread over.
+DEFAULT_ZONES = 100
+
+#: Default number of backends the domains are routed to.
+DEFAULT_BACKENDS = 50
+
+#: Default validity of the certificates in days.
+DEFAULT_DAYS = 90
+
+Fixture = collections.namedtuple(
+    'Fixture', 'name domains key_type backend not_after'
+)
+Fixture.__doc__ = """
+    A generated certificate.
+
+    :ivar str name: Name of its lineage and combined PEM.
+    :ivar list domains: Domains it is valid for, the first one is the
+        commonName.
+    :ivar str key_type: Type of its key, one of `.util.KEY_TYPES`.
+    :ivar str backend: Backend its domains are routed to.
+    :ivar not_after: When it expires, in UTC.
+    :vartype not_after: `datetime.datetime`
+"""
+
+Spec = collections.namedtuple(
+    'Spec',
+    'count sans key_types zones backends days spread_days seed shared_keys'
+)
+Spec.__doc__ = """
+    What to generate, see the module documentation.
+
+    :ivar int count: Number of certificates.
+    :ivar tuple sans: Minimum and maximum number of names per certificate.
+    :ivar tuple key_types: Key types to use round-robin.
+    :ivar int zones: Number of zones the domains are spread over.
+    :ivar int backends: Number of backends.
+    :ivar int days: Validity of the certificates in days.
+    :ivar int spread_days: Maximum number of days ago the certificates were
+        issued.
+    :ivar int seed: Seed of the random choices.
+    :ivar bool shared_keys: Whether the certificates of a chunk share keys.
+"""
+
+
+def parse_sans(value):
+    """
+        Parse a SAN count or range.
+
+        :param str value: ``N`` or ``MIN:MAX``.
+        :returns: Minimum and maximum.
+        :rtype: tuple
+        :raises ValueError: When the value is not a valid count or range.
+    """
+    low, _, high = value.partition(':')
+    sans = (int(low), int(high or low))
+    if sans[0] < 1 or sans[1] < sans[0]:
+        raise ValueError("Invalid SAN count: %s" % value)
+    return sans
+
+
+def describe(spec, index):
+    """
+        Describe certificate `index` of a spec.
+
+        Every certificate has its own random generator, so the outcome does
+        not depend on how the certificates are divided over the workers.
+
+        :param spec: What to generate.
+        :type spec: `Spec`
+        :param int index: Number of the certificate.
+        :returns: The certificate, without `not_after`, and the number of
+            seconds it was issued ago.
+        :rtype: tuple
+    """
+    rand = random.Random('%s-%d' % (spec.seed, index))
+    zone = 'zone%d.test' % (index % spec.zones)
+    primary = 'site%d.%s' % (index, zone)
+    san_count = rand.randint(*spec.sans)
+    domains = [primary] + [
+        'alt%d.%s' % (number, primary) for number in range(1, san_count)
+    ]
+    fixture = Fixture(
+        primary, domains, spec.key_types[index % len(spec.key_types)],
+        'backend_%d' % (index % spec.backends), None)
+    return fixture, rand.randint(0, spec.spread_days * 86400)
+
+
+def _sign(key, domains, ca_key, ca_cert, serial, not_before, not_after):
+    """Issue a certificate for domains signed by the CA."""
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().commonName = domains[0]
+    cert.set_serial_number(serial)
+    cert.gmtime_adj_notBefore(not_before)
+    cert.gmtime_adj_notAfter(not_after)
+    cert.set_issuer(ca_cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([crypto.X509Extension(
+        b'subjectAltName', False,
+        b', '.join(b'DNS:' + domain.encode('ascii') for domain in domains)
+    )])
+    cert.sign(ca_key, 'sha256')
+    return cert
+
+
+def make_ca(key_type='rsa'):
+    """
+        Create a throw-away CA.
+
+        :param str key_type: Type of its key, one of `.util.KEY_TYPES`.
+        :returns: The key and the certificate.
+        :rtype: tuple of `OpenSSL.crypto.PKey` and `OpenSSL.crypto.X509`
+    """
+    key = util.generate_key(key_type)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().commonName = u'certbot-haproxy fixtures CA'
+    cert.set_serial_number(1)
+    cert.gmtime_adj_notBefore(-86400 * 365)
+    cert.gmtime_adj_notAfter(86400 * 365 * 10)
+    cert.set_issuer(cert.get_subject())
+    cert.set_pubkey(key)
+    cert.add_extensions([
+        crypto.X509Extension(b'basicConstraints', True, b'CA:TRUE'),
+    ])
+    cert.sign(key, 'sha256')
+    return key, cert
+
+
+def _write(path, data):
+    """Write a file, fixtures are not worth an fsync."""
+    with open(path, 'wb') as target:
+        target.write(data)
+
+
+def _generate_chunk(spec, indices, directory, ca_key_pem, ca_pem):
+    """Generate and write the certificates `indices`, in a worker."""
+    ca_key = crypto.load_privatekey(crypto.FILETYPE_PEM, ca_key_pem)
+    ca_cert = crypto.load_certificate(crypto.FILETYPE_PEM, ca_pem)
+    shared = {}
+    fixtures = []
+    for index in indices:
+        fixture, issued_ago = describe(spec, index)
+        if spec.shared_keys:
+            if fixture.key_type not in shared:
+                shared[fixture.key_type] = util.generate_key(fixture.key_type)
+            key = shared[fixture.key_type]
+        else:
+            key = util.generate_key(fixture.key_type)
+        cert = _sign(key, fixture.domains, ca_key, ca_cert, index + 2,
+                     -issued_ago, spec.days * 86400 - issued_ago)
+        key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, key)
+        cert_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
+
+        lineage = os.path.join(directory, 'live', fixture.name)
+        if not os.path.isdir(lineage):
+            os.makedirs(lineage)
+        _write(os.path.join(lineage, 'privkey.pem'), key_pem)
+        _write(os.path.join(lineage, 'cert.pem'), cert_pem)
+        _write(os.path.join(lineage, 'chain.pem'), ca_pem)
+        _write(os.path.join(lineage, 'fullchain.pem'), cert_pem + ca_pem)
+        _write(os.path.join(directory, 'certs', fixture.name + '.pem'),
+               key_pem + cert_pem + ca_pem)
+        fixtures.append(fixture._replace(not_after=util.certificate_not_after(
+            cert)))
+    return fixtures
+
+
+def generate(directory, spec, workers=None, chunk_size=64):
+    """
+        Generate the certificates of a spec and write them to a directory.
+
+        :param str directory: Output directory, see the module documentation.
+        :param spec: What to generate.
+        :type spec: `Spec`
+        :param int workers: Number of worker processes, defaults to the number
+            of CPUs.
+        :param int chunk_size: Number of certificates a worker generates per
+            task.
+        :returns: The certificates in order.
+        :rtype: list of `Fixture`
+    """
+    for subdirectory in ('live', 'certs'):
+        path = os.path.join(directory, subdirectory)
+        if not os.path.isdir(path):
+            os.makedirs(path)
+    ca_key, ca_cert = make_ca()
+    ca_key_pem = crypto.dump_privatekey(crypto.FILETYPE_PEM, ca_key)
+    ca_pem = crypto.dump_certificate(crypto.FILETYPE_PEM, ca_cert)
+    _write(os.path.join(directory, 'ca.pem'), ca_pem)
+
+    indices = list(range(spec.count))
+    chunks = [indices[start:start + chunk_size]
+              for start in range(0, len(indices), chunk_size)]
+    arguments = (directory, ca_key_pem, ca_pem)
+    if len(chunks) <= 1 or workers == 1:
+        generated = [_generate_chunk(spec, chunk, *arguments)
+                     for chunk in chunks]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            generated = list(executor.map(
+                _generate_chunk, [spec] * len(chunks), chunks,
+                *[[argument] * len(chunks) for argument in arguments]))
+    return [fixture for chunk in generated for fixture in chunk]
+
+
+def crt_list(fixtures, crt_directory):
+    """
+        Format an HAProxy crt-list of the combined PEMs.
+
+        :param list fixtures: The certificates.
+        :param str crt_directory: Directory of the combined PEMs.
+        :rtype: list of str
+    """
+    return [
+        '%s %s' % (os.path.join(crt_directory, fixture.name + '.pem'),
+                   ' '.join(fixture.domains))
+        for fixture in fixtures
+    ]
+
+
+def haproxy_config(fixtures, crt_list_path, backends=DEFAULT_BACKENDS):
+    """
+        Format an HAProxy configuration that routes every domain by ACL.
+
+        :param list fixtures: The certificates.
+        :param str crt_list_path: Path of the crt-list to load.
+        :param int backends: Number of backends.
+        :rtype: list of str
+    """
+    lines = [
+        'global',
+        '    maxconn 4096',
+        '',
+        'defaults',
+        '    mode http',
+        '    timeout connect 5s',
+        '    timeout client 30s',
+        '    timeout server 30s',
+        '',
+        'frontend http-in',
+        '    bind *:80',
+        '    bind *:443 ssl crt-list %s' % crt_list_path,
+        '    acl is_certbot path_beg -i /.well-known/acme-challenge',
+        '    use_backend certbot if is_certbot',
+    ]
+    rules = []
+    for index, fixture in enumerate(fixtures):
+        for number, domain in enumerate(fixture.domains):
+            acl = 'host_%d_%d' % (index, number)
+            lines.append('    acl %s hdr(host) -i %s' % (acl, domain))
+            rules.append('    use_backend %s if %s' % (fixture.backend, acl))
+    lines.extend(rules)
+    lines.extend([
+        '    default_backend backend_0',
+        '',
+        'backend certbot',
+        '    server certbot 127.0.0.1:8000',
+    ])
+    for index in range(backends):
+        lines.extend([
+            '',
+            'backend backend_%d' % index,
+            '    server node1 127.0.0.1:8080',
+        ])
+    return lines
+
+
+def _write_lines(path, lines):
+    """Write lines to a text file."""
+    with open(path, 'w') as target:
+        target.write('\n'.join(lines) + '\n')
+
+
+def main(cli_args=None):
+    """Generate scale fixtures, see the module documentation."""
+    parser = argparse.ArgumentParser(
+        description="Generate synthetic certificates, a crt-list and an"
+        " HAProxy configuration for scale tests.")
+    parser.add_argument('directory', help="Output directory.")
+    parser.add_argument('--count', type=int, default=1000,
+                        help="Number of certificates (default: %(default)s).")
+    parser.add_argument('--sans', default='1',
+                        help="Names per certificate, N or MIN:MAX"
+                        " (default: %(default)s).")
+    parser.add_argument('--key-types', default='rsa',
+                        help="Comma separated key types to use round-robin,"
+                        " of %s (default: %%(default)s)."
+                        % ', '.join(util.KEY_TYPES))
+    parser.add_argument('--zones', type=int, default=DEFAULT_ZONES)
+    parser.add_argument('--backends', type=int, default=DEFAULT_BACKENDS)
+    parser.add_argument('--days', type=int, default=DEFAULT_DAYS,
+                        help="Validity in days (default: %(default)s).")
+    parser.add_argument('--spread-days', type=int, default=0,
+                        help="Issue the certificates up to this many days"
+                        " ago (default: %(default)s).")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--shared-keys', action='store_true',
+                        help="Share keys between the certificates of a"
+                        " chunk.")
+    parser.add_argument('--workers', type=int)
+    args = parser.parse_args(cli_args)
+    logging.basicConfig(level=logging.INFO)
+
+    try:
+        sans = parse_sans(args.sans)
+    except ValueError:
+        parser.error("invalid --sans %r" % args.sans)
+    key_types = tuple(key_type for key_type in args.key_types.split(',')
+                      if key_type)
+    for key_type in key_types:
+        if key_type not in util.KEY_TYPES:
+            parser.error("unknown key type %r" % key_type)
+    if not key_types or args.count < 1 or args.zones < 1 or \
+            args.backends < 1:
+        parser.error("--count, --zones, --backends and --key-types may not"
+                     " be empty")
+
+    spec = Spec(args.count, sans, key_types, args.zones, args.backends,
+                args.days, args.spread_days, args.seed, args.shared_keys)
+    fixtures = generate(args.directory, spec, workers=args.workers)
+
+    directory = os.path.abspath(args.directory)
+    crt_list_path = os.path.join(directory, 'crt-list.txt')
+    _write_lines(crt_list_path,
+                 crt_list(fixtures, os.path.join(directory, 'certs')))
+    _write_lines(os.path.join(directory, 'haproxy.cfg'),
+                 haproxy_config(fixtures, crt_list_path, args.backends))
+    logger.info("Generated %d certificates for %d domains in %s",
+                len(fixtures), sum(len(f.domains) for f in fixtures),
+                directory)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,234 @@
+"""HAProxy configuration reading.
+
+This plugin does not configure HAProxy, but several of its tools need to know
+which domains a configuration serves and which backend each of them is routed
+to. This module extracts that from configurations that route per domain with
+``acl <name> hdr(host) -i <domain> [<domain> ...]`` lines (see
+`.constants.RE_HAPROXY_DOMAIN_ACL`) and ``use_backend <backend> if <name>``
+rules referring to those ACLs. An ACL is only a domain ACL when all its lines
+match domains only: a ``host:port`` pattern, a flag after the domain or a line
+with another criterion makes its name match something else as well.
+
+Only rules whose condition is an ``or`` of domain ACLs route by the Host
+header alone. Other rules that refer to domain ACLs, with ``unless``, an
+implicit ``and``, a negation, an anonymous ``{ }`` ACL or an ACL name that
+also matches something else, are returned by `parse_routing` as well, so
+callers can tell when a configuration does more than this module understands.
+"""
+import collections
+import logging
+
+from certbot_haproxy.constants import (
+    RE_DOMAIN, RE_HAPROXY_ACL, RE_HAPROXY_DOMAIN_ACL, RE_HAPROXY_USE_BACKEND,
+    RE_HAPROXY_SECTION
+)
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+DomainACL = collections.namedtuple(
+    'DomainACL', 'section acl domain backend line_nr'
+)
+DomainACL.__doc__ = """
+    A domain matched by a ``hdr(host)`` ACL.
+
+    :ivar str section: Name of the frontend or listen section.
+    :ivar str acl: Name of the ACL.
+    :ivar str domain: Lower-cased domain name.
+    :ivar str backend: Backend the first ``use_backend`` rule that routes by
+        the ACL alone (see `UseBackendRule.by_domain`) routes to, `None` if no
+        rule does.
+    :ivar int line_nr: Line number of the ACL in the configuration.
+"""
+
+UseBackendRule = collections.namedtuple(
+    'UseBackendRule', 'section backend condition acls by_domain line_nr'
+)
+UseBackendRule.__doc__ = """
+    A ``use_backend`` rule.
+
+    :ivar str section: Name of the frontend or listen section.
+    :ivar str backend: The backend the rule routes to.
+    :ivar str condition: The condition, including ``if`` or ``unless``, empty
+        for a rule without one.
+    :ivar list acls: Names of the ACLs with domain lines the condition refers
+        to.
+    :ivar bool by_domain: Whether the condition is an ``or`` of domain ACLs
+        only, i.e. the rule routes by the Host header alone.
+    :ivar int line_nr: Line number of the rule in the configuration.
+"""
+
+Routing = collections.namedtuple('Routing', 'acls rules')
+Routing.__doc__ = """
+    The domain ACLs and ``use_backend`` rules of a configuration.
+
+    :ivar list acls: `DomainACL` in the order they appear.
+    :ivar list rules: `UseBackendRule` in the order they appear.
+"""
+
+
+def _strip_comment(line):
+    """Remove a trailing comment from a configuration line."""
+    index = line.find('#')
+    if index != -1:
+        line = line[:index]
+    return line.rstrip()
+
+
+def _condition_acls(condition):
+    """
+        Return the ACL names of an ``if`` condition that is a plain ``or``.
+
+        :param str condition: The condition, without ``if``.
+        :returns: The names, `None` if the condition is anything else, e.g.
+            it ands ACLs, negates one (``!name``) or uses anonymous ACLs
+            (``{ ... }``).
+        :rtype: list
+    """
+    words = condition.split()
+    names = words[::2]
+    operators = words[1::2]
+    if len(words) % 2 == 0 or \
+            any(operator not in ('or', '||') for operator in operators) or \
+            any(name.startswith('!') or '{' in name or '}' in name
+                for name in names):
+        return None
+    return names
+
+
+def _referenced_acls(condition):
+    """Return the names of the named ACLs a condition refers to."""
+    names = []
+    depth = 0
+    for word in condition.split():
+        if word == '{':
+            depth += 1
+        elif word == '}':
+            depth -= 1
+        elif depth == 0 and word not in ('or', '||'):
+            names.append(word.lstrip('!'))
+    return names
+
+
+def _acl_domains(line):
+    """
+        Return the domains an ``acl`` line matches the Host header with.
+
+        :param str line: The ``acl`` line, without comment.
+        :returns: Lower-cased domains, `None` if the ACL matches anything else
+            as well, e.g. a ``host:port`` pattern or another criterion.
+        :rtype: list
+    """
+    match = RE_HAPROXY_DOMAIN_ACL.match(line)
+    if not match:
+        return None
+    domains = [match.group('domain')] + line[match.end():].split()
+    if not all(RE_DOMAIN.match(domain) for domain in domains):
+        return None
+    return [domain.lower() for domain in domains]
+
+
+def parse_domain_acls(lines):
+    """
+        Find all domain ACLs and the backends they route to.
+
+        :param lines: Iterable of configuration lines.
+        :returns: Domain ACLs in the order they appear in the configuration.
+        :rtype: list of `DomainACL`
+    """
+    return parse_routing(lines).acls
+
+
+def parse_routing(lines):
+    """
+        Find all domain ACLs, ``use_backend`` rules and how they route.
+
+        HAProxy evaluates ``use_backend`` rules in order, so a domain is
+        assigned the backend of the first rule that routes by its ACL alone.
+        Rules that also depend on anything else, e.g.
+        ``use_backend api if host_a is_api``, do not assign a backend.
+
+        :param lines: Iterable of configuration lines.
+        :rtype: `Routing`
+    """
+    acls = []
+    found_rules = []
+    section = None
+    # (section, acl name) -> indices in `acls`
+    by_name = collections.defaultdict(list)
+    # ACL names with a line that does not only match domains.
+    other_names = set()
+    for line_nr, line in enumerate(lines, 1):
+        line = _strip_comment(line)
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            match = RE_HAPROXY_SECTION.match(line)
+            if match:
+                section = match.group('name')
+            continue
+
+        match = RE_HAPROXY_ACL.match(line)
+        if match:
+            name = match.group('name')
+            domains = _acl_domains(line)
+            if domains is None:
+                other_names.add((section, name))
+                continue
+            for domain in domains:
+                by_name[(section, name)].append(len(acls))
+                acls.append(DomainACL(section, name, domain, None, line_nr))
+            continue
+
+        match = RE_HAPROXY_USE_BACKEND.match(line)
+        if match:
+            found_rules.append((section, match, line_nr))
+
+    rules = []
+    for section, match, line_nr in found_rules:
+        condition = match.group('condition') or ''
+        domain_acls = [name for name in _referenced_acls(condition)
+                       if (section, name) in by_name]
+        names = None
+        if match.group('operator') == 'if':
+            names = _condition_acls(condition)
+        by_domain = names is not None and all(
+            (section, name) in by_name and (section, name) not in other_names
+            for name in names)
+        rules.append(UseBackendRule(
+            section, match.group('backend'),
+            ('%s %s' % (match.group('operator'), condition)
+             if condition else ''),
+            domain_acls, by_domain, line_nr
+        ))
+        if not by_domain:
+            continue
+        for name in names:
+            for index in by_name[(section, name)]:
+                if acls[index].backend is None:
+                    acls[index] = acls[index]._replace(
+                        backend=match.group('backend'))
+    return Routing(acls, rules)
+
+
+def read_domain_acls(path):
+    """
+        Read the domain ACLs of a configuration file.
+
+        :param str path: Path to the HAProxy configuration.
+        :rtype: list of `DomainACL`
+    """
+    return read_routing(path).acls
+
+
+def read_routing(path):
+    """
+        Read the domain ACLs and ``use_backend`` rules of a configuration file.
+
+        :param str path: Path to the HAProxy configuration.
+        :rtype: `Routing`
+    """
+    with open(path) as config:
+        routing = parse_routing(config)
+    logger.debug("Found %d domain ACLs and %d use_backend rules in %s",
+                 len(routing.acls), len(routing.rules), path)
+    return routing
@@ -0,0 +1,298 @@
+"""Host to backend map files.
+
+Configurations that route per domain with one ``acl <name> hdr(host) -i
+<domain>`` line and a ``use_backend`` rule per domain make HAProxy evaluate
+the ACLs one by one on every request, so the cost of routing a request grows
+with the number of domains. A map file does the same with a single tree
+lookup::
+
+    use_backend %[req.hdr(host),lower,map(/etc/haproxy/hosts.map)]
+
+This module generates such a map from the domain ACLs of a configuration
+(see `certbot_haproxy.haproxycfg`) and keeps it in sync with the domains
+certificates are issued for. Changes are written to the map file, so they
+survive a reload, and applied to the running HAProxy through the runtime API
+(see `certbot_haproxy.runtime`), so no reload is needed::
+
+    certbot-haproxy-hostmap generate --haproxy-config /etc/haproxy/haproxy.cfg \\
+        --map /etc/haproxy/hosts.map
+    certbot renew --deploy-hook "certbot-haproxy-hostmap sync \\
+        --map /etc/haproxy/hosts.map --default-backend nodes"
+
+`generate` refuses configurations whose routing a map can't reproduce, see
+`unconvertible_rules`.
+
+`sync` adds the domains in certbot's `RENEWED_DOMAINS` environment variable,
+or the domains given with ``--domain``, to the map when they are not in it
+yet.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import logging
+import os
+import sys
+
+from certbot_haproxy import deploy
+from certbot_haproxy import haproxycfg
+from certbot_haproxy import runtime
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+MapChanges = collections.namedtuple('MapChanges', 'added changed removed')
+
+
+def unconvertible_rules(rules):
+    """
+        Find the ``use_backend`` rules that keep a map from routing the same.
+
+        The map replaces the rules that route by domain alone. Rules that
+        refer to domain ACLs in any other way, e.g. with ``unless``, an
+        ``and`` or a negation, can't be expressed in it. Other rules can be
+        kept in front of the map rule, but only when they come before the
+        first domain rule of their section, or their precedence changes.
+
+        :param rules: Rules from `.haproxycfg.parse_routing`.
+        :returns: The offending rules with the reason.
+        :rtype: list of tuples
+    """
+    problems = []
+    routed = set()
+    for rule in rules:
+        if rule.by_domain:
+            routed.add(rule.section)
+        elif rule.acls:
+            problems.append(
+                (rule, "it refers to domain ACLs, but its condition is not"
+                       " an 'or' of ACLs that only match domains"))
+        elif rule.section in routed:
+            problems.append(
+                (rule, "it follows rules that route by domain"))
+    return problems
+
+
+def build_map(acls):
+    """
+        Build the host to backend map equivalent to domain ACLs.
+
+        ACLs that are not used by any ``use_backend`` rule are left out, the
+        first rule that routes a domain wins, as in HAProxy. The map is only
+        equivalent when `unconvertible_rules` finds nothing.
+
+        :param acls: Domain ACLs from `.haproxycfg.parse_domain_acls`.
+        :returns: Mapping of domain on backend.
+        :rtype: `collections.OrderedDict`
+    """
+    entries = collections.OrderedDict()
+    for acl in acls:
+        if acl.backend is not None and acl.domain not in entries:
+            entries[acl.domain] = acl.backend
+    return entries
+
+
+def use_backend_rule(map_path, default_backend=None):
+    """
+        The ``use_backend`` rule that routes by a map.
+
+        :param str map_path: Path of the map file.
+        :param str default_backend: Backend for hosts not in the map, when
+            not given, HAProxy falls back to the ``default_backend``.
+        :rtype: str
+    """
+    arguments = map_path
+    if default_backend:
+        arguments += ',' + default_backend
+    return 'use_backend %%[req.hdr(host),lower,map(%s)]' % arguments
+
+
+def read_map(path):
+    """
+        Read a map file.
+
+        :param str path: Path of the map file.
+        :returns: Mapping of key on value, empty if the file does not exist.
+        :rtype: `collections.OrderedDict`
+    """
+    entries = collections.OrderedDict()
+    if not os.path.exists(path):
+        return entries
+    with open(path) as map_file:
+        for line in map_file:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) == 2:
+                entries[parts[0]] = parts[1]
+    return entries
+
+
+def write_map(path, entries):
+    """
+        Atomically replace a map file.
+
+        :param str path: Path of the map file.
+        :param dict entries: Mapping of key on value.
+    """
+    data = ''.join('%s %s\n' % (key, value)
+                   for key, value in sorted(entries.items()))
+    temp_path = path + '.tmp'
+    deploy.write_file(temp_path, data.encode('utf-8'), mode=0o644)
+    os.rename(temp_path, path)
+
+
+def diff_maps(current, wanted):
+    """
+        Determine the changes that turn one map into another.
+
+        :param dict current: The current entries.
+        :param dict wanted: The wanted entries.
+        :rtype: `MapChanges` of lists of keys
+    """
+    added = [key for key in wanted if key not in current]
+    changed = [key for key in wanted
+               if key in current and current[key] != wanted[key]]
+    removed = [key for key in current if key not in wanted]
+    return MapChanges(added, changed, removed)
+
+
+def sync_runtime(client, map_ref, wanted):
+    """
+        Apply a map to a running HAProxy through the runtime API.
+
+        The map as HAProxy has it loaded is compared to `wanted`, only the
+        differences are sent, pipelined over one connection.
+
+        :param client: Runtime API client.
+        :type client: `.runtime.RuntimeClient`
+        :param str map_ref: The map as HAProxy knows it, i.e. the path it was
+            loaded from.
+        :param dict wanted: The wanted entries.
+        :returns: The applied changes.
+        :rtype: `MapChanges`
+        :raises runtime.RuntimeAPIError: When HAProxy rejects a change.
+    """
+    current = client.execute('show map %s' % map_ref)
+    if not current.ok:
+        raise runtime.RuntimeAPIError(current.text.strip())
+    changes = diff_maps(current.as_map(), wanted)
+    commands = (
+        ['add map %s %s %s' % (map_ref, key, wanted[key])
+         for key in changes.added] +
+        ['set map %s %s %s' % (map_ref, key, wanted[key])
+         for key in changes.changed] +
+        ['del map %s %s' % (map_ref, key) for key in changes.removed]
+    )
+    failed = [response for response in client.execute_many(commands)
+              if not response.ok]
+    if failed:
+        raise runtime.RuntimeAPIError(
+            "%d map updates failed, first: %s: %s" % (
+                len(failed), failed[0].command, failed[0].text.strip()))
+    logger.info("Map %s: %d added, %d changed, %d removed", map_ref,
+                len(changes.added), len(changes.changed),
+                len(changes.removed))
+    return changes
+
+
+def add_domains(entries, domains, default_backend):
+    """
+        Add domains that are not in a map yet.
+
+        :param dict entries: Mapping of domain on backend, updated in place.
+        :param list domains: Domains to add.
+        :param str default_backend: Backend to route new domains to.
+        :returns: The domains that were added.
+        :rtype: list
+    """
+    added = []
+    for domain in domains:
+        domain = domain.lower()
+        if domain.startswith('*.') or domain in entries:
+            continue
+        entries[domain] = default_backend
+        added.append(domain)
+    return added
+
+
+def _generate(args):
+    """Generate a map file from domain ACLs."""
+    acls = []
+    failed = False
+    for path in args.haproxy_config:
+        routing = haproxycfg.read_routing(path)
+        for rule, reason in unconvertible_rules(routing.rules):
+            logger.error(
+                "%s:%d: can't convert '%s' to a map, %s", path, rule.line_nr,
+                ('use_backend %s %s' % (rule.backend, rule.condition)).strip(),
+                reason)
+            failed = True
+        acls.extend(routing.acls)
+    if failed:
+        logger.error("Not writing %s, rewrite the rules above first",
+                     args.map)
+        return 1
+    entries = build_map(acls)
+    write_map(args.map, entries)
+    print("Wrote %d domains to %s" % (len(entries), args.map))
+    print("Replace the domain ACLs and their use_backend rules with:")
+    print("    " + use_backend_rule(args.map, args.default_backend))
+    return 0
+
+
+def _sync(args):
+    """Add domains to a map file and the running HAProxy."""
+    entries = read_map(args.map)
+    domains = list(args.domain)
+    if not domains and os.environ.get('RENEWED_DOMAINS'):
+        domains = os.environ['RENEWED_DOMAINS'].split()
+    added = add_domains(entries, domains, args.default_backend)
+    if added:
+        write_map(args.map, entries)
+    if args.no_runtime:
+        return 0
+    try:
+        with runtime.RuntimeClient(args.socket) as client:
+            sync_runtime(client, args.map, entries)
+    except runtime.RuntimeAPIError as error:
+        logger.error("Could not update the running HAProxy: %s", error)
+        return 1
+    return 0
+
+
+def main(cli_args=None):
+    """Generate and synchronise host maps, see the module documentation."""
+    parser = argparse.ArgumentParser(
+        description="Route domains to backends with a map file.")
+    subparsers = parser.add_subparsers(dest='action')
+    subparsers.required = True
+
+    generate = subparsers.add_parser(
+        'generate', help="Generate a map file from domain ACLs.")
+    generate.add_argument('--haproxy-config', action='append', required=True)
+    generate.add_argument('--map', required=True)
+    generate.add_argument('--default-backend')
+    generate.set_defaults(function=_generate)
+
+    sync = subparsers.add_parser(
+        'sync', help="Add domains to a map and the running HAProxy.")
+    sync.add_argument('--map', required=True)
+    sync.add_argument(
+        '--domain', action='append', default=[],
+        help="Domain to add, defaults to $RENEWED_DOMAINS.")
+    sync.add_argument('--default-backend', required=True,
+                      help="Backend to route new domains to.")
+    sync.add_argument('--socket', default=runtime.DEFAULT_ADDRESS,
+                      help="Runtime API address (default: %(default)s).")
+    sync.add_argument('--no-runtime', action='store_true',
+                      help="Only update the map file.")
+    sync.set_defaults(function=_sync)
+
+    args = parser.parse_args(cli_args)
+    logging.basicConfig(level=logging.INFO)
+    return args.function(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,255 @@
+"""Profiles of the HAProxy instances on a host.
+
+`certbot_haproxy.constants` assumes one HAProxy per host. Hosts that run
+several instances, e.g. one per tenant, describe them in an INI file with a
+section per instance::
+
+    [DEFAULT]
+    conftest_cmd = /usr/sbin/haproxy -c -f
+    timeout = 30
+
+    [tenant-a]
+    haproxy_config = /etc/haproxy/tenant-a.cfg
+    crt_directory = /etc/haproxy/tenant-a/certs
+    restart_cmd = sudo systemctl reload haproxy@tenant-a
+
+    [tenant-b]
+    haproxy_config = /etc/haproxy/tenant-b.cfg
+    crt_directory = /etc/haproxy/tenant-b/certs
+    restart_cmd = sudo systemctl reload haproxy@tenant-b
+
+Settings that an instance does not define are taken from the ``DEFAULT``
+section and then from `certbot_haproxy.constants`. The file is read from the
+``instances_config`` constant, or from the path given to
+``certbot-haproxy-deploy --instances``, which deploys to all instances in one
+run (see `certbot_haproxy.deploy`).
+
+The configuration tests and restarts of the instances are run concurrently
+with asyncio subprocesses, each command is killed when it takes longer than
+the ``timeout`` of its instance.
+
+.. note:: Running commands concurrently needs Python 3.5 or newer.
+"""
+import asyncio
+import collections
+import configparser
+import logging
+import os
+import shlex
+import signal
+import time
+
+from certbot import errors
+
+from certbot_haproxy import constants
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Seconds a configuration test or restart may take by default.
+DEFAULT_TIMEOUT = 60.0
+
+#: Number of instances that are reloaded at the same time by default.
+DEFAULT_CONCURRENCY = 8
+
+SETTINGS = ('haproxy_config', 'crt_directory', 'conftest_cmd', 'restart_cmd')
+
+Instance = collections.namedtuple(
+    'Instance',
+    'name haproxy_config crt_directory conftest_cmd restart_cmd timeout'
+)
+Instance.__doc__ = """
+    A HAProxy instance to deploy to.
+
+    :ivar str name: Name of the instance.
+    :ivar str haproxy_config: Path of its configuration.
+    :ivar str crt_directory: Its certificate directory.
+    :ivar list conftest_cmd: Configuration test command, the configuration
+        path is appended.
+    :ivar list restart_cmd: Restart (or reload) command.
+    :ivar float timeout: Seconds each command may take.
+"""
+
+CommandResult = collections.namedtuple(
+    'CommandResult', 'command returncode output duration'
+)
+CommandResult.__doc__ = """
+    Outcome of a command.
+
+    :ivar list command: Command and arguments.
+    :ivar int returncode: Exit status, `None` when the command timed out.
+    :ivar str output: Combined standard output and error.
+    :ivar float duration: Seconds the command took.
+"""
+
+
+def default_instance(name='haproxy'):
+    """
+        The single instance described by `certbot_haproxy.constants`.
+
+        :param str name: Name to give the instance.
+        :rtype: `Instance`
+    """
+    return Instance(name, *(
+        [constants.os_constant(setting) for setting in SETTINGS] +
+        [DEFAULT_TIMEOUT]))
+
+
+def _command(value):
+    """Split a command from the configuration file."""
+    if isinstance(value, (list, tuple)):
+        return list(value)
+    return shlex.split(value)
+
+
+def read_instances(path, defaults=None):
+    """
+        Read instance profiles.
+
+        :param str path: Path of the INI file.
+        :param dict defaults: Settings for instances that do not define them,
+            taken from `certbot_haproxy.constants` when not given.
+        :returns: The instances in the order of the file.
+        :rtype: list of `Instance`
+        :raises errors.PluginError: When the file cannot be read or an
+            instance is incomplete.
+    """
+    parser = configparser.RawConfigParser()
+    try:
+        with open(path) as config:
+            parser.read_file(config)
+    except (IOError, OSError, configparser.Error) as error:
+        raise errors.PluginError(
+            "Cannot read instance profiles %s: %s" % (path, error))
+    if defaults is None:
+        defaults = {}
+        for setting in SETTINGS:
+            try:
+                defaults[setting] = constants.os_constant(setting)
+            except errors.Error:
+                break
+
+    instances = []
+    for name in parser.sections():
+        settings = dict(defaults)
+        settings.update(parser.items(name))
+        missing = [setting for setting in SETTINGS if not settings.get(setting)]
+        if missing:
+            raise errors.PluginError(
+                "Instance %s in %s has no %s" % (name, path, ", ".join(missing)))
+        try:
+            timeout = float(settings.get('timeout', DEFAULT_TIMEOUT))
+        except ValueError:
+            raise errors.PluginError(
+                "Instance %s in %s has an invalid timeout" % (name, path))
+        instances.append(Instance(
+            name,
+            settings['haproxy_config'],
+            settings['crt_directory'],
+            _command(settings['conftest_cmd']),
+            _command(settings['restart_cmd']),
+            timeout,
+        ))
+    if not instances:
+        raise errors.PluginError("No instances defined in %s" % path)
+    return instances
+
+
+async def run_command(command, timeout):
+    """
+        Run a command in a subprocess, killing it when it takes too long.
+
+        The command runs in a session of its own, so the processes it starts
+        are killed along with it.
+
+        :param list command: Command and arguments.
+        :param float timeout: Seconds the command may take.
+        :rtype: `CommandResult`
+    """
+    start = time.time()
+    logger.debug("Running %s", command)
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command, stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.STDOUT, start_new_session=True)
+    except OSError as error:
+        return CommandResult(command, 127, str(error), time.time() - start)
+    try:
+        output, _ = await asyncio.wait_for(process.communicate(), timeout)
+    except asyncio.TimeoutError:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+        await process.wait()
+        return CommandResult(command, None, "timed out after %gs" % timeout,
+                             time.time() - start)
+    return CommandResult(command, process.returncode,
+                         output.decode('utf-8', 'replace'),
+                         time.time() - start)
+
+
+async def reload_instance(instance):
+    """
+        Test the configuration of an instance and restart it.
+
+        :param instance: The instance.
+        :type instance: `Instance`
+        :returns: Why the reload failed, `None` if it succeeded.
+        :rtype: str
+    """
+    steps = (
+        ("configuration test",
+         list(instance.conftest_cmd) + [instance.haproxy_config]),
+        ("restart", list(instance.restart_cmd)),
+    )
+    for label, command in steps:
+        result = await run_command(command, instance.timeout)
+        if result.returncode is None:
+            return "The %s of %s timed out after %gs" % (
+                label, instance.name, instance.timeout)
+        if result.returncode != 0:
+            return "The %s of %s failed with status %d: %s" % (
+                label, instance.name, result.returncode,
+                result.output.strip())
+        logger.debug("The %s of %s took %.2fs", label, instance.name,
+                     result.duration)
+    return None
+
+
+async def reload_all(instances, concurrency=DEFAULT_CONCURRENCY):
+    """
+        Reload instances concurrently.
+
+        :param list instances: The instances.
+        :param int concurrency: Number of instances to reload at once.
+        :returns: Why the reload failed per instance, in the order of
+            `instances`, `None` for the ones that succeeded.
+        :rtype: list
+    """
+    slots = asyncio.Semaphore(concurrency)
+
+    async def reload_bounded(instance):
+        """Reload one instance when a slot is free."""
+        async with slots:
+            return await reload_instance(instance)
+
+    return await asyncio.gather(*[reload_bounded(instance)
+                                  for instance in instances])
+
+
+def reload_instances(instances, concurrency=DEFAULT_CONCURRENCY):
+    """
+        Reload instances concurrently from synchronous code.
+
+        :param list instances: The instances.
+        :param int concurrency: Number of instances to reload at once.
+        :returns: See `reload_all`.
+        :rtype: list
+    """
+    if not instances:
+        return []
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(reload_all(instances, concurrency))
+    finally:
+        loop.close()
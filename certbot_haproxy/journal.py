@@ -0,0 +1,206 @@
+"""Write-ahead journal of deploy runs.
+
+A deploy (see `certbot_haproxy.deploy`) that is interrupted, by a crash, a
+reboot or a failing configuration test, can leave certificates committed to
+the `crt_directory` that HAProxy has not loaded yet. Once a certificate is in
+place the next run considers it unchanged, so without a record of the
+interrupted run HAProxy would never be reloaded for it.
+
+The journal is a file of JSON records, one per line, that describe the steps
+of a run:
+
+  - ``begin``: a run started;
+  - ``stage``: the combined PEM of a lineage was written to the staging
+    directory, with its digest;
+  - ``commit``: a staged PEM is about to be moved into the `crt_directory`.
+    These records are synced *before* the files are moved, so a crash after
+    the move cannot lose them;
+  - ``remove``: a PEM file that is superseded by the committed ones is about
+    to be removed from the `crt_directory`;
+  - ``reload``: HAProxy is about to be reloaded;
+  - ``done``: the run completed, after which the journal is truncated.
+
+Records are buffered and written with a single ``fsync`` per batch instead
+of one per record. When a run does not end with ``done``, `recover` returns
+what it did, so the next run can resume: staged files that are still intact
+are not written again and committed certificates are reloaded, even when
+nothing changed since.
+"""
+import collections
+import json
+import logging
+import os
+import time
+from builtins import object
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Number of records that are buffered before they are synced.
+DEFAULT_BATCH_SIZE = 64
+
+STEPS = ('begin', 'stage', 'commit', 'remove', 'reload', 'done')
+
+InterruptedRun = collections.namedtuple(
+    'InterruptedRun', 'run_id staged committed reload_started'
+)
+InterruptedRun.__doc__ = """
+    What an interrupted run did before it stopped.
+
+    :ivar str run_id: Identifier of the run.
+    :ivar dict staged: Digests of the staged PEM files by name.
+    :ivar dict committed: Digests of the PEM files that were (about to be)
+        committed by name, superseded files that were removed have no
+        digest.
+    :ivar bool reload_started: Whether the run started reloading HAProxy.
+"""
+
+
+def _encode(records):
+    """Serialise records to journal lines."""
+    return b''.join(
+        json.dumps(record, sort_keys=True).encode('utf-8') + b'\n'
+        for record in records)
+
+
+def read_records(path):
+    """
+        Read the records of a journal.
+
+        A record that was only partially written when the writer crashed ends
+        the journal, it and anything after it is ignored.
+
+        :param str path: Path of the journal.
+        :returns: The records, empty if the journal does not exist.
+        :rtype: list of dict
+    """
+    records = []
+    try:
+        with open(path, 'rb') as journal:
+            for line in journal:
+                try:
+                    record = json.loads(line.decode('utf-8'))
+                except ValueError:
+                    logger.warning("Ignoring the torn end of journal %s", path)
+                    break
+                if not isinstance(record, dict) or \
+                        record.get('step') not in STEPS:
+                    logger.warning("Ignoring the corrupt end of journal %s",
+                                   path)
+                    break
+                records.append(record)
+    except (IOError, OSError):
+        pass
+    return records
+
+
+def recover(path):
+    """
+        Find the last run in a journal that did not complete.
+
+        :param str path: Path of the journal.
+        :returns: What the run did, `None` if the last run completed.
+        :rtype: `InterruptedRun`
+    """
+    run = None
+    for record in read_records(path):
+        step = record['step']
+        if step == 'begin':
+            # A resumed run begins again with the same identifier and
+            # keeps what it did before.
+            if run is None or run.run_id != record.get('run'):
+                run = InterruptedRun(record.get('run'), {}, {}, False)
+        elif run is None:
+            continue
+        elif step == 'stage':
+            run.staged[record['name']] = record.get('digest')
+        elif step in ('commit', 'remove'):
+            run.committed[record['name']] = record.get('digest')
+        elif step == 'reload':
+            run = run._replace(reload_started=True)
+        elif step == 'done':
+            run = None
+    return run
+
+
+class Journal(object):
+    """
+        Append-only journal of a deploy run with batched syncs.
+
+        :param str path: Path of the journal file.
+        :param int batch_size: Number of records to buffer before they are
+            written and synced.
+    """
+
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE):
+        self.path = path
+        self.batch_size = batch_size
+        self.run_id = None
+        self.syncs = 0
+        self._pending = []
+
+    def begin(self, run_id=None):
+        """
+            Start (or resume) a run.
+
+            :param str run_id: Identifier of an interrupted run to resume,
+                a new one is generated when not given.
+        """
+        self._repair()
+        self.run_id = run_id or '%d-%d' % (time.time(), os.getpid())
+        self.record('begin')
+        self.sync()
+
+    def _repair(self):
+        """Cut off a torn end, so appended records can be read back."""
+        try:
+            with open(self.path, 'rb') as journal:
+                data = journal.read()
+        except (IOError, OSError):
+            return
+        intact = _encode(read_records(self.path))
+        if data != intact:
+            temp_path = self.path + '.tmp'
+            with open(temp_path, 'wb') as journal:
+                journal.write(intact)
+                journal.flush()
+                os.fsync(journal.fileno())
+            os.rename(temp_path, self.path)
+
+    def record(self, step, name=None, digest=None):
+        """
+            Add a record, it is written when the batch is full or on `sync`.
+
+            :param str step: One of `STEPS`.
+            :param str name: Name of the PEM file the step is about.
+            :param str digest: Digest of the PEM file.
+        """
+        assert step in STEPS
+        record = {'step': step, 'run': self.run_id}
+        if name is not None:
+            record['name'] = name
+        if digest is not None:
+            record['digest'] = digest
+        self._pending.append(record)
+        if len(self._pending) >= self.batch_size:
+            self.sync()
+
+    def sync(self):
+        """Write the buffered records and flush them to disk."""
+        if not self._pending:
+            return
+        data = _encode(self._pending)
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o640)
+        try:
+            os.write(fd, data)
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        self._pending = []
+        self.syncs += 1
+
+    def complete(self):
+        """Mark the run as completed and truncate the journal."""
+        self.record('done')
+        self.sync()
+        with open(self.path, 'wb'):
+            pass
@@ -0,0 +1,301 @@
+"""Integrity checks of combined PEM files.
+
+HAProxy refuses to start, and `conftest_cmd` fails, when a single file in the
+`crt_directory` is broken. The checks in this module find such files before
+they are put in place, so they can be held back individually:
+
+  - every ``BEGIN`` marker has its ``END`` marker and the base64 data decodes
+    (the file is not truncated);
+  - there is exactly one private key and it matches the first certificate;
+  - every certificate is issued by the one following it (the chain is in
+    order) and, unless the first certificate is self-signed, there is at least
+    one intermediate. When a CA file is given, the chain is also verified
+    against it;
+  - the certificate has not expired.
+
+`check_files` runs the checks in a process pool and caches positive results
+by content digest and CA file, so unchanged files are not checked again. A
+file that passed without a CA file is checked again when one is given.
+"""
+import base64
+import binascii
+import calendar
+import collections
+import hashlib
+import json
+import logging
+import os
+import re
+import time
+from builtins import object
+from concurrent import futures
+
+from OpenSSL import crypto
+
+from certbot_haproxy import util
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+RE_PEM_BLOCK = re.compile(
+    br'-----BEGIN (?P<label>[A-Z0-9 ]+)-----\r?\n'
+    br'(?P<body>.*?)'
+    br'-----END (?P=label)-----',
+    re.DOTALL
+)
+
+KEY_LABELS = (b'PRIVATE KEY', b'RSA PRIVATE KEY', b'EC PRIVATE KEY')
+
+CheckResult = collections.namedtuple(
+    'CheckResult', 'path digest problems expires'
+)
+CheckResult.__doc__ = """
+    Result of checking one file.
+
+    :ivar str path: Path of the file.
+    :ivar str digest: SHA-256 hex digest of the contents.
+    :ivar list problems: Descriptions of the problems found, empty if the file
+        is fine.
+    :ivar float expires: Epoch time at which the certificate expires, `None`
+        if it could not be determined.
+"""
+
+
+def digest(data):
+    """SHA-256 hex digest of `data`."""
+    return hashlib.sha256(data).hexdigest()
+
+
+def ca_digest(ca_file):
+    """
+        Digest of the path and the contents of a CA file.
+
+        :param str ca_file: The CA file, or `None`.
+        :returns: The digest, `None` without a CA file.
+        :rtype: str
+        :raises IOError: When the CA file cannot be read.
+    """
+    if ca_file is None:
+        return None
+    with open(ca_file, 'rb') as roots:
+        return digest(b'\0'.join([
+            os.path.abspath(ca_file).encode('utf-8'), roots.read()]))
+
+
+def cache_key(content_digest, ca_file_digest=None):
+    """
+        Key of a check result in a `CheckCache`.
+
+        :param str content_digest: Digest of the checked file.
+        :param str ca_file_digest: `ca_digest` of the CA file the chain was
+            verified against.
+        :returns: The content digest, combined with the CA file digest if
+            there is one.
+        :rtype: str
+    """
+    if ca_file_digest is None:
+        return content_digest
+    return '%s:%s' % (content_digest, ca_file_digest)
+
+
+def _blocks(data, problems):
+    """Split PEM data in (label, der) tuples, reporting malformed blocks."""
+    blocks = []
+    for match in RE_PEM_BLOCK.finditer(data):
+        try:
+            der = base64.b64decode(b''.join(match.group('body').split()))
+        except (binascii.Error, TypeError, ValueError):
+            problems.append("corrupt base64 in %s block"
+                            % match.group('label').decode('ascii'))
+            continue
+        blocks.append((match.group('label'), der))
+    begins = data.count(b'-----BEGIN ')
+    if begins != len(RE_PEM_BLOCK.findall(data)):
+        problems.append("unterminated PEM block, the file may be truncated")
+    return blocks
+
+
+def check_pem(data, ca_file=None):
+    """
+        Check the contents of a combined PEM file.
+
+        :param bytes data: Contents of the file.
+        :param str ca_file: Optional PEM file with trusted roots to verify the
+            chain against.
+        :returns: Descriptions of the problems found, empty if the file is
+            fine.
+        :rtype: list
+    """
+    return _check(data, ca_file)[0]
+
+
+def _check(data, ca_file):
+    """Check PEM data, returns the problems and the leaf certificate."""
+    problems = []
+    blocks = _blocks(data, problems)
+    keys = [der for label, der in blocks if label in KEY_LABELS]
+    certs = []
+    for label, der in blocks:
+        if label != b'CERTIFICATE':
+            continue
+        try:
+            certs.append(crypto.load_certificate(crypto.FILETYPE_ASN1, der))
+        except crypto.Error:
+            problems.append("unparsable certificate #%d" % (len(certs) + 1))
+            return problems, None
+
+    if len(keys) != 1:
+        problems.append("expected 1 private key, found %d" % len(keys))
+    if not certs:
+        problems.append("no certificate found")
+    if problems:
+        return problems, (certs[0] if certs else None)
+
+    try:
+        key = crypto.load_privatekey(crypto.FILETYPE_ASN1, keys[0])
+    except crypto.Error:
+        return problems + ["unparsable private key"], certs[0]
+
+    leaf = certs[0]
+    if crypto.dump_publickey(crypto.FILETYPE_ASN1, leaf.get_pubkey()) != \
+            crypto.dump_publickey(crypto.FILETYPE_ASN1, key):
+        problems.append("private key does not match the certificate")
+
+    for index, (cert, issuer) in enumerate(zip(certs, certs[1:]), 1):
+        if cert.get_issuer() != issuer.get_subject():
+            problems.append(
+                "certificate #%d is not issued by certificate #%d, the chain"
+                " is out of order" % (index, index + 1))
+    if len(certs) == 1 and leaf.get_issuer() != leaf.get_subject():
+        problems.append("the chain is missing, only the certificate found")
+
+    if ca_file and not problems:
+        store = crypto.X509Store()
+        store.load_locations(ca_file)
+        try:
+            crypto.X509StoreContext(store, leaf, chain=certs[1:]) \
+                .verify_certificate()
+        except crypto.X509StoreContextError as error:
+            problems.append("chain does not verify: %s" % error)
+
+    if leaf.has_expired():
+        problems.append("the certificate has expired")
+    return problems, leaf
+
+
+def check_file(path, ca_file=None):
+    """
+        Check a combined PEM file.
+
+        :param str path: Path of the file.
+        :param str ca_file: Optional PEM file with trusted roots.
+        :rtype: `CheckResult`
+    """
+    try:
+        with open(path, 'rb') as pem:
+            data = pem.read()
+    except (IOError, OSError) as error:
+        return CheckResult(path, None, ["unreadable: %s" % error], None)
+    problems, leaf = _check(data, ca_file)
+    expires = None
+    if leaf is not None:
+        expires = calendar.timegm(
+            util.certificate_not_after(leaf).utctimetuple())
+    return CheckResult(path, digest(data), problems, expires)
+
+
+def _check_files_chunk(paths, ca_file):
+    """Check a chunk of files in a worker process."""
+    return [check_file(path, ca_file) for path in paths]
+
+
+class CheckCache(object):
+    """
+        Positive check results by `cache_key`, persisted as JSON.
+
+        Entries expire at the notAfter time of the checked certificate, a
+        file that passed before is otherwise known to pass again.
+
+        :param str path: Path of the cache file, `None` for an in-memory cache.
+    """
+    def __init__(self, path=None):
+        self.path = path
+        self.entries = {}
+        if path and os.path.exists(path):
+            try:
+                with open(path) as cache:
+                    self.entries = json.load(cache)
+            except ValueError:
+                logger.warning("Ignoring corrupt cache %s", path)
+
+    def __contains__(self, key):
+        expires = self.entries.get(key)
+        return expires is not None and expires > time.time()
+
+    def add(self, key, expires):
+        """Remember that the file and CA file of `key` passed all checks."""
+        self.entries[key] = expires
+
+    def save(self):
+        """Write the cache, dropping expired entries."""
+        if not self.path:
+            return
+        now = time.time()
+        entries = {key: expires for key, expires in self.entries.items()
+                   if expires > now}
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as cache:
+            json.dump(entries, cache)
+        os.rename(temp_path, self.path)
+
+
+def check_files(paths, ca_file=None, cache=None, workers=None, chunk_size=64):
+    """
+        Check many combined PEM files in a process pool.
+
+        Files whose contents passed before according to `cache` are not
+        checked again. A problem with one file does not affect the others.
+
+        :param list paths: Paths of the files to check.
+        :param str ca_file: Optional PEM file with trusted roots.
+        :param cache: Optional cache of positive results, updated in place.
+        :type cache: `CheckCache`
+        :param int workers: Number of worker processes, defaults to the number
+            of CPUs.
+        :param int chunk_size: Number of files a worker checks per task.
+        :returns: Results in the order of `paths`.
+        :rtype: list of `CheckResult`
+    """
+    results = {}
+    pending = []
+    ca_file_digest = ca_digest(ca_file) if cache is not None else None
+    for path in paths:
+        if cache is not None:
+            try:
+                with open(path, 'rb') as pem:
+                    content_digest = digest(pem.read())
+            except (IOError, OSError):
+                content_digest = None
+            if content_digest is not None:
+                key = cache_key(content_digest, ca_file_digest)
+                if key in cache:
+                    results[path] = CheckResult(
+                        path, content_digest, [], cache.entries[key])
+                    continue
+        pending.append(path)
+
+    chunks = [pending[index:index + chunk_size]
+              for index in range(0, len(pending), chunk_size)]
+    if len(chunks) == 1 or workers == 1:
+        checked = [_check_files_chunk(chunk, ca_file) for chunk in chunks]
+    else:
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            checked = list(executor.map(
+                _check_files_chunk, chunks, [ca_file] * len(chunks)))
+
+    for chunk in checked:
+        for result in chunk:
+            results[result.path] = result
+            if cache is not None and not result.problems:
+                cache.add(cache_key(result.digest, ca_file_digest),
+                          result.expires)
+    return [results[path] for path in paths]
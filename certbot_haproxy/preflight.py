@@ -0,0 +1,153 @@
+"""Pre-flight check of challenge routing.
+
+When the ``is_certbot`` ACL or the ``backend certbot`` of a frontend is
+configured incorrectly, the certificate authority fails the validation of the
+affected domains, which costs a round trip and counts against its rate limits.
+
+Before anything is ordered, the `.HAProxyAuthenticator` can publish a canary
+token and request it for every domain through the local HAProxy, with the
+domain in the `Host` header, the same way the certificate authority will.
+Domains for which the canary is not served are not routed to the plugin.
+"""
+import base64
+import collections
+import logging
+import os
+import socket
+import time
+from concurrent import futures
+from http import client as http_client
+
+from certbot_haproxy.tokenstore import HTTP01_PATH_PREFIX
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Default address of the local HAProxy http frontend.
+DEFAULT_ADDRESS = '127.0.0.1:80'
+
+#: Seconds a domain may take to serve the canary, HAProxy's health check may
+#: need some time to notice the responder came up.
+DEFAULT_TIMEOUT = 5.0
+
+#: Maximum number of concurrent probes.
+DEFAULT_WORKERS = 32
+
+ProbeResult = collections.namedtuple('ProbeResult', 'domain ok status error')
+ProbeResult.__doc__ = """
+    Result of probing a single domain.
+
+    :ivar str domain: The domain.
+    :ivar bool ok: Whether the canary was served correctly.
+    :ivar int status: HTTP status of the last attempt, `None` if no response
+        was received.
+    :ivar str error: Description of what went wrong, `None` if `ok`.
+"""
+
+
+def parse_address(address):
+    """
+        Split a ``host:port`` address.
+
+        :param str address: Address, the port defaults to 80.
+        :rtype: tuple
+    """
+    host, _, port = address.rpartition(':')
+    if not host:
+        return (address, 80)
+    return (host.strip('[]'), int(port))
+
+
+def generate_canary():
+    """
+        Generate a random canary token and the body it should be answered with.
+
+        :returns: (token, body)
+        :rtype: tuple
+    """
+    def _random():
+        return base64.urlsafe_b64encode(os.urandom(24)).decode('ascii')
+    return _random(), _random()
+
+
+def probe(domain, token, expected, address=DEFAULT_ADDRESS,
+          timeout=DEFAULT_TIMEOUT):
+    """
+        Request the canary for a domain through HAProxy.
+
+        The request is retried until `timeout` passes for as long as HAProxy
+        answers with a `503`, which it does until its health check notices the
+        responder is up.
+
+        :param str domain: Domain to put in the `Host` header.
+        :param str token: Canary token.
+        :param bytes expected: Canary body.
+        :param str address: Address of the HAProxy http frontend.
+        :param float timeout: Seconds to keep trying.
+        :rtype: `ProbeResult`
+    """
+    host, port = parse_address(address)
+    path = HTTP01_PATH_PREFIX + token
+    deadline = time.time() + timeout
+    while True:
+        status = None
+        connection = http_client.HTTPConnection(
+            host, port, timeout=max(deadline - time.time(), 0.1))
+        try:
+            connection.request('GET', path, headers={'Host': domain})
+            response = connection.getresponse()
+            status = response.status
+            body = response.read()
+        except (socket.error, http_client.HTTPException) as error:
+            return ProbeResult(domain, False, None, str(error))
+        finally:
+            connection.close()
+
+        if status == http_client.OK and body.strip() == expected:
+            return ProbeResult(domain, True, status, None)
+        if status != http_client.SERVICE_UNAVAILABLE \
+                or time.time() + 0.25 >= deadline:
+            break
+        time.sleep(0.25)
+
+    if status == http_client.OK:
+        error = "served a different response than the canary"
+    else:
+        error = "answered with HTTP status %d" % status
+    return ProbeResult(domain, False, status, error)
+
+
+def check_routing(domains, tokens, address=DEFAULT_ADDRESS,
+                  timeout=DEFAULT_TIMEOUT, workers=DEFAULT_WORKERS):
+    """
+        Publish a canary token and probe all domains concurrently.
+
+        The responder serving `tokens` should be running and reachable through
+        HAProxy at `address`.
+
+        :param list domains: Domains to check.
+        :param tokens: Token store the responder serves from.
+        :type tokens: `.TokenStore`
+        :param str address: Address of the HAProxy http frontend.
+        :param float timeout: Seconds each probe may take.
+        :param int workers: Maximum number of concurrent probes.
+        :returns: Results in the order of `domains`.
+        :rtype: list of `ProbeResult`
+    """
+    token, body = generate_canary()
+    tokens.add(token, body, ttl=timeout * 2 + 60)
+    try:
+        with futures.ThreadPoolExecutor(
+                max_workers=max(1, min(workers, len(domains)))) as executor:
+            results = list(executor.map(
+                lambda domain: probe(domain, token, body.encode('ascii'),
+                                     address, timeout),
+                domains
+            ))
+    finally:
+        tokens.discard(token)
+    for result in results:
+        if not result.ok:
+            logger.warning(
+                "Challenges for %s are not routed to this plugin by HAProxy"
+                " at %s: %s", result.domain, address, result.error)
+    return results
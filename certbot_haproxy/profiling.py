@@ -0,0 +1,180 @@
+"""Opt-in CPU and memory profiling.
+
+The authenticator's `perform` and `cleanup`, the deploy step and the helpers
+in `certbot_haproxy.constants` and `certbot_haproxy.util` are decorated with
+`profiled`. Profiling is off unless a directory to write the reports to is
+configured, either with the authenticator's ``haproxy-profile-dir`` option or
+with environment variables, which also works for `certbot-haproxy-deploy`:
+
+    .. envvar:: CERTBOT_HAPROXY_PROFILE_DIR
+
+        Directory to write the reports to, enables profiling.
+
+    .. envvar:: CERTBOT_HAPROXY_PROFILE_RATE
+
+        Fraction of the runs to profile (default: 1). The decision is taken
+        once per process, so a run is either profiled completely or not at
+        all. A low rate makes it possible to leave profiling on in production.
+
+    .. envvar:: CERTBOT_HAPROXY_PROFILE_TOP
+
+        Number of allocation sites per report (default: 25).
+
+For every profiled call two files are written, prefixed with a run id
+(``<timestamp>-<pid>``), a sequence number and the name of the call:
+
+  - ``.pstats``: a `cProfile` dump, read it with ``python -m pstats <file>``;
+  - ``.alloc.txt``: the duration, the peak of traced memory and the lines that
+    allocated the most memory during the call, measured with `tracemalloc`.
+
+Calls made while another profiled call is running are part of the outer
+call's report.
+"""
+import cProfile
+import functools
+import logging
+import os
+import random
+import threading
+import time
+import tracemalloc
+from builtins import object
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+ENV_DIR = 'CERTBOT_HAPROXY_PROFILE_DIR'
+ENV_RATE = 'CERTBOT_HAPROXY_PROFILE_RATE'
+ENV_TOP = 'CERTBOT_HAPROXY_PROFILE_TOP'
+
+
+class _Settings(object):  # pylint:disable=too-few-public-methods
+    """Profiling settings and the sampling decision of this process."""
+
+    def __init__(self):
+        self.directory = None
+        self.rate = None
+        self.sampled = None
+        self.run_id = None
+        self.sequence = 0
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+
+_settings = _Settings()  # pylint:disable=invalid-name
+
+
+def configure(directory=None, rate=None):
+    """
+        Configure profiling, overriding the environment variables.
+
+        Arguments that are `None` are left as they are. The sampling decision
+        is taken again on the next profiled call.
+
+        :param str directory: Directory to write the reports to.
+        :param float rate: Fraction of the runs to profile.
+    """
+    with _settings.lock:
+        if directory is not None:
+            _settings.directory = directory
+        if rate is not None:
+            _settings.rate = rate
+        _settings.sampled = None
+
+
+def active():
+    """
+        Whether this run is profiled.
+
+        :rtype: bool
+    """
+    if _settings.sampled is not None:
+        return _settings.sampled
+    with _settings.lock:
+        directory = _settings.directory or os.environ.get(ENV_DIR)
+        rate = _settings.rate
+        if rate is None:
+            try:
+                rate = float(os.environ.get(ENV_RATE, 1))
+            except ValueError:
+                logger.warning("Ignoring invalid %s", ENV_RATE)
+                rate = 1.0
+        sampled = bool(directory) and random.random() < rate
+        if sampled:
+            _settings.directory = directory
+            _settings.run_id = '%s-%d' % (
+                time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+            logger.info("Writing profiles of this run to %s", directory)
+        _settings.sampled = sampled
+    return sampled
+
+
+def _report_path(name, extension):
+    """Path of a new report file."""
+    with _settings.lock:
+        _settings.sequence += 1
+        sequence = _settings.sequence
+    if not os.path.isdir(_settings.directory):
+        os.makedirs(_settings.directory)
+    return os.path.join(_settings.directory, '%s-%03d-%s.%s' % (
+        _settings.run_id, sequence, name, extension))
+
+
+def _write_reports(name, profile, before, after, duration, peak):
+    """Write the pstats dump and the allocation report of a call."""
+    try:
+        top = int(os.environ.get(ENV_TOP, 25))
+    except ValueError:
+        top = 25
+    stats_path = _report_path(name, 'pstats')
+    profile.dump_stats(stats_path)
+    lines = [
+        "%s: %.3f s, peak traced memory %.1f KiB" % (
+            name, duration, peak / 1024.0),
+        "Top %d allocation sites during the call:" % top,
+    ]
+    for stat in after.compare_to(before, 'lineno')[:top]:
+        lines.append(str(stat))
+    with open(stats_path[:-len('pstats')] + 'alloc.txt', 'w') as report:
+        report.write('\n'.join(lines) + '\n')
+
+
+def _call_profiled(name, function, args, kwargs):
+    """Call a function under cProfile and tracemalloc."""
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    if hasattr(tracemalloc, 'reset_peak'):  # Python 3.9+
+        tracemalloc.reset_peak()
+    before = tracemalloc.take_snapshot()
+    profile = cProfile.Profile()
+    _settings.local.depth = 1
+    start = time.time()
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        duration = time.time() - start
+        _settings.local.depth = 0
+        after = tracemalloc.take_snapshot()
+        peak = tracemalloc.get_traced_memory()[1]
+        if started_tracing:
+            tracemalloc.stop()
+        try:
+            _write_reports(name, profile, before, after, duration, peak)
+        except (IOError, OSError) as error:
+            logger.warning("Could not write profile of %s: %s", name, error)
+
+
+def profiled(name):
+    """
+        Decorate a function to be profiled when profiling is active.
+
+        :param str name: Name of the function in report file names.
+    """
+    def decorator(function):  # pylint:disable=missing-docstring
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):  # pylint:disable=missing-docstring
+            if getattr(_settings.local, 'depth', 0) or not active():
+                return function(*args, **kwargs)
+            return _call_profiled(name, function, args, kwargs)
+        return wrapper
+    return decorator
@@ -0,0 +1,460 @@
+"""Renewal spreading planner.
+
+Certificates that were issued in a few bulk waves come due together. Certbot
+renews a certificate on its first run after it entered the renewal window, so
+every wave returns as one night with a huge batch of validations, PEM writes
+and HAProxy reloads, 60 days after it was issued.
+
+This module assigns every lineage a renewal slot (an hour by default) so that
+no slot holds more than ``--budget`` renewals. A lineage is renewed in the
+last slot with room before its deadline, which is ``--renew-before-days``
+before it expires, like certbot's ``renew_before_expiry``. Renewing early, at
+most ``--max-early-days`` before the deadline, is what spreads a wave out;
+lineages are renewed no earlier than needed to stay within the budget.
+Lineages that do not fit in that window, because they are already overdue or
+because the budget is too small for a wave, are put in the first slots with
+room after now. That is earlier than ``--max-early-days`` when there is room,
+otherwise it is after their deadline and they are reported as ``late``.
+
+The schedule is read from the ``cert.pem`` of the lineages in certbot's live
+directory and written as JSON, one entry per lineage with its slot, or as
+``<slot> <lineage>`` lines::
+
+    certbot-haproxy-plan-renewal --live-dir /etc/letsencrypt/live \\
+        --budget 20 --output /var/lib/certbot-haproxy/renewals.json
+
+An hourly timer renews the lineages whose slot has come and deploys them at
+once::
+
+    for name in $(certbot-haproxy-plan-renewal --live-dir \\
+            /etc/letsencrypt/live --due /var/lib/certbot-haproxy/renewals.json)
+    do
+        certbot renew --cert-name "$name" --force-renewal
+    done
+    certbot-haproxy-deploy --live-dir /etc/letsencrypt/live
+
+``--due`` only lists lineages that still hold the certificate the schedule
+was made for, a lineage that was renewed in the meantime is skipped. Make a
+new schedule daily, or after certificates were added.
+
+Next to the schedule the planner prints a simulation of the load: renewals and
+reloads per slot, and an estimate of the CPU time of the busiest slot, for the
+schedule and for certbot's own behaviour of renewing everything that is due
+on its nightly run.
+
+.. note:: The CPU estimates are based on the per-renewal and per-reload costs
+    passed on the command line, the defaults are rough figures and should be
+    calibrated for your own setup, e.g. with `certbot_haproxy.profiling`.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import heapq
+import json
+import logging
+import os
+import sys
+
+from certbot_haproxy import sanplanner
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Days before expiry a certificate has to be renewed, certbot's default.
+DEFAULT_RENEW_BEFORE_DAYS = 30
+
+#: Days a renewal may be brought forward to spread the load.
+DEFAULT_MAX_EARLY_DAYS = 30
+
+#: Default maximum number of renewals per slot.
+DEFAULT_BUDGET = 20
+
+#: Default length of a slot in seconds.
+DEFAULT_SLOT_SECONDS = 3600
+
+#: Hour (UTC) at which certbot runs in the simulation of its own behaviour.
+DEFAULT_RUN_HOUR = 2
+
+#: Default estimate of the CPU time of one renewal: the key, the validation,
+#: the PEM check and write (seconds).
+DEFAULT_RENEWAL_CPU_SECONDS = 0.5
+
+#: Default estimate of the CPU time of one HAProxy reload (seconds).
+DEFAULT_RELOAD_CPU_SECONDS = 2.0
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+Renewal = collections.namedtuple(
+    'Renewal', 'lineage not_after deadline slot'
+)
+Renewal.__doc__ = """
+    The planned renewal of a lineage.
+
+    :ivar str lineage: Name of the lineage.
+    :ivar not_after: When its current certificate expires.
+    :vartype not_after: `datetime.datetime`
+    :ivar deadline: When it has to be renewed at the latest.
+    :vartype deadline: `datetime.datetime`
+    :ivar slot: Start of the slot it is renewed in.
+    :vartype slot: `datetime.datetime`
+"""
+
+
+def is_late(renewal):
+    """
+        Whether a renewal is planned after its deadline.
+
+        :param renewal: The renewal.
+        :type renewal: `Renewal`
+        :rtype: bool
+    """
+    return renewal.slot > renewal.deadline
+
+
+def _slot_index(moment, slot_seconds):
+    """Number of the slot a moment falls in."""
+    return int((moment - EPOCH).total_seconds() // slot_seconds)
+
+
+def _slot_start(index, slot_seconds):
+    """Start of a slot."""
+    return EPOCH + datetime.timedelta(seconds=index * slot_seconds)
+
+
+def read_expiries(live_dir):
+    """
+        Read when the certificates of certbot's lineages expire.
+
+        :param str live_dir: Certbot's ``live`` directory.
+        :returns: Expiry datetime (UTC) by lineage name.
+        :rtype: dict
+    """
+    return {
+        name: not_after for name, (_, not_after)
+        in sanplanner.read_lineages(live_dir).items()
+    }
+
+
+def plan(expiries, now=None, budget=DEFAULT_BUDGET,
+         renew_before_days=DEFAULT_RENEW_BEFORE_DAYS,
+         max_early_days=DEFAULT_MAX_EARLY_DAYS,
+         slot_seconds=DEFAULT_SLOT_SECONDS):
+    """
+        Assign every lineage a renewal slot.
+
+        Slots are filled from the last deadline backwards. Each slot takes the
+        lineages whose window closes first going backwards, i.e. the ones that
+        may be brought forward least, which places every lineage as late as
+        the budget allows.
+
+        :param dict expiries: Expiry datetime (UTC) by lineage name.
+        :param now: Time to plan from, defaults to the current time.
+        :type now: `datetime.datetime`
+        :param int budget: Maximum number of renewals per slot.
+        :param float renew_before_days: Days before expiry a certificate has
+            to be renewed.
+        :param float max_early_days: Days a renewal may be brought forward.
+        :param int slot_seconds: Length of a slot.
+        :returns: Renewals sorted by slot and lineage.
+        :rtype: list of `Renewal`
+        :raises ValueError: When the budget or the slot length is not
+            positive.
+    """
+    if budget < 1 or slot_seconds < 1:
+        raise ValueError("The budget and slot length should be positive")
+    if now is None:
+        now = datetime.datetime.utcnow()
+    first = -(-int((now - EPOCH).total_seconds()) // slot_seconds)
+    renew_before = datetime.timedelta(days=renew_before_days)
+    early = datetime.timedelta(days=max_early_days)
+
+    jobs = []
+    late = []
+    for lineage, not_after in expiries.items():
+        deadline = not_after - renew_before
+        last = _slot_index(deadline, slot_seconds)
+        earliest = max(first, _slot_index(deadline - early, slot_seconds))
+        if last < first:
+            late.append((last, lineage))
+        else:
+            jobs.append((last, earliest, lineage))
+    # Latest deadline first, the sweep below goes back in time.
+    jobs.sort(reverse=True)
+
+    usage = collections.Counter()
+    slots = {}
+    available = []
+    position = 0
+    slot = jobs[0][0] if jobs else first
+    while slot >= first and (position < len(jobs) or available):
+        if not available and jobs[position][0] < slot:
+            slot = jobs[position][0]
+        while position < len(jobs) and jobs[position][0] >= slot:
+            last, earliest, lineage = jobs[position]
+            # The lineage that may be brought forward least comes first.
+            heapq.heappush(available, (-earliest, lineage, last))
+            position += 1
+        while available and usage[slot] < budget:
+            key, lineage, last = heapq.heappop(available)
+            if -key > slot:
+                # Its window is full.
+                late.append((last, lineage))
+                continue
+            slots[lineage] = slot
+            usage[slot] += 1
+        slot -= 1
+    late.extend((last, lineage) for _, lineage, last in available)
+    late.extend((last, lineage) for last, _, lineage in jobs[position:])
+
+    slot = first
+    for last, lineage in sorted(late):
+        while usage[slot] >= budget:
+            slot += 1
+        slots[lineage] = slot
+        usage[slot] += 1
+    if late:
+        logger.warning("%d lineages do not fit in their renewal window"
+                       " within the budget", len(late))
+
+    renewals = [
+        Renewal(lineage, not_after, not_after - renew_before,
+                _slot_start(slots[lineage], slot_seconds))
+        for lineage, not_after in expiries.items()
+    ]
+    return sorted(renewals, key=lambda renewal: (renewal.slot,
+                                                 renewal.lineage))
+
+
+def certbot_times(expiries, now=None,
+                  renew_before_days=DEFAULT_RENEW_BEFORE_DAYS,
+                  run_hour=DEFAULT_RUN_HOUR):
+    """
+        When certbot itself would renew the lineages.
+
+        Certbot renews whatever is within `renew_before_days` of expiry on its
+        first run after that, this models a single nightly run.
+
+        :param dict expiries: Expiry datetime (UTC) by lineage name.
+        :param now: Time to start from, defaults to the current time.
+        :type now: `datetime.datetime`
+        :param float renew_before_days: Days before expiry a certificate is
+            renewed.
+        :param int run_hour: Hour (UTC) of the nightly run.
+        :returns: Renewal datetime by lineage name.
+        :rtype: dict
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    renew_before = datetime.timedelta(days=renew_before_days)
+    times = {}
+    for lineage, not_after in expiries.items():
+        due = max(now, not_after - renew_before)
+        run = datetime.datetime.combine(due.date(), datetime.time(run_hour))
+        if run < due:
+            run += datetime.timedelta(days=1)
+        times[lineage] = run
+    return times
+
+
+def simulate(times, slot_seconds=DEFAULT_SLOT_SECONDS,
+             renewal_cpu_seconds=DEFAULT_RENEWAL_CPU_SECONDS,
+             reload_cpu_seconds=DEFAULT_RELOAD_CPU_SECONDS, busiest=5):
+    """
+        Simulate the load of renewing at the given times.
+
+        Every slot with renewals is assumed to deploy them with one reload.
+
+        :param times: Renewal datetimes, e.g. the slots of `plan` or the
+            values of `certbot_times`.
+        :param int slot_seconds: Length of a slot.
+        :param float renewal_cpu_seconds: CPU time of one renewal.
+        :param float reload_cpu_seconds: CPU time of one reload.
+        :param int busiest: Number of busiest slots to list.
+        :returns: Simulation figures.
+        :rtype: dict
+    """
+    load = collections.Counter(
+        _slot_index(moment, slot_seconds) for moment in times)
+    peak = max(load.values()) if load else 0
+    return {
+        'renewals': sum(load.values()),
+        'reloads': len(load),
+        'peak_renewals': peak,
+        'mean_renewals': round(
+            sum(load.values()) / float(len(load)), 2) if load else 0,
+        'peak_cpu_seconds': round(
+            peak * renewal_cpu_seconds + reload_cpu_seconds, 1)
+        if load else 0,
+        'busiest': [
+            [_slot_start(index, slot_seconds).strftime(TIME_FORMAT), count]
+            for index, count in sorted(
+                load.items(), key=lambda item: (-item[1], item[0]))[:busiest]
+        ],
+    }
+
+
+def summarise(renewals):
+    """
+        Summarise how far renewals were brought forward.
+
+        :param list renewals: Result of `plan`.
+        :returns: Figures of the schedule.
+        :rtype: dict
+    """
+    early = [(renewal.deadline - renewal.slot).total_seconds() / 86400.0
+             for renewal in renewals if not is_late(renewal)]
+    return {
+        'lineages': len(renewals),
+        'late': sum(1 for renewal in renewals if is_late(renewal)),
+        'mean_early_days': round(sum(early) / len(early), 2) if early else 0,
+        'max_early_days': round(max(early), 2) if early else 0,
+    }
+
+
+def write_schedule(path, renewals):
+    """
+        Write a schedule as JSON.
+
+        :param str path: Path of the schedule file.
+        :param list renewals: Result of `plan`.
+    """
+    temp_path = path + '.tmp'
+    with open(temp_path, 'w') as schedule:
+        json.dump(schedule_json(renewals), schedule, indent=2,
+                  sort_keys=True)
+    os.rename(temp_path, path)
+
+
+def schedule_json(renewals):
+    """
+        Serialise renewals.
+
+        :param list renewals: Result of `plan`.
+        :rtype: list of dict
+    """
+    return [
+        {
+            'lineage': renewal.lineage,
+            'not_after': renewal.not_after.strftime(TIME_FORMAT),
+            'deadline': renewal.deadline.strftime(TIME_FORMAT),
+            'slot': renewal.slot.strftime(TIME_FORMAT),
+        } for renewal in renewals
+    ]
+
+
+def read_schedule(path):
+    """
+        Read a schedule written by `write_schedule`.
+
+        :param str path: Path of the schedule file.
+        :rtype: list of `Renewal`
+    """
+    with open(path) as schedule:
+        entries = json.load(schedule)
+    return [
+        Renewal(entry['lineage'], *[
+            datetime.datetime.strptime(entry[field], TIME_FORMAT)
+            for field in ('not_after', 'deadline', 'slot')
+        ]) for entry in entries
+    ]
+
+
+def due(renewals, expiries, now=None):
+    """
+        Find the lineages whose renewal slot has come.
+
+        :param list renewals: The schedule.
+        :param dict expiries: Current expiry datetime by lineage name, see
+            `read_expiries`.
+        :param now: Current time, defaults to the current time.
+        :type now: `datetime.datetime`
+        :returns: Names of the lineages to renew, a lineage whose certificate
+            changed since the schedule was made is skipped.
+        :rtype: list
+    """
+    if now is None:
+        now = datetime.datetime.utcnow()
+    return [
+        renewal.lineage for renewal in renewals
+        if renewal.slot <= now and
+        expiries.get(renewal.lineage) == renewal.not_after
+    ]
+
+
+def main(cli_args=None):
+    """Plan renewal slots, see the module documentation."""
+    parser = argparse.ArgumentParser(
+        description="Spread certificate renewals over time to stay within a"
+        " budget of renewals per hour.")
+    parser.add_argument(
+        '--live-dir', required=True,
+        help="Certbot live directory to read lineages from.")
+    parser.add_argument(
+        '--due', metavar='SCHEDULE',
+        help="Print the lineages of this schedule whose slot has come"
+        " instead of planning.")
+    parser.add_argument('--budget', type=int, default=DEFAULT_BUDGET,
+                        help="Maximum renewals per slot"
+                        " (default: %(default)s).")
+    parser.add_argument('--renew-before-days', type=float,
+                        default=DEFAULT_RENEW_BEFORE_DAYS)
+    parser.add_argument('--max-early-days', type=float,
+                        default=DEFAULT_MAX_EARLY_DAYS)
+    parser.add_argument('--slot-seconds', type=int,
+                        default=DEFAULT_SLOT_SECONDS)
+    parser.add_argument('--run-hour', type=int, default=DEFAULT_RUN_HOUR,
+                        help="Hour (UTC) of certbot's nightly run in the"
+                        " simulation (default: %(default)s).")
+    parser.add_argument('--renewal-cpu-seconds', type=float,
+                        default=DEFAULT_RENEWAL_CPU_SECONDS)
+    parser.add_argument('--reload-cpu-seconds', type=float,
+                        default=DEFAULT_RELOAD_CPU_SECONDS)
+    parser.add_argument('--output', help="Write the schedule to this file.")
+    parser.add_argument('--format', choices=('json', 'slots'),
+                        default='json')
+    args = parser.parse_args(cli_args)
+
+    expiries = read_expiries(args.live_dir)
+    if args.due:
+        for lineage in due(read_schedule(args.due), expiries):
+            print(lineage)
+        return 0
+
+    try:
+        renewals = plan(expiries, budget=args.budget,
+                        renew_before_days=args.renew_before_days,
+                        max_early_days=args.max_early_days,
+                        slot_seconds=args.slot_seconds)
+    except ValueError as error:
+        parser.error(str(error))
+    if args.output:
+        write_schedule(args.output, renewals)
+
+    if args.format == 'slots':
+        for renewal in renewals:
+            print('%s %s' % (renewal.slot.strftime(TIME_FORMAT),
+                             renewal.lineage))
+        return 0
+
+    costs = dict(slot_seconds=args.slot_seconds,
+                 renewal_cpu_seconds=args.renewal_cpu_seconds,
+                 reload_cpu_seconds=args.reload_cpu_seconds)
+    print(json.dumps({
+        'schedule': schedule_json(renewals),
+        'summary': summarise(renewals),
+        'simulation': {
+            'certbot': simulate(certbot_times(
+                expiries, renew_before_days=args.renew_before_days,
+                run_hour=args.run_hour).values(), **costs),
+            'planned': simulate(
+                [renewal.slot for renewal in renewals], **costs),
+        },
+    }, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
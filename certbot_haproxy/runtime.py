@@ -0,0 +1,467 @@
+"""HAProxy runtime API client.
+
+HAProxy's runtime API is served on its stats socket (see ``stats socket`` in
+the example configuration, e.g. `/run/haproxy/admin.sock`). Sending every
+command over a new connection costs a connect and a round trip per command,
+which makes bulk operations, like updating thousands of map entries, slow.
+
+The clients in this module keep their connections open in interactive
+(``prompt``) mode, in which HAProxy answers every command with its output
+followed by a ``> `` prompt, and write many commands before reading their
+responses (pipelining)::
+
+    client = RuntimeClient('/run/haproxy/admin.sock')
+    info = client.execute('show info').as_dict()
+    for response in client.execute_many(
+            ['set map /etc/haproxy/hosts.map le.wtf nodes'] * 1000):
+        if not response.ok:
+            print(response.text)
+
+`AsyncRuntimeClient` offers the same for asyncio code. Both record the
+latency of every command in `metrics`; for pipelined commands the latency is
+the time between writing the batch and receiving the command's response.
+
+.. note:: The asyncio interface needs Python 3.5 or newer.
+"""
+import asyncio
+import collections
+import logging
+import socket
+import threading
+import time
+from builtins import object
+
+from future.moves import queue
+
+from certbot import errors
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Default address of the runtime API, as in the example configuration.
+DEFAULT_ADDRESS = '/run/haproxy/admin.sock'
+
+#: What HAProxy writes after every response in interactive mode.
+PROMPT = b'\n> '
+
+#: Maximum number of commands written before their responses are read.
+DEFAULT_MAX_BATCH = 64
+
+#: Lower-case response prefixes with which HAProxy reports a failed command,
+#: e.g.: ``Unknown map identifier``, ``'set map' expects three parameters``, or
+#: ``entry not found.`` for ``set map`` and ``del map`` of a missing key.
+ERROR_PREFIXES = (
+    "unknown ", "no such ", "missing ", "require ", "permission denied",
+    "failed ", "out of memory", "invalid ", "can't ", "'", "entry not found",
+    "key not found",
+)
+
+#: How HAProxy ends other failures to find something, e.g.:
+#: ``Frontend not found.``
+NOT_FOUND_SUFFIX = "not found."
+
+
+class RuntimeAPIError(errors.Error):
+    """Communication with the HAProxy runtime API failed."""
+
+
+class Response(object):
+    """
+        Response to a single runtime API command.
+
+        :ivar str command: The command.
+        :ivar str text: The output of the command, without the prompt.
+        :ivar float latency: Seconds it took to get the response.
+    """
+    __slots__ = ('command', 'text', 'latency')
+
+    def __init__(self, command, text, latency):
+        self.command = command
+        self.text = text
+        self.latency = latency
+
+    def __repr__(self):
+        return '<Response %r: %r>' % (self.command, self.text[:60])
+
+    @property
+    def ok(self):  # pylint:disable=invalid-name
+        """Whether the command succeeded, judged by its output."""
+        lines = self.text.strip().lower().splitlines()
+        if not lines:
+            return True
+        return not (lines[0].startswith(ERROR_PREFIXES) or
+                    lines[0].endswith(NOT_FOUND_SUFFIX))
+
+    @property
+    def lines(self):
+        """Non-empty output lines."""
+        return [line for line in self.text.splitlines() if line.strip()]
+
+    def as_dict(self):
+        """
+            Parse ``Key: value`` output, like that of ``show info``.
+
+            :rtype: `collections.OrderedDict`
+        """
+        result = collections.OrderedDict()
+        for line in self.lines:
+            key, separator, value = line.partition(':')
+            if separator:
+                result[key.strip()] = value.strip()
+        return result
+
+    def as_table(self):
+        """
+            Parse CSV output with a ``# header`` line, like that of
+            ``show stat``.
+
+            :rtype: list of dict
+        """
+        lines = self.lines
+        if not lines or not lines[0].startswith('#'):
+            return []
+        header = lines[0].lstrip('# ').rstrip(',').split(',')
+        return [dict(zip(header, line.split(','))) for line in lines[1:]]
+
+    def as_map(self):
+        """
+            Parse ``show map <map>`` output (``<id> <key> <value>`` lines).
+
+            :returns: Mapping of key on value.
+            :rtype: `collections.OrderedDict`
+        """
+        result = collections.OrderedDict()
+        for line in self.lines:
+            parts = line.split(None, 2)
+            if len(parts) == 3:
+                result[parts[1]] = parts[2]
+        return result
+
+
+class LatencyMetrics(object):
+    """
+        Latency per command, grouped by the command's first two words.
+
+        The individual latencies are kept, runs are short-lived and even
+        hundreds of thousands of commands cost only a few MiB.
+    """
+    def __init__(self):
+        self.latencies = collections.defaultdict(list)
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def command_name(command):
+        """Name under which a command is recorded, e.g.: ``set map``."""
+        return ' '.join(command.split()[:2])
+
+    def record(self, command, latency):
+        """Record the latency of a command."""
+        with self._lock:
+            self.latencies[self.command_name(command)].append(latency)
+
+    def summary(self):
+        """
+            Summarise the recorded latencies.
+
+            :returns: Per command name: count, mean, p50, p99 and max latency
+                in seconds.
+            :rtype: dict
+        """
+        result = {}
+        with self._lock:
+            for name, latencies in self.latencies.items():
+                ordered = sorted(latencies)
+                count = len(ordered)
+                result[name] = {
+                    'count': count,
+                    'mean': sum(ordered) / count,
+                    'p50': ordered[int(count * 0.50)],
+                    'p99': ordered[min(count - 1, int(count * 0.99))],
+                    'max': ordered[-1],
+                }
+        return result
+
+
+def parse_address(address):
+    """
+        Determine the socket family and address of a runtime API address.
+
+        :param str address: Path of a UNIX socket, or ``host:port``, which may
+            be prefixed with ``ipv4@`` as in HAProxy's configuration.
+        :returns: (family, address)
+        :rtype: tuple
+    """
+    if address.startswith('unix@'):
+        return socket.AF_UNIX, address[len('unix@'):]
+    if address.startswith('/') or ':' not in address:
+        return socket.AF_UNIX, address
+    if address.startswith(('ipv4@', 'ipv6@')):
+        address = address[len('ipv4@'):]
+    host, _, port = address.rpartition(':')
+    return socket.AF_INET6 if ':' in host else socket.AF_INET, \
+        (host.strip('[]'), int(port))
+
+
+def _batches(commands, max_batch):
+    """Split commands into batches of at most `max_batch`."""
+    for index in range(0, len(commands), max_batch):
+        yield commands[index:index + max_batch]
+
+
+def _encode(commands):
+    """Encode commands for writing them in one go."""
+    for command in commands:
+        if '\n' in command:
+            raise ValueError("Commands can't contain newlines: %r" % command)
+    return ''.join(command + '\n' for command in commands).encode('utf-8')
+
+
+class _Connection(object):
+    """
+        A connection in interactive mode with its read buffer.
+
+        In interactive mode, HAProxy writes ``\\n> `` after the output of
+        every command, including the ``prompt`` command itself.
+    """
+
+    def __init__(self, address, timeout):
+        family, sockaddr = parse_address(address)
+        self.sock = socket.socket(family, socket.SOCK_STREAM)
+        self.sock.settimeout(timeout)
+        self.buffer = b''
+        try:
+            self.sock.connect(sockaddr)
+            self.sock.sendall(b'prompt\n')
+            self.read_response()
+        except Exception:
+            self.sock.close()
+            raise
+
+    def read_response(self):
+        """Read up to and including the next prompt, return what precedes it."""
+        while True:
+            index = self.buffer.find(PROMPT)
+            if index != -1:
+                text = self.buffer[:index]
+                self.buffer = self.buffer[index + len(PROMPT):]
+                return text.decode('utf-8', 'replace')
+            data = self.sock.recv(65536)
+            if not data:
+                raise RuntimeAPIError("Connection closed by HAProxy")
+            self.buffer += data
+
+    def close(self):
+        """Close the connection."""
+        try:
+            self.sock.sendall(b'quit\n')
+        except socket.error:
+            pass
+        self.sock.close()
+
+
+class RuntimeClient(object):
+    """
+        Synchronous runtime API client with a pool of persistent connections.
+
+        The client is thread-safe, every thread that executes commands at the
+        same time uses its own connection, up to `pool_size` connections.
+
+        :param str address: Address of the runtime API, see `parse_address`.
+        :param int pool_size: Maximum number of connections.
+        :param float timeout: Socket timeout in seconds.
+        :param int max_batch: Maximum number of commands per round trip.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=4, timeout=10.0,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.address = address
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.metrics = LatencyMetrics()
+        self._pool = queue.LifoQueue()
+        self._slots = threading.Semaphore(pool_size)
+        self._closed = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _acquire(self):
+        """Get an idle connection or open a new one."""
+        self._slots.acquire()
+        try:
+            return self._pool.get_nowait()
+        except queue.Empty:
+            pass
+        try:
+            return _Connection(self.address, self.timeout)
+        except (socket.error, RuntimeAPIError) as error:
+            self._slots.release()
+            raise RuntimeAPIError(
+                "Can't connect to the runtime API at %s: %s"
+                % (self.address, error))
+
+    def _release(self, connection, broken=False):
+        """Return a connection to the pool, or close it when it broke."""
+        if broken or self._closed:
+            connection.sock.close()
+        else:
+            self._pool.put(connection)
+        self._slots.release()
+
+    def execute(self, command):
+        """
+            Execute a single command.
+
+            :param str command: The command, e.g.: ``show info``.
+            :rtype: `Response`
+        """
+        return self.execute_many([command])[0]
+
+    def execute_many(self, commands):
+        """
+            Execute commands, pipelining up to `max_batch` per round trip.
+
+            The commands are executed in order over a single connection.
+
+            :param list commands: The commands.
+            :returns: Responses in the order of the commands.
+            :rtype: list of `Response`
+            :raises RuntimeAPIError: When the connection fails.
+            :raises ValueError: When a command contains a newline.
+        """
+        batches = [(batch, _encode(batch))
+                   for batch in _batches(list(commands), self.max_batch)]
+        responses = []
+        connection = self._acquire()
+        # Whatever interrupts a batch leaves unread responses behind, so the
+        # connection is only reused when all of them were read.
+        broken = True
+        try:
+            for batch, data in batches:
+                start = time.time()
+                connection.sock.sendall(data)
+                for command in batch:
+                    text = connection.read_response()
+                    latency = time.time() - start
+                    self.metrics.record(command, latency)
+                    responses.append(Response(command, text, latency))
+            broken = False
+        except (socket.error, RuntimeAPIError) as error:
+            raise RuntimeAPIError(
+                "Runtime API at %s failed: %s" % (self.address, error))
+        finally:
+            self._release(connection, broken)
+        return responses
+
+    def close(self):
+        """Close all idle connections."""
+        self._closed = True
+        while True:
+            try:
+                self._pool.get_nowait().close()
+            except queue.Empty:
+                break
+
+
+class AsyncRuntimeClient(object):
+    """
+        Asyncio runtime API client with a pool of persistent connections.
+
+        Takes the same arguments as `RuntimeClient`.
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, pool_size=4, timeout=10.0,
+                 max_batch=DEFAULT_MAX_BATCH):
+        self.address = address
+        self.timeout = timeout
+        self.max_batch = max_batch
+        self.metrics = LatencyMetrics()
+        self._idle = []
+        self._slots = asyncio.Semaphore(pool_size)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _connect(self):
+        """Open a connection in interactive mode."""
+        family, sockaddr = parse_address(self.address)
+        if family == socket.AF_UNIX:
+            connect = asyncio.open_unix_connection(sockaddr)
+        else:
+            connect = asyncio.open_connection(*sockaddr)
+        reader, writer = await asyncio.wait_for(connect, self.timeout)
+        try:
+            writer.write(b'prompt\n')
+            await self._read_response(reader)
+        except BaseException:
+            # Includes the cancellation of the task.
+            writer.close()
+            raise
+        return reader, writer
+
+    async def _read_response(self, reader):
+        """Read up to and including the next prompt."""
+        data = await asyncio.wait_for(reader.readuntil(PROMPT), self.timeout)
+        return data[:-len(PROMPT)].decode('utf-8', 'replace')
+
+    async def execute(self, command):
+        """
+            Execute a single command.
+
+            :param str command: The command.
+            :rtype: `Response`
+        """
+        return (await self.execute_many([command]))[0]
+
+    async def execute_many(self, commands):
+        """
+            Execute commands, pipelining up to `max_batch` per round trip.
+
+            :param list commands: The commands.
+            :returns: Responses in the order of the commands.
+            :rtype: list of `Response`
+            :raises RuntimeAPIError: When the connection fails.
+            :raises ValueError: When a command contains a newline.
+        """
+        batches = [(batch, _encode(batch))
+                   for batch in _batches(list(commands), self.max_batch)]
+        responses = []
+        async with self._slots:
+            connection = self._idle.pop() if self._idle else None
+            # As in `RuntimeClient.execute_many`, also on cancellation.
+            broken = True
+            try:
+                if connection is None:
+                    connection = await self._connect()
+                reader, writer = connection
+                for batch, data in batches:
+                    start = time.time()
+                    writer.write(data)
+                    await writer.drain()
+                    for command in batch:
+                        text = await self._read_response(reader)
+                        latency = time.time() - start
+                        self.metrics.record(command, latency)
+                        responses.append(Response(command, text, latency))
+                broken = False
+            except (OSError, asyncio.IncompleteReadError,
+                    asyncio.TimeoutError) as error:
+                raise RuntimeAPIError(
+                    "Runtime API at %s failed: %r" % (self.address, error))
+            finally:
+                if connection is not None:
+                    if broken:
+                        connection[1].close()
+                    else:
+                        self._idle.append(connection)
+        return responses
+
+    async def close(self):
+        """Close all idle connections."""
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.write(b'quit\n')
+            writer.close()
@@ -0,0 +1,414 @@
+"""SAN consolidation planner.
+
+Every certificate in the `crt_directory` costs HAProxy memory and time to
+parse when it starts or reloads. When thousands of domains each have their own
+certificate, packing them into multi-SAN certificates cuts the number of
+certificates HAProxy has to load by up to two orders of magnitude.
+
+This module plans such a consolidation. The domains are read from the domain
+ACLs of an HAProxy configuration (see `.constants.RE_HAPROXY_DOMAIN_ACL`)
+and/or from existing certbot lineages. They are grouped by affinity, so that
+domains that belong together end up in the same certificate:
+
+  - ``backend``: the backend the domain is routed to in the configuration.
+  - ``customer``: the customer owning the domain, read from a CSV file of
+    ``domain,customer`` lines, the registered domain is used when the domain
+    is not listed.
+  - ``expiry``: the expiry date of the current certificate of the domain,
+    bucketed per ``--expiry-bucket-days``.
+
+Within a group, the subdomains of a registered domain are kept together in one
+certificate whenever they fit. The result is a renewal plan in JSON, or as
+certbot command lines, together with an estimate of the savings::
+
+    certbot-haproxy-plan-san --haproxy-config /etc/haproxy/haproxy.cfg \\
+        --live-dir /etc/letsencrypt/live --affinity backend,customer
+
+Wildcard names of existing lineages are left out of the plan and listed as
+``wildcards``: this authenticator only answers `http-01` and `tls-alpn-01`
+challenges, and Let's Encrypt only validates wildcards with `dns-01`. Their
+certificates have to be issued with another authenticator.
+
+.. note:: The estimate is based on the per-certificate costs passed on the
+    command line, the defaults are rough figures for RSA-2048 certificates
+    with a short chain and should be calibrated for your own setup.
+"""
+from __future__ import print_function
+
+import argparse
+import collections
+import csv
+import datetime
+import json
+import logging
+import os
+import re
+import sys
+
+from certbot_haproxy import haproxycfg
+from certbot_haproxy import util
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Maximum number of names Let's Encrypt accepts in one certificate.
+MAX_SANS = 100
+
+AFFINITIES = ('backend', 'customer', 'expiry')
+
+#: Default estimate of the memory one loaded certificate costs HAProxy (KiB).
+DEFAULT_CERT_MEMORY_KIB = 40.0
+
+#: Default estimate of the time HAProxy needs to load one certificate (ms).
+DEFAULT_CERT_LOAD_MS = 1.5
+
+#: Default estimate of the extra memory one SAN entry costs HAProxy (bytes).
+DEFAULT_SAN_MEMORY_BYTES = 64
+
+Domain = collections.namedtuple('Domain', 'name backend customer not_after')
+
+PlannedCertificate = collections.namedtuple(
+    'PlannedCertificate', 'name affinity domains'
+)
+
+
+def registered_domain(domain):
+    """
+        Approximate the registered domain of a domain name by its last two
+        labels.
+
+        :param str domain: Domain name.
+        :rtype: str
+    """
+    return '.'.join(domain.split('.')[-2:])
+
+
+def read_customers(path):
+    """
+        Read a customer mapping file.
+
+        :param str path: Path to a CSV file with ``domain,customer`` rows.
+        :returns: Mapping of lower-cased domain on customer.
+        :rtype: dict
+    """
+    customers = {}
+    with open(path) as mapping:
+        for row in csv.reader(mapping):
+            if len(row) >= 2 and not row[0].startswith('#'):
+                customers[row[0].strip().lower()] = row[1].strip()
+    return customers
+
+
+def read_lineages(live_dir):
+    """
+        Read the domains and expiry dates of existing certbot lineages.
+
+        :param str live_dir: Certbot's ``live`` directory.
+        :returns: Mapping of lineage name on a tuple of the list of domains
+            and the expiry datetime.
+        :rtype: dict
+    """
+    lineages = {}
+    for name in sorted(os.listdir(live_dir)):
+        cert_path = os.path.join(live_dir, name, 'cert.pem')
+        if not os.path.isfile(cert_path):
+            continue
+        cert = util.load_certificate_file(cert_path)
+        lineages[name] = (
+            util.certificate_domains(cert), util.certificate_not_after(cert)
+        )
+    return lineages
+
+
+def collect_domains(acls=(), lineages=None, customers=None):
+    """
+        Merge the domains of a configuration and of existing lineages.
+
+        :param acls: Domain ACLs from `.haproxycfg.parse_domain_acls`.
+        :param dict lineages: Result of `read_lineages`.
+        :param dict customers: Result of `read_customers`.
+        :returns: Domains sorted by name.
+        :rtype: list of `Domain`
+    """
+    customers = customers or {}
+    backends = {}
+    for acl in acls:
+        backends.setdefault(acl.domain, acl.backend)
+    not_after = {}
+    for names, expires in (lineages or {}).values():
+        for name in names:
+            if name not in not_after or expires < not_after[name]:
+                not_after[name] = expires
+
+    domains = []
+    for name in sorted(set(backends) | set(not_after)):
+        customer = customers.get(name) \
+            or customers.get(registered_domain(name)) \
+            or registered_domain(name)
+        domains.append(Domain(
+            name, backends.get(name), customer, not_after.get(name)
+        ))
+    return domains
+
+
+def split_wildcards(domains):
+    """
+        Separate the wildcard names, which this authenticator can't validate.
+
+        :param domains: List of `Domain`.
+        :returns: The other domains and the wildcard names.
+        :rtype: tuple
+    """
+    wildcards = [domain.name for domain in domains
+                 if domain.name.startswith('*.')]
+    return ([domain for domain in domains
+             if not domain.name.startswith('*.')], wildcards)
+
+
+def affinity_key(domain, affinities, expiry_bucket_days=30):
+    """
+        Determine the group a domain belongs to.
+
+        :param Domain domain: The domain.
+        :param affinities: Names from `AFFINITIES` to group by.
+        :param int expiry_bucket_days: Width of an expiry bucket in days.
+        :returns: Tuple of (affinity, value) pairs.
+        :rtype: tuple
+    """
+    key = []
+    for affinity in affinities:
+        if affinity == 'backend':
+            value = domain.backend or 'none'
+        elif affinity == 'customer':
+            value = domain.customer
+        elif affinity == 'expiry':
+            if domain.not_after is None:
+                value = 'unknown'
+            else:
+                day = domain.not_after.toordinal()
+                bucket = datetime.date.fromordinal(
+                    day - day % expiry_bucket_days)
+                value = bucket.strftime('%Y%m%d')
+        else:
+            raise ValueError("Unknown affinity %r" % affinity)
+        key.append((affinity, value))
+    return tuple(key)
+
+
+def _pack(domains, max_sans):
+    """
+        Pack domains into certificates of at most `max_sans` names, keeping
+        registered domains together when they fit (first fit decreasing).
+    """
+    clusters = collections.defaultdict(list)
+    for domain in domains:
+        clusters[registered_domain(domain.name)].append(domain.name)
+
+    bins = []
+    open_bins = []
+    for _, names in sorted(clusters.items(),
+                           key=lambda item: (-len(item[1]), item[0])):
+        names = sorted(names)
+        while len(names) >= max_sans:
+            bins.append(names[:max_sans])
+            names = names[max_sans:]
+        if not names:
+            continue
+        for candidate in open_bins:
+            if len(candidate) + len(names) <= max_sans:
+                candidate.extend(names)
+                if len(candidate) == max_sans:
+                    open_bins.remove(candidate)
+                break
+        else:
+            bins.append(names)
+            open_bins.append(names)
+    return bins
+
+
+def _slug(key):
+    """Turn an affinity key into a certificate name prefix."""
+    if not key:
+        return 'san'
+    slug = '-'.join(str(value) for _, value in key)
+    return re.sub(r'[^0-9a-z.-]+', '-', slug.lower()).strip('-') or 'san'
+
+
+def plan(domains, max_sans=MAX_SANS, affinities=('backend',),
+         expiry_bucket_days=30):
+    """
+        Group domains into multi-SAN certificates.
+
+        Certificate names are unique, groups whose names would collide get a
+        numbered prefix.
+
+        :param domains: List of `Domain`.
+        :param int max_sans: Maximum number of names per certificate.
+        :param affinities: Names from `AFFINITIES` to group by.
+        :param int expiry_bucket_days: Width of an expiry bucket in days.
+        :rtype: list of `PlannedCertificate`
+    """
+    if not 1 <= max_sans <= MAX_SANS:
+        raise ValueError("max_sans should be between 1 and %d" % MAX_SANS)
+    groups = collections.defaultdict(list)
+    for domain in domains:
+        groups[affinity_key(domain, affinities, expiry_bucket_days)].append(
+            domain)
+
+    certificates = []
+    used = set()
+    for key in sorted(groups):
+        bins = _pack(groups[key], max_sans)
+        # Different groups can have the same slug, e.g. backends ``web_1``
+        # and ``web-1``, a certificate name may only be used once.
+        prefix = base = _slug(key)
+        number = 1
+        while any('%s-%03d' % (prefix, index) in used
+                  for index in range(1, len(bins) + 1)):
+            number += 1
+            prefix = '%s-%d' % (base, number)
+        for index, names in enumerate(bins, 1):
+            name = '%s-%03d' % (prefix, index)
+            used.add(name)
+            certificates.append(PlannedCertificate(name, dict(key), names))
+    return certificates
+
+
+def estimate(current_count, certificates,
+             cert_memory_kib=DEFAULT_CERT_MEMORY_KIB,
+             cert_load_ms=DEFAULT_CERT_LOAD_MS,
+             san_memory_bytes=DEFAULT_SAN_MEMORY_BYTES):
+    """
+        Estimate HAProxy memory use and certificate load time before and after
+        the consolidation.
+
+        :param int current_count: Number of certificates currently loaded.
+        :param certificates: The planned certificates.
+        :returns: Estimate figures.
+        :rtype: dict
+    """
+    sans = sum(len(certificate.domains) for certificate in certificates)
+    planned_count = len(certificates)
+
+    def _memory(count):
+        return (count * cert_memory_kib * 1024 + sans * san_memory_bytes) \
+            / 1024.0 / 1024.0
+
+    before = {
+        'certificates': current_count,
+        'memory_mib': round(_memory(current_count), 1),
+        'load_seconds': round(current_count * cert_load_ms / 1000.0, 2),
+    }
+    after = {
+        'certificates': planned_count,
+        'memory_mib': round(_memory(planned_count), 1),
+        'load_seconds': round(planned_count * cert_load_ms / 1000.0, 2),
+    }
+    return {
+        'before': before,
+        'after': after,
+        'saved_memory_mib': round(
+            before['memory_mib'] - after['memory_mib'], 1),
+        'saved_load_seconds': round(
+            before['load_seconds'] - after['load_seconds'], 2),
+    }
+
+
+def certbot_commands(certificates):
+    """
+        Format planned certificates as certbot command lines.
+
+        :rtype: list of str
+    """
+    return [
+        'certbot certonly --cert-name %s --domains %s' % (
+            certificate.name, ','.join(certificate.domains))
+        for certificate in certificates
+    ]
+
+
+def main(cli_args=None):
+    """Plan a SAN consolidation, see the module documentation."""
+    parser = argparse.ArgumentParser(
+        description="Plan the consolidation of certificates into multi-SAN"
+        " certificates.")
+    parser.add_argument(
+        '--haproxy-config', action='append', default=[],
+        help="HAProxy configuration to read domain ACLs from, may be"
+        " repeated.")
+    parser.add_argument(
+        '--live-dir', help="Certbot live directory to read lineages from.")
+    parser.add_argument(
+        '--customers', help="CSV file with domain,customer rows.")
+    parser.add_argument(
+        '--affinity', default='backend',
+        help="Comma separated list of %s (default: backend)."
+        % ', '.join(AFFINITIES))
+    parser.add_argument('--max-sans', type=int, default=MAX_SANS)
+    parser.add_argument('--expiry-bucket-days', type=int, default=30)
+    parser.add_argument(
+        '--current-certs', type=int,
+        help="Number of certificates currently loaded, defaults to the"
+        " number of lineages, or to the number of domains.")
+    parser.add_argument('--cert-memory-kib', type=float,
+                        default=DEFAULT_CERT_MEMORY_KIB)
+    parser.add_argument('--cert-load-ms', type=float,
+                        default=DEFAULT_CERT_LOAD_MS)
+    parser.add_argument('--san-memory-bytes', type=float,
+                        default=DEFAULT_SAN_MEMORY_BYTES)
+    parser.add_argument('--format', choices=('json', 'commands'),
+                        default='json')
+    args = parser.parse_args(cli_args)
+
+    affinities = [a for a in args.affinity.split(',') if a]
+    for affinity in affinities:
+        if affinity not in AFFINITIES:
+            parser.error("unknown affinity %r" % affinity)
+    if not args.haproxy_config and not args.live_dir:
+        parser.error("use --haproxy-config and/or --live-dir")
+
+    acls = []
+    for path in args.haproxy_config:
+        acls.extend(haproxycfg.read_domain_acls(path))
+    lineages = read_lineages(args.live_dir) if args.live_dir else {}
+    customers = read_customers(args.customers) if args.customers else {}
+    domains, wildcards = split_wildcards(
+        collect_domains(acls, lineages, customers))
+    if wildcards:
+        logger.warning(
+            "Leaving %d wildcard names out of the plan, they need an"
+            " authenticator that supports dns-01: %s", len(wildcards),
+            ", ".join(wildcards))
+
+    certificates = plan(domains, args.max_sans, affinities,
+                        args.expiry_bucket_days)
+    current_count = args.current_certs
+    if current_count is None:
+        current_count = len(lineages) or len(domains)
+
+    savings = estimate(current_count, certificates, args.cert_memory_kib,
+                       args.cert_load_ms, args.san_memory_bytes)
+    if args.format == 'commands':
+        for command in certbot_commands(certificates):
+            print(command)
+        # Keep stdout usable as a script.
+        print(json.dumps({'estimate': savings, 'wildcards': wildcards},
+                         indent=2, sort_keys=True),
+              file=sys.stderr)
+        return 0
+
+    print(json.dumps({
+        'certificates': [
+            {
+                'name': certificate.name,
+                'affinity': certificate.affinity,
+                'domains': certificate.domains,
+            } for certificate in certificates
+        ],
+        'estimate': savings,
+        'wildcards': wildcards,
+    }, indent=2, sort_keys=True))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,220 @@
+"""Challenge responder servers.
+
+These are the servers the `.HAProxyAuthenticator` runs on its internal ports.
+They are based on the servers in `acme.standalone` but answer requests from a
+`.TokenStore` instead of scanning a set of resources, and present tls-alpn-01
+certificates from a `.ChallengeCertificates` store.
+"""
+import logging
+import socket
+import socketserver
+
+from http import client as http_client
+
+from OpenSSL import SSL
+
+from acme import challenges
+from acme import standalone as acme_standalone
+
+from certbot import errors
+from certbot.plugins import standalone
+
+from certbot_haproxy import tlsalpn
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: Path that is answered with `200 OK` for as long as the responder runs.
+HEALTH_PATH = "/.certbot-haproxy/health"
+
+#: Path that is answered with `200 OK` once all tokens of the current batch
+#: are loaded and `503 Service Unavailable` before that. Point HAProxy's
+#: `option httpchk` at this path.
+READY_PATH = "/.certbot-haproxy/ready"
+
+
+class HTTP01RequestHandler(acme_standalone.HTTP01RequestHandler):
+    """
+        HTTP01 challenge handler that looks up responses in a `.TokenStore`.
+
+        The store is passed in as `simple_http_resources` so the handler can
+        be initialised in the same way as its parent.
+
+        Besides the challenge resources the handler answers `HEALTH_PATH`
+        and `READY_PATH` for HAProxy's health checks, to both `GET` and
+        `HEAD` requests.
+    """
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve health checks and challenge resources."""
+        if not self.handle_health_check(send_body=True):
+            acme_standalone.HTTP01RequestHandler.do_GET(self)
+
+    def do_HEAD(self):  # pylint: disable=invalid-name
+        """Serve health checks, other paths are not allowed."""
+        if not self.handle_health_check(send_body=False):
+            self.send_error(http_client.METHOD_NOT_ALLOWED)
+
+    def handle_health_check(self, send_body):
+        """
+            Answer a health check request.
+
+            :param bool send_body: Whether to write a response body.
+            :returns: `True` if the request was a health check.
+            :rtype: bool
+        """
+        if self.path == HEALTH_PATH:
+            status, body = http_client.OK, b"alive"
+        elif self.path == READY_PATH:
+            if self.simple_http_resources.ready:
+                status, body = http_client.OK, b"ready"
+            else:
+                status, body = http_client.SERVICE_UNAVAILABLE, b"loading"
+        else:
+            return False
+        self.send_response(status)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.send_header("Cache-Control", "no-cache")
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+        return True
+
+    def handle_simple_http_resource(self):
+        """Handle HTTP01 provisioned resources."""
+        body = self.simple_http_resources.get_path(self.path)
+        if body is None:
+            self.log_message("%s does not correspond to any resource. ignoring",
+                             self.path)
+            self.handle_404()
+            return
+        self.log_message("Serving HTTP01 for %s", self.path)
+        self.send_response(http_client.OK)
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class HTTP01Server(acme_standalone.HTTPServer, acme_standalone.ACMEServerMixin):
+    """HTTP01 Server backed by a `.TokenStore`."""
+
+    def __init__(self, server_address, resources, ipv6=False):
+        acme_standalone.HTTPServer.__init__(
+            self, server_address, HTTP01RequestHandler.partial_init(
+                simple_http_resources=resources), ipv6=ipv6)
+
+
+class HTTP01DualNetworkedServers(acme_standalone.BaseDualNetworkedServers):
+    """HTTP01Server Wrapper. Tries everything for both. Failures for one don't
+       affect the other."""
+
+    def __init__(self, *args, **kwargs):
+        acme_standalone.BaseDualNetworkedServers.__init__(
+            self, HTTP01Server, *args, **kwargs)
+
+
+class TLSALPN01RequestHandler(socketserver.BaseRequestHandler):
+    """
+        Completes the TLS handshake of a tls-alpn-01 validation request.
+
+        The certificate is selected by the server name the client sends, the
+        handshake fails when no certificate is served for it or when the
+        client does not offer the ``acme-tls/1`` protocol. The validation is
+        complete once the handshake is, so the connection is closed after it.
+    """
+
+    def handle(self):
+        """Perform the handshake with the certificate of the server name."""
+        certificates = self.server.certificates
+
+        def select_context(connection):
+            """Switch to the context of the requested server name."""
+            context = certificates.context(connection.get_servername())
+            if context is None:
+                logger.debug("No tls-alpn-01 certificate for %r",
+                             connection.get_servername())
+                return
+            connection.set_context(context)
+
+        context = tlsalpn.new_context()
+        context.set_tlsext_servername_callback(select_context)
+        connection = SSL.Connection(context, self.request)
+        connection.set_accept_state()
+        try:
+            connection.do_handshake()
+        except SSL.Error as error:
+            logger.debug("tls-alpn-01 handshake with %s failed: %s",
+                         self.client_address, error)
+            return
+        logger.debug("Served tls-alpn-01 for %r to %s",
+                     connection.get_servername(), self.client_address)
+        try:
+            connection.shutdown()
+        except SSL.Error:
+            pass
+
+
+class TLSALPN01Server(socketserver.ThreadingMixIn, socketserver.TCPServer,
+                      acme_standalone.ACMEServerMixin):
+    """TLS-ALPN-01 Server backed by a `.ChallengeCertificates` store."""
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, server_address, certificates, ipv6=False):
+        self.ipv6 = ipv6
+        self.address_family = socket.AF_INET6 if ipv6 else socket.AF_INET
+        self.certificates = certificates
+        socketserver.TCPServer.__init__(
+            self, server_address, TLSALPN01RequestHandler)
+
+
+class TLSALPN01DualNetworkedServers(acme_standalone.BaseDualNetworkedServers):
+    """TLSALPN01Server Wrapper. Tries everything for both. Failures for one
+       don't affect the other."""
+
+    def __init__(self, *args, **kwargs):
+        acme_standalone.BaseDualNetworkedServers.__init__(
+            self, TLSALPN01Server, *args, **kwargs)
+
+
+class ServerManager(standalone.ServerManager):
+    """
+        Standalone servers manager that runs the servers of this module.
+
+        `http_01_resources` is expected to be a `.TokenStore` and `certs` a
+        `.ChallengeCertificates` store.
+    """
+
+    def run(self, port, challenge_type, listenaddr=""):
+        """
+            Run ACME server on specified ``port``.
+
+            :param int port: Port to run the server on.
+            :param challenge_type: Subclass of `acme.challenges.Challenge`,
+                either `acme.challenges.HTTP01` or
+                `acme.challenges.TLSALPN01`.
+            :param str listenaddr: (optional) The address to listen on.
+                Defaults to all addresses.
+
+            :returns: DualNetworkedServers instance.
+        """
+        assert challenge_type in (challenges.HTTP01, challenges.TLSALPN01)
+        if port in self._instances:
+            return self._instances[port]
+
+        try:
+            if challenge_type is challenges.TLSALPN01:
+                servers = TLSALPN01DualNetworkedServers(
+                    (listenaddr, port), self.certs)
+            else:
+                servers = HTTP01DualNetworkedServers(
+                    (listenaddr, port), self.http_01_resources)
+        except socket.error as error:
+            raise errors.StandaloneBindError(error, port)
+
+        servers.serve_forever()
+        real_port = servers.getsocknames()[0][1]
+        self._instances[real_port] = servers
+        return servers
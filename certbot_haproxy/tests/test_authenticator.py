@@ -3,7 +3,9 @@ import mock
 import os
 
 from certbot_haproxy.authenticator import HAProxyAuthenticator
+from certbot_haproxy.preflight import ProbeResult
 from acme import challenges
+from certbot import errors
 
 class TestAuthenticator(unittest.TestCase):
 
@@ -14,6 +16,14 @@ class TestAuthenticator(unittest.TestCase):
     def setUp(self):
         mock_le_config = mock.MagicMock(
             # TODO: Don't know what we need here
+            authenticator_haproxy_token_ttl=60,
+            authenticator_haproxy_tls_alpn_01_port=None,
+            authenticator_haproxy_tls_alpn_01_address='',
+            authenticator_haproxy_ready_delay=0,
+            authenticator_haproxy_preflight='warn',
+            authenticator_haproxy_profile_dir=None,
+            authenticator_haproxy_profile_rate=None,
+            domains=['le.wtf', 'www.le.wtf'],
             )
         self.authenticator = HAProxyAuthenticator(
             config=mock_le_config, name="authenticator")
@@ -34,3 +44,106 @@ class TestAuthenticator(unittest.TestCase):
         chal = self.authenticator.supported_challenges
         self.assertIsInstance(chal, list)
         self.assertTrue(challenges.HTTP01 in chal)
+
+    def test_supported_challenges_tls_alpn_01(self):
+        self.authenticator.config.authenticator_haproxy_tls_alpn_01_port = 8443
+        self.assertEqual(self.authenticator.supported_challenges,
+                         [challenges.TLSALPN01, challenges.HTTP01])
+
+    def test_perform_cleanup_tls_alpn_01(self):
+        self.authenticator.config.authenticator_haproxy_tls_alpn_01_port = 8443
+        self.authenticator.servers = mock.MagicMock()
+        self.authenticator.servers.running.return_value = {8443: None}
+        achall = mock.MagicMock(domain='le.wtf')
+        achall.chall = mock.MagicMock(spec=challenges.TLSALPN01)
+        achall.chall.key_authorization.return_value = 'token.thumbprint'
+        achall.chall.response.return_value = 'response'
+
+        self.assertEqual(self.authenticator.perform([achall]), ['response'])
+        self.authenticator.servers.run.assert_called_once_with(
+            8443, challenges.TLSALPN01, listenaddr='')
+        self.assertTrue('le.wtf' in self.authenticator.certs)
+        self.assertIsNotNone(self.authenticator.certs.context(b'le.wtf'))
+
+        self.authenticator.cleanup([achall])
+        self.assertEqual(len(self.authenticator.certs), 0)
+        self.authenticator.servers.stop.assert_called_once_with(8443)
+
+    def test_perform_cleanup(self):
+        self.authenticator.servers = mock.MagicMock()
+        self.authenticator.servers.running.return_value = {8000: None}
+        achall = mock.MagicMock()
+        achall.chall.encode.return_value = 'token'
+        achall.response_and_validation.return_value = ('response', 'key.auth')
+
+        self.assertFalse(self.authenticator.tokens.ready)
+        self.assertEqual(self.authenticator.perform([achall]), ['response'])
+        self.assertTrue(self.authenticator.tokens.ready)
+        self.assertEqual(self.authenticator.tokens.get('token'), b'key.auth')
+
+        self.authenticator.cleanup([achall])
+        self.assertEqual(len(self.authenticator.tokens), 0)
+        self.authenticator.servers.stop.assert_called_once_with(8000)
+
+    @mock.patch('certbot_haproxy.authenticator.time.sleep')
+    def test_perform_waits_for_health_check(self, m_sleep):
+        self.authenticator.config.authenticator_haproxy_ready_delay = 0.5
+        self.authenticator.servers = mock.MagicMock()
+        achall = mock.MagicMock()
+        achall.response_and_validation.return_value = ('response', 'key.auth')
+        self.authenticator.perform([achall])
+        m_sleep.assert_called_once_with(0.5)
+
+    def test_ready_delay_default(self):
+        add = mock.MagicMock()
+        self.authenticator.add_parser_arguments(add)
+        defaults = dict((call[0][0], call[1].get('default'))
+                        for call in add.call_args_list)
+        self.assertTrue(defaults['haproxy-ready-delay'] >= 0.25)
+
+    def _prepare(self, mode):
+        self.authenticator.config.authenticator_haproxy_preflight = mode
+        self.authenticator.servers = mock.MagicMock()
+        self.authenticator.servers.running.return_value = {8000: None}
+        results = [
+            ProbeResult('le.wtf', True, 200, None),
+            ProbeResult('www.le.wtf', False, 503, 'unavailable'),
+        ]
+        with mock.patch('certbot_haproxy.authenticator.preflight'
+                        '.check_routing', return_value=results) as check:
+            self.authenticator.prepare()
+        return check
+
+    def test_prepare_preflight_off(self):
+        check = self._prepare('off')
+        self.assertEqual(check.call_count, 0)
+
+    def test_prepare_preflight_warn(self):
+        check = self._prepare('warn')
+        self.assertEqual(check.call_args[0][0], ['le.wtf', 'www.le.wtf'])
+        self.assertEqual(self.authenticator.config.domains,
+                         ['le.wtf', 'www.le.wtf'])
+        self.assertFalse(self.authenticator.tokens.ready)
+        self.authenticator.servers.stop.assert_called_once_with(8000)
+
+    def test_prepare_preflight_drop(self):
+        self._prepare('drop')
+        self.assertEqual(self.authenticator.config.domains, ['le.wtf'])
+
+    def test_prepare_preflight_drop_renewal(self):
+        # certbot renew orders the names of the lineage, whatever is in
+        # config.domains, so dropping would only pretend to work.
+        self.authenticator.config.verb = 'renew'
+        self.assertRaises(errors.PluginError, self._prepare, 'drop')
+        self.assertEqual(self.authenticator.config.domains,
+                         ['le.wtf', 'www.le.wtf'])
+
+    def test_prepare_preflight_fail(self):
+        self.assertRaises(errors.PluginError, self._prepare, 'fail')
+
+    def test_prepare_preflight_tls_alpn_01(self):
+        # The check requests http-01 challenges, which are not used.
+        self.authenticator.config.authenticator_haproxy_tls_alpn_01_port = 8443
+        check = self._prepare('fail')
+        self.assertEqual(check.call_count, 0)
+        self.assertEqual(self.authenticator.servers.run.call_count, 0)
@@ -0,0 +1,252 @@
+import os
+import shutil
+import stat
+import tempfile
+import unittest
+
+from mock import patch
+from OpenSSL import crypto
+
+from certbot import errors
+from certbot_haproxy import deploy
+from certbot_haproxy.tests.test_pemcheck import make_cert
+
+
+class LineageTestCase(unittest.TestCase):
+    """Base class of tests that deploy lineages from a live directory."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.live_dir = os.path.join(self.directory, 'live')
+        self.crt_directory = os.path.join(self.directory, 'fullchains')
+        os.makedirs(self.crt_directory)
+        self.ca_key, self.ca = make_cert(u'Test CA')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def make_lineage(self, name, mismatch=False, key_type='rsa'):
+        """Create a lineage in the live directory."""
+        lineage = os.path.join(self.live_dir, name)
+        if not os.path.isdir(lineage):
+            os.makedirs(lineage)
+        key, cert = make_cert(name, self.ca, self.ca_key, key_type=key_type)
+        if mismatch:
+            key, _ = make_cert(name, self.ca, self.ca_key, key_type=key_type)
+        with open(os.path.join(lineage, 'privkey.pem'), 'wb') as target:
+            target.write(crypto.dump_privatekey(crypto.FILETYPE_PEM, key))
+        with open(os.path.join(lineage, 'fullchain.pem'), 'wb') as target:
+            target.write(crypto.dump_certificate(crypto.FILETYPE_PEM, cert))
+            target.write(crypto.dump_certificate(crypto.FILETYPE_PEM, self.ca))
+        return lineage
+
+
+class DeployTest(LineageTestCase):
+    """Test staging, validating and committing lineages."""
+
+    def setUp(self):
+        super(DeployTest, self).setUp()
+        self.make_lineage('good.wtf')
+        self.make_lineage('bad.wtf', mismatch=True)
+
+    def deploy(self, **kwargs):
+        return deploy.deploy(
+            deploy.find_lineages(self.live_dir), self.crt_directory,
+            'haproxy.cfg', ['true'], ['true'], workers=1, **kwargs)
+
+    def test_staging_directory(self):
+        self.assertEqual(deploy.staging_directory('/opt/certbot/fullchains/'),
+                         '/opt/certbot/.fullchains.staging')
+
+    def test_deploy(self):
+        result = self.deploy()
+        self.assertEqual(result.committed, ['good.wtf.pem'])
+        self.assertEqual(list(result.rejected), ['bad.wtf.pem'])
+        self.assertTrue(result.reloaded)
+        self.assertEqual(os.listdir(self.crt_directory), ['good.wtf.pem'])
+        self.assertEqual(
+            sorted(os.listdir(deploy.staging_directory(self.crt_directory))),
+            sorted([deploy.CACHE_FILE, deploy.JOURNAL_FILE]))
+
+        result = self.deploy()
+        self.assertEqual(result.committed, [])
+        self.assertEqual(result.unchanged, ['good.wtf.pem'])
+        self.assertFalse(result.reloaded)
+
+    def test_conftest_fails(self):
+        with self.assertRaises(errors.PluginError):
+            deploy.deploy(
+                deploy.find_lineages(self.live_dir), self.crt_directory,
+                'haproxy.cfg', ['false'], ['true'], workers=1)
+
+    @patch('certbot_haproxy.deploy.constants.os_constant')
+    def test_main_renewed_lineage(self, m_os_constant):
+        m_os_constant.side_effect = {
+            'crt_directory': self.crt_directory,
+            'haproxy_config': 'haproxy.cfg',
+            'conftest_cmd': ['true'],
+            'restart_cmd': ['true'],
+        }.get
+        lineage = os.path.join(self.live_dir, 'good.wtf')
+        with patch.dict(os.environ, {'RENEWED_LINEAGE': lineage}):
+            self.assertEqual(deploy.main([]), 0)
+        self.assertEqual(os.listdir(self.crt_directory), ['good.wtf.pem'])
+        self.assertEqual(deploy.main(['--live-dir', self.live_dir]), 1)
+
+
+class BundleTest(LineageTestCase):
+    """Test deploying paired RSA and ECDSA lineages as bundles."""
+
+    def setUp(self):
+        super(BundleTest, self).setUp()
+        self.make_lineage('pair.wtf-rsa')
+        self.make_lineage('pair.wtf-ecdsa', key_type='ec')
+
+    def deploy(self, lineages=None):
+        return deploy.deploy(
+            lineages or deploy.find_lineages(self.live_dir),
+            self.crt_directory, 'haproxy.cfg', ['true'], ['true'], workers=1)
+
+    def touch(self, name):
+        open(os.path.join(self.crt_directory, name), 'w').close()
+
+    def test_pem_files(self):
+        files = deploy.pem_files(
+            [os.path.join(self.live_dir, 'pair.wtf-ecdsa')])
+        self.assertEqual(
+            sorted((pem.name, pem.bundle, pem.superseded) for pem in files),
+            [('pair.wtf.pem.ecdsa', 'pair.wtf.pem', ('pair.wtf.pem',)),
+             ('pair.wtf.pem.rsa', 'pair.wtf.pem', ('pair.wtf.pem',))])
+
+    def test_bundle_replaces_single(self):
+        self.touch('pair.wtf.pem')
+        result = self.deploy()
+        self.assertEqual(sorted(result.committed),
+                         ['pair.wtf.pem.ecdsa', 'pair.wtf.pem.rsa'])
+        self.assertEqual(result.removed, ['pair.wtf.pem'])
+        self.assertTrue(result.reloaded)
+        self.assertEqual(sorted(os.listdir(self.crt_directory)),
+                         ['pair.wtf.pem.ecdsa', 'pair.wtf.pem.rsa'])
+
+        # Renewing one of the pair deploys the bundle as a whole.
+        result = self.deploy([os.path.join(self.live_dir, 'pair.wtf-rsa')])
+        self.assertEqual(sorted(result.unchanged),
+                         ['pair.wtf.pem.ecdsa', 'pair.wtf.pem.rsa'])
+        self.assertFalse(result.reloaded)
+
+    def test_bundle_held_back_together(self):
+        self.make_lineage('pair.wtf-ecdsa', mismatch=True, key_type='ec')
+        self.touch('pair.wtf.pem')
+        result = self.deploy()
+        self.assertEqual(result.committed, [])
+        self.assertEqual(sorted(result.rejected),
+                         ['pair.wtf.pem.ecdsa', 'pair.wtf.pem.rsa'])
+        self.assertEqual(result.removed, [])
+        self.assertFalse(result.reloaded)
+        self.assertEqual(os.listdir(self.crt_directory), ['pair.wtf.pem'])
+
+    def test_single_replaces_bundle(self):
+        shutil.rmtree(os.path.join(self.live_dir, 'pair.wtf-ecdsa'))
+        self.touch('pair.wtf.pem.ecdsa')
+        self.touch('pair.wtf.pem.rsa')
+        result = self.deploy()
+        self.assertEqual(result.committed, ['pair.wtf.pem'])
+        self.assertEqual(sorted(result.removed),
+                         ['pair.wtf.pem.ecdsa', 'pair.wtf.pem.rsa'])
+        self.assertEqual(os.listdir(self.crt_directory), ['pair.wtf.pem'])
+
+
+STUB_HAPROXY = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls.log"
+[ -e "$(dirname "$0")/fail" ] && exit 1
+exit 0
+"""
+
+
+class ResumeTest(LineageTestCase):
+    """Test resuming interrupted deploys, with a stub haproxy."""
+
+    def setUp(self):
+        super(ResumeTest, self).setUp()
+        self.make_lineage('good.wtf')
+        self.make_lineage('other.wtf')
+        self.make_lineage('third.wtf')
+        self.bin_dir = os.path.join(self.directory, 'bin')
+        os.makedirs(self.bin_dir)
+        self.haproxy = os.path.join(self.bin_dir, 'haproxy')
+        with open(self.haproxy, 'w') as stub:
+            stub.write(STUB_HAPROXY)
+        os.chmod(self.haproxy, stat.S_IRWXU)
+
+    def deploy(self, **kwargs):
+        return deploy.deploy(
+            deploy.find_lineages(self.live_dir), self.crt_directory,
+            'haproxy.cfg', [self.haproxy, '-c', '-f'],
+            [self.haproxy, 'restart'], workers=1, **kwargs)
+
+    def calls(self):
+        """Invocations of the stub haproxy, emptying its log."""
+        log = os.path.join(self.bin_dir, 'calls.log')
+        if not os.path.exists(log):
+            return []
+        with open(log) as calls:
+            lines = calls.read().splitlines()
+        os.remove(log)
+        return lines
+
+    def test_crash_during_commit(self):
+        real_commit = deploy.commit
+
+        def crash_after_first(*args):
+            if os.listdir(self.crt_directory):
+                raise KeyboardInterrupt()
+            real_commit(*args)
+
+        with patch('certbot_haproxy.deploy.commit',
+                   side_effect=crash_after_first):
+            self.assertRaises(KeyboardInterrupt, self.deploy)
+        self.assertEqual(os.listdir(self.crt_directory), ['good.wtf.pem'])
+        self.assertEqual(self.calls(), [])
+
+        with patch('certbot_haproxy.deploy.write_file') as m_write:
+            result = self.deploy()
+        # The intact staged files of the interrupted run are reused.
+        self.assertEqual(m_write.call_count, 0)
+        self.assertEqual(result.committed, ['other.wtf.pem', 'third.wtf.pem'])
+        self.assertEqual(result.resumed, ['good.wtf.pem'])
+        self.assertTrue(result.reloaded)
+        self.assertEqual(self.calls(), ['-c -f haproxy.cfg', 'restart'])
+
+        result = self.deploy()
+        self.assertEqual(result.resumed, [])
+        self.assertFalse(result.reloaded)
+        self.assertEqual(self.calls(), [])
+
+    def test_crash_before_reload(self):
+        with patch('certbot_haproxy.deploy.reload_haproxy',
+                   side_effect=KeyboardInterrupt()):
+            self.assertRaises(KeyboardInterrupt, self.deploy)
+        self.assertEqual(len(os.listdir(self.crt_directory)), 3)
+
+        result = self.deploy()
+        self.assertEqual(result.committed, [])
+        self.assertEqual(len(result.resumed), 3)
+        self.assertTrue(result.reloaded)
+        self.assertEqual(self.calls(), ['-c -f haproxy.cfg', 'restart'])
+
+    def test_conftest_failure(self):
+        open(os.path.join(self.bin_dir, 'fail'), 'w').close()
+        self.assertRaises(errors.PluginError, self.deploy)
+        self.assertEqual(self.calls(), ['-c -f haproxy.cfg'])
+        self.assertRaises(errors.PluginError, self.deploy)
+        self.assertEqual(self.calls(), ['-c -f haproxy.cfg'])
+
+        os.remove(os.path.join(self.bin_dir, 'fail'))
+        result = self.deploy()
+        self.assertEqual(len(result.resumed), 3)
+        self.assertEqual(self.calls(), ['-c -f haproxy.cfg', 'restart'])
+        self.assertFalse(self.deploy().reloaded)
+
+
+if __name__ == '__main__':
+    unittest.main()
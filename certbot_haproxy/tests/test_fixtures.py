@@ -0,0 +1,96 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from certbot_haproxy import deploy
+from certbot_haproxy import fixtures
+from certbot_haproxy import haproxycfg
+from certbot_haproxy import pemcheck
+
+
+def make_spec(**kwargs):
+    """A spec of a few cheap certificates."""
+    values = dict(count=5, sans=(1, 3), key_types=('ec',), zones=2,
+                  backends=3, days=90, spread_days=30, seed=1,
+                  shared_keys=False)
+    values.update(kwargs)
+    return fixtures.Spec(**values)
+
+
+class FixturesTest(unittest.TestCase):
+    """Test generating scale fixtures."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_parse_sans(self):
+        self.assertEqual(fixtures.parse_sans('3'), (3, 3))
+        self.assertEqual(fixtures.parse_sans('1:5'), (1, 5))
+        self.assertRaises(ValueError, fixtures.parse_sans, '0')
+        self.assertRaises(ValueError, fixtures.parse_sans, '5:1')
+        self.assertRaises(ValueError, fixtures.parse_sans, 'many')
+
+    def test_describe(self):
+        spec = make_spec(key_types=('rsa', 'ec'))
+        fixture, issued_ago = fixtures.describe(spec, 3)
+        self.assertEqual(fixture.name, 'site3.zone1.test')
+        self.assertEqual(fixture.key_type, 'ec')
+        self.assertEqual(fixture.backend, 'backend_0')
+        self.assertTrue(1 <= len(fixture.domains) <= 3)
+        self.assertTrue(0 <= issued_ago <= 30 * 86400)
+        self.assertEqual(fixtures.describe(spec, 3), (fixture, issued_ago))
+        self.assertNotEqual(
+            fixtures.describe(spec._replace(seed=2), 3)[1], issued_ago)
+
+    def test_generate(self):
+        generated = fixtures.generate(self.directory, make_spec(),
+                                      workers=2, chunk_size=2)
+        self.assertEqual([fixture.name for fixture in generated],
+                         ['site%d.zone%d.test' % (index, index % 2)
+                          for index in range(5)])
+        lineages = deploy.find_lineages(os.path.join(self.directory, 'live'))
+        self.assertEqual(len(lineages), 5)
+
+        paths = [os.path.join(self.directory, 'certs', fixture.name + '.pem')
+                 for fixture in generated]
+        results = pemcheck.check_files(
+            paths, ca_file=os.path.join(self.directory, 'ca.pem'), workers=1)
+        self.assertEqual([result.problems for result in results], [[]] * 5)
+        with open(paths[0], 'rb') as pem:
+            self.assertEqual(pem.read(), deploy.combine(lineages[0]))
+
+    def test_crt_list_and_config(self):
+        generated = fixtures.generate(self.directory, make_spec(), workers=1)
+        lines = fixtures.crt_list(generated, '/certs')
+        self.assertEqual(
+            lines[0], '/certs/site0.zone0.test.pem %s'
+            % ' '.join(generated[0].domains))
+
+        config = fixtures.haproxy_config(generated, '/crt-list.txt',
+                                         backends=3)
+        self.assertIn('    bind *:443 ssl crt-list /crt-list.txt', config)
+        acls = haproxycfg.parse_domain_acls(config)
+        self.assertEqual(
+            [(acl.domain, acl.backend) for acl in acls],
+            [(domain, fixture.backend) for fixture in generated
+             for domain in fixture.domains])
+
+    def test_main(self):
+        self.assertEqual(fixtures.main(
+            [self.directory, '--count', '2', '--key-types', 'ec',
+             '--workers', '1']), 0)
+        self.assertEqual(
+            sorted(os.listdir(self.directory)),
+            ['ca.pem', 'certs', 'crt-list.txt', 'haproxy.cfg', 'live'])
+        self.assertRaises(SystemExit, fixtures.main,
+                          [self.directory, '--key-types', 'dsa'])
+        self.assertRaises(SystemExit, fixtures.main,
+                          [self.directory, '--sans', '0'])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
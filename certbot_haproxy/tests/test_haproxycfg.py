@@ -0,0 +1,105 @@
+import unittest
+
+from certbot_haproxy import haproxycfg
+
+CONFIG = """
+global
+    daemon
+
+frontend http-in
+    bind *:80
+    acl is_certbot path_beg -i /.well-known/acme-challenge
+    acl host_example hdr(host) -i example.com
+    acl host_www_example hdr(host) -i www.example.com  # comment
+    acl host_other hdr(host) -i other.org
+    acl host_unrouted hdr(host) -i unrouted.net
+    use_backend certbot if is_certbot
+    use_backend nodes if host_example or host_www_example
+    use_backend other if host_other
+    use_backend never if host_other
+    use_backend skipped if !host_unrouted
+    default_backend nodes
+
+backend nodes
+    server node1 127.0.0.1:8080 check
+"""
+
+
+class ParseDomainACLsTest(unittest.TestCase):
+    """Test extracting domain ACLs and their backends."""
+
+    def test_parse(self):
+        acls = haproxycfg.parse_domain_acls(CONFIG.splitlines())
+        self.assertEqual(
+            [(acl.section, acl.acl, acl.domain, acl.backend) for acl in acls],
+            [
+                ('http-in', 'host_example', 'example.com', 'nodes'),
+                ('http-in', 'host_www_example', 'www.example.com', 'nodes'),
+                ('http-in', 'host_other', 'other.org', 'other'),
+                ('http-in', 'host_unrouted', 'unrouted.net', None),
+            ]
+        )
+        self.assertEqual(acls[0].line_nr, 8)
+
+    def test_conditions(self):
+        self.assertEqual(haproxycfg._condition_acls('a or b || c'),
+                         ['a', 'b', 'c'])
+        for condition in ('a b', 'a or !b', '{ hdr(host) -i aa.wtf }',
+                          'a or', 'a and b'):
+            self.assertIsNone(haproxycfg._condition_acls(condition))
+
+    def test_parse_routing(self):
+        acls, rules = haproxycfg.parse_routing([
+            'frontend http-in',
+            '    acl host_a hdr(host) -i aa.wtf',
+            '    acl host_b hdr(host) -i bb.wtf',
+            '    acl is_api path_beg /api',
+            '    use_backend api if host_a is_api',
+            '    use_backend legacy unless host_b',
+            '    use_backend web if host_a or host_b',
+            '    use_backend api if is_api',
+            '    use_backend fallback',
+        ])
+        # The first rule refers to host_a, but does not route it alone.
+        self.assertEqual([(acl.domain, acl.backend) for acl in acls],
+                         [('aa.wtf', 'web'), ('bb.wtf', 'web')])
+        self.assertEqual(
+            [(rule.backend, rule.condition, rule.acls, rule.by_domain,
+              rule.line_nr) for rule in rules],
+            [
+                ('api', 'if host_a is_api', ['host_a'], False, 5),
+                ('legacy', 'unless host_b', ['host_b'], False, 6),
+                ('web', 'if host_a or host_b', ['host_a', 'host_b'], True, 7),
+                ('api', 'if is_api', [], False, 8),
+                ('fallback', '', [], False, 9),
+            ]
+        )
+
+    def test_acl_patterns(self):
+        acls, rules = haproxycfg.parse_routing([
+            'frontend http-in',
+            '    acl host_a hdr(host) -i aa.example.com www.aa.example.com',
+            '    acl host_b hdr(host) -i bb.example.com:8080',
+            '    acl host_c hdr(host) -i cc.example.com',
+            '    acl host_c path_beg /cc',
+            '    acl host_d hdr(host) -i dd.example.com -m beg',
+            '    use_backend app_a if host_a',
+            '    use_backend app_b if host_b',
+            '    use_backend app_c if host_c',
+            '    use_backend app_d if host_d',
+        ])
+        # Every domain of a line is routed, patterns that are not a plain
+        # domain make the ACL match something else.
+        self.assertEqual(
+            [(acl.acl, acl.domain, acl.backend) for acl in acls],
+            [('host_a', 'aa.example.com', 'app_a'),
+             ('host_a', 'www.aa.example.com', 'app_a'),
+             ('host_c', 'cc.example.com', None)])
+        self.assertEqual(
+            [(rule.backend, rule.acls, rule.by_domain) for rule in rules],
+            [('app_a', ['host_a'], True), ('app_b', [], False),
+             ('app_c', ['host_c'], False), ('app_d', [], False)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,153 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from certbot_haproxy import haproxycfg
+from certbot_haproxy import hostmap
+from certbot_haproxy import runtime
+from certbot_haproxy.haproxycfg import DomainACL
+from certbot_haproxy.tests.test_runtime import FakeRuntimeServer
+
+CONFIG = """frontend http-in
+    acl is_certbot path_beg -i /.well-known/acme-challenge
+    acl is_api path_beg /api
+    acl host_a hdr(host) -i aa.wtf
+    use_backend certbot if is_certbot
+    use_backend api if host_a is_api
+    use_backend web if host_a
+    acl host_b hdr(host) -i bb.wtf
+    use_backend api if is_api
+    use_backend other if host_b
+"""
+
+
+class HostMapTest(unittest.TestCase):
+    """Test building, writing and synchronising host maps."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.map_path = os.path.join(self.directory, 'hosts.map')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_build_map(self):
+        acls = [
+            DomainACL('http-in', 'a', 'le.wtf', 'nodes', 1),
+            DomainACL('http-in', 'b', 'le.wtf', 'other', 2),
+            DomainACL('http-in', 'c', 'other.wtf', 'other', 3),
+            DomainACL('http-in', 'd', 'unused.wtf', None, 4),
+        ]
+        self.assertEqual(hostmap.build_map(acls),
+                         {'le.wtf': 'nodes', 'other.wtf': 'other'})
+
+    def test_unconvertible_rules(self):
+        rules = haproxycfg.parse_routing(CONFIG.splitlines()).rules
+        problems = hostmap.unconvertible_rules(rules)
+        self.assertEqual([(rule.line_nr, reason.split(',')[0])
+                          for rule, reason in problems],
+                         [(6, "it refers to domain ACLs"),
+                          (9, "it follows rules that route by domain")])
+        # A rule in front of the domain rules can stay in front of the map.
+        self.assertEqual(hostmap.unconvertible_rules(rules[:1]), [])
+
+    def test_unconvertible_acls(self):
+        rules = haproxycfg.parse_routing([
+            'frontend http-in',
+            '    acl host_a hdr(host) -i aa.example.com',
+            '    acl host_b hdr(host) -i bb.example.com:8080',
+            '    acl host_c hdr(host) -i cc.example.com',
+            '    acl host_c path_beg /cc',
+            '    use_backend app_a if host_a',
+            '    use_backend app_b if host_b',
+            '    use_backend app_c if host_c',
+        ]).rules
+        self.assertEqual(
+            [(rule.backend, reason.split(',')[0]) for rule, reason
+             in hostmap.unconvertible_rules(rules)],
+            [('app_b', "it follows rules that route by domain"),
+             ('app_c', "it refers to domain ACLs")])
+
+    def test_use_backend_rule(self):
+        self.assertEqual(
+            hostmap.use_backend_rule('/etc/haproxy/hosts.map', 'nodes'),
+            'use_backend %[req.hdr(host),lower,map(/etc/haproxy/hosts.map,'
+            'nodes)]')
+
+    def test_read_write(self):
+        entries = {'le.wtf': 'nodes', 'a.wtf': 'other'}
+        hostmap.write_map(self.map_path, entries)
+        with open(self.map_path) as map_file:
+            self.assertEqual(map_file.read(), 'a.wtf other\nle.wtf nodes\n')
+        self.assertEqual(hostmap.read_map(self.map_path), entries)
+
+    def test_add_domains(self):
+        entries = {'le.wtf': 'other'}
+        added = hostmap.add_domains(
+            entries, ['LE.wtf', 'new.wtf', '*.new.wtf'], 'nodes')
+        self.assertEqual(added, ['new.wtf'])
+        self.assertEqual(entries, {'le.wtf': 'other', 'new.wtf': 'nodes'})
+
+    def test_generate(self):
+        config = os.path.join(self.directory, 'haproxy.cfg')
+        with open(config, 'w') as config_file:
+            config_file.write(
+                "frontend http-in\n"
+                "    acl host_le hdr(host) -i le.wtf\n"
+                "    use_backend nodes if host_le\n")
+        with patch('certbot_haproxy.hostmap.print'):
+            hostmap.main(['generate', '--haproxy-config', config,
+                          '--map', self.map_path])
+        self.assertEqual(hostmap.read_map(self.map_path), {'le.wtf': 'nodes'})
+
+        with open(config, 'w') as config_file:
+            config_file.write(CONFIG)
+        with patch('certbot_haproxy.hostmap.print'):
+            self.assertEqual(hostmap.main(
+                ['generate', '--haproxy-config', config,
+                 '--map', self.map_path]), 1)
+        self.assertEqual(hostmap.read_map(self.map_path), {'le.wtf': 'nodes'})
+
+
+class SyncRuntimeTest(unittest.TestCase):
+    """Test applying maps to a (fake) running HAProxy."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket = os.path.join(self.directory, 'admin.sock')
+        self.map_path = os.path.join(self.directory, 'hosts.map')
+        self.server = FakeRuntimeServer(self.socket)
+        self.server.maps[self.map_path] = {
+            'keep.wtf': 'nodes', 'move.wtf': 'nodes', 'gone.wtf': 'nodes'}
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_sync_runtime(self):
+        wanted = {'keep.wtf': 'nodes', 'move.wtf': 'other', 'new.wtf': 'x'}
+        with runtime.RuntimeClient(self.socket) as client:
+            changes = hostmap.sync_runtime(client, self.map_path, wanted)
+        self.assertEqual(changes, (['new.wtf'], ['move.wtf'], ['gone.wtf']))
+        self.assertEqual(self.server.maps[self.map_path], wanted)
+
+    def test_sync_unknown_map(self):
+        with runtime.RuntimeClient(self.socket) as client:
+            self.assertRaises(runtime.RuntimeAPIError, hostmap.sync_runtime,
+                              client, 'unknown.map', {})
+
+    def test_main_sync(self):
+        hostmap.write_map(self.map_path, self.server.maps[self.map_path])
+        with patch.dict(os.environ, {'RENEWED_DOMAINS': 'new.wtf keep.wtf'}):
+            self.assertEqual(hostmap.main([
+                'sync', '--map', self.map_path, '--default-backend', 'nodes',
+                '--socket', self.socket]), 0)
+        self.assertEqual(self.server.maps[self.map_path]['new.wtf'], 'nodes')
+        self.assertEqual(hostmap.read_map(self.map_path)['new.wtf'], 'nodes')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,251 @@
+import os
+import stat
+import tempfile
+import time
+import shutil
+import unittest
+
+from mock import patch
+
+from certbot import errors
+from certbot_haproxy import deploy
+from certbot_haproxy import instances
+from certbot_haproxy.tests.test_deploy import LineageTestCase
+
+PROFILES = """
+[DEFAULT]
+conftest_cmd = /usr/sbin/haproxy -c -f
+timeout = 5
+
+[tenant-a]
+haproxy_config = /etc/haproxy/tenant-a.cfg
+crt_directory = /etc/haproxy/tenant-a/certs
+restart_cmd = sudo systemctl reload haproxy@tenant-a
+
+[tenant-b]
+haproxy_config = /etc/haproxy/tenant-b.cfg
+crt_directory = /etc/haproxy/tenant-b/certs
+restart_cmd = sudo systemctl reload "haproxy@tenant b"
+timeout = 2.5
+"""
+
+DEFAULTS = {
+    'haproxy_config': '/etc/haproxy/haproxy.cfg',
+    'crt_directory': '/opt/certbot/haproxy_fullchains',
+    'conftest_cmd': ['/usr/sbin/haproxy', '-c', '-f'],
+    'restart_cmd': ['sudo', 'systemctl', 'restart', 'haproxy'],
+}
+
+STUB_HAPROXY = """#!/bin/sh
+echo "$@" >> "$(dirname "$0")/calls.log"
+for name; do :; done
+name=${name%.cfg}
+[ -e "$(dirname "$0")/fail-$name" ] && exit 1
+[ -e "$(dirname "$0")/hang-$name" ] && sleep 30
+exit 0
+"""
+
+
+class ReadInstancesTest(unittest.TestCase):
+    """Test reading instance profiles."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'instances.ini')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, content):
+        with open(self.path, 'w') as profiles:
+            profiles.write(content)
+
+    def test_read_instances(self):
+        self.write(PROFILES)
+        tenant_a, tenant_b = instances.read_instances(self.path, DEFAULTS)
+        self.assertEqual(tenant_a.name, 'tenant-a')
+        self.assertEqual(tenant_a.crt_directory, '/etc/haproxy/tenant-a/certs')
+        self.assertEqual(tenant_a.conftest_cmd,
+                         ['/usr/sbin/haproxy', '-c', '-f'])
+        self.assertEqual(tenant_a.timeout, 5.0)
+        self.assertEqual(tenant_b.restart_cmd,
+                         ['sudo', 'systemctl', 'reload', 'haproxy@tenant b'])
+        self.assertEqual(tenant_b.timeout, 2.5)
+
+    def test_defaults(self):
+        self.write("[main]\ncrt_directory = /srv/certs\n")
+        instance, = instances.read_instances(self.path, DEFAULTS)
+        self.assertEqual(instance.crt_directory, '/srv/certs')
+        self.assertEqual(instance.haproxy_config, '/etc/haproxy/haproxy.cfg')
+        self.assertEqual(instance.restart_cmd, DEFAULTS['restart_cmd'])
+        self.assertEqual(instance.timeout, instances.DEFAULT_TIMEOUT)
+
+    @patch('certbot_haproxy.instances.constants.os_constant',
+           side_effect=errors.NotSupportedError())
+    def test_incomplete(self, unused_os_constant):
+        self.write("[main]\ncrt_directory = /srv/certs\n")
+        self.assertRaises(errors.PluginError,
+                          instances.read_instances, self.path)
+
+    def test_invalid(self):
+        self.write("[main]\ntimeout = soon\n")
+        self.assertRaises(errors.PluginError,
+                          instances.read_instances, self.path, DEFAULTS)
+        self.write("")
+        self.assertRaises(errors.PluginError,
+                          instances.read_instances, self.path, DEFAULTS)
+        self.assertRaises(errors.PluginError, instances.read_instances,
+                          os.path.join(self.directory, 'missing'), DEFAULTS)
+
+
+class ReloadInstancesTest(LineageTestCase):
+    """Test reloading instances concurrently, with a stub haproxy."""
+
+    def setUp(self):
+        super(ReloadInstancesTest, self).setUp()
+        self.bin_dir = os.path.join(self.directory, 'bin')
+        os.makedirs(self.bin_dir)
+        self.haproxy = os.path.join(self.bin_dir, 'haproxy')
+        with open(self.haproxy, 'w') as stub:
+            stub.write(STUB_HAPROXY)
+        os.chmod(self.haproxy, stat.S_IRWXU)
+
+    def instance(self, name, timeout=5.0):
+        """An instance reloaded by the stub haproxy."""
+        crt_directory = os.path.join(self.directory, name)
+        if not os.path.isdir(crt_directory):
+            os.makedirs(crt_directory)
+        return instances.Instance(
+            name, name + '.cfg', crt_directory, [self.haproxy, '-c', '-f'],
+            [self.haproxy, 'restart', name], timeout)
+
+    def flag(self, kind, name):
+        open(os.path.join(self.bin_dir, '%s-%s' % (kind, name)), 'w').close()
+
+    def calls(self):
+        """Invocations of the stub haproxy, emptying its log."""
+        log = os.path.join(self.bin_dir, 'calls.log')
+        if not os.path.exists(log):
+            return []
+        with open(log) as calls:
+            lines = calls.read().splitlines()
+        os.remove(log)
+        return sorted(lines)
+
+    def test_run_command(self):
+        result = instances.reload_instances([])
+        self.assertEqual(result, [])
+        loop_result = instances.reload_instances([self.instance('a')])
+        self.assertEqual(loop_result, [None])
+        self.assertEqual(self.calls(), ['-c -f a.cfg', 'restart a'])
+
+    def test_missing_command(self):
+        instance = self.instance('a')._replace(
+            restart_cmd=[os.path.join(self.bin_dir, 'missing')])
+        failure, = instances.reload_instances([instance])
+        self.assertIn("restart of a failed with status 127", failure)
+
+    def test_concurrent_with_timeout(self):
+        self.flag('hang', 'slow')
+        self.flag('fail', 'broken')
+        start = time.time()
+        failures = instances.reload_instances([
+            self.instance('a'), self.instance('slow', timeout=1.0),
+            self.instance('broken'), self.instance('b')])
+        # The slow instance is killed after its timeout and does not hold
+        # up the others.
+        self.assertLess(time.time() - start, 10)
+        self.assertIsNone(failures[0])
+        self.assertIn("configuration test of slow timed out", failures[1])
+        self.assertIn("configuration test of broken failed", failures[2])
+        self.assertIsNone(failures[3])
+        self.assertEqual(self.calls(), [
+            '-c -f a.cfg', '-c -f b.cfg', '-c -f broken.cfg', '-c -f slow.cfg',
+            'restart a', 'restart b'])
+
+    def test_deploy_instances(self):
+        self.make_lineage('good.wtf')
+        self.make_lineage('bad.wtf', mismatch=True)
+        lineages = deploy.find_lineages(self.live_dir)
+        self.flag('fail', 'broken')
+        profiles = [self.instance('a'), self.instance('broken'),
+                    self.instance('b')]
+
+        with patch('certbot_haproxy.deploy.pemcheck.check_file',
+                   wraps=deploy.pemcheck.check_file) as m_check:
+            results = deploy.deploy_instances(lineages, profiles, workers=1)
+        # A combined PEM that passed is not validated again for the other
+        # instances, only the rejected one is.
+        checked = [os.path.basename(call[0][0])
+                   for call in m_check.call_args_list]
+        self.assertEqual(checked.count('good.wtf.pem'), 1)
+        self.assertEqual(checked.count('bad.wtf.pem'), 3)
+        self.assertEqual(list(results), ['a', 'broken', 'b'])
+        for name in ('a', 'b'):
+            self.assertIsNone(results[name].error)
+            self.assertEqual(results[name].result.committed, ['good.wtf.pem'])
+            self.assertEqual(list(results[name].result.rejected),
+                             ['bad.wtf.pem'])
+            self.assertTrue(results[name].result.reloaded)
+        self.assertIn("configuration test of broken failed",
+                      results['broken'].error)
+        self.assertFalse(results['broken'].result.reloaded)
+        self.calls()
+
+        # Only the instance that failed is reloaded by the next run.
+        os.remove(os.path.join(self.bin_dir, 'fail-broken'))
+        results = deploy.deploy_instances(lineages, profiles, workers=1)
+        self.assertEqual(results['broken'].result.resumed, ['good.wtf.pem'])
+        self.assertTrue(results['broken'].result.reloaded)
+        self.assertFalse(results['a'].result.reloaded)
+        self.assertEqual(self.calls(), ['-c -f broken.cfg', 'restart broken'])
+
+    def test_first_instance_fails(self):
+        self.make_lineage('good.wtf')
+        lineages = deploy.find_lineages(self.live_dir)
+        broken = self.instance('broken')
+        # The certificate directory of the first instance is a file.
+        crt_directory = os.path.join(self.directory, 'not-a-directory')
+        open(crt_directory, 'w').close()
+        broken = broken._replace(crt_directory=crt_directory)
+
+        results = deploy.deploy_instances(
+            lineages, [broken, self.instance('a'), self.instance('b')],
+            workers=1)
+        self.assertIsNone(results['broken'].result)
+        self.assertTrue(results['broken'].error)
+        for name in ('a', 'b'):
+            self.assertIsNone(results[name].error)
+            self.assertEqual(results[name].result.committed, ['good.wtf.pem'])
+            self.assertTrue(os.path.exists(os.path.join(
+                deploy.staging_directory(self.instance(name).crt_directory),
+                deploy.CACHE_FILE)))
+        self.assertEqual(self.calls(), [
+            '-c -f a.cfg', '-c -f b.cfg', 'restart a', 'restart b'])
+
+    def test_main(self):
+        self.make_lineage('good.wtf')
+        profiles = os.path.join(self.directory, 'instances.ini')
+        with open(profiles, 'w') as config:
+            config.write("[DEFAULT]\nconftest_cmd = %s -c -f\n" % self.haproxy)
+            for name in ('a', 'b'):
+                instance = self.instance(name)
+                config.write(
+                    "[%s]\nhaproxy_config = %s.cfg\ncrt_directory = %s\n"
+                    "restart_cmd = %s restart %s\n" % (
+                        name, name, instance.crt_directory, self.haproxy,
+                        name))
+        self.assertEqual(deploy.main(
+            ['--live-dir', self.live_dir, '--instances', profiles,
+             '--workers', '1']), 0)
+        self.assertEqual(len(self.calls()), 4)
+
+        self.flag('fail', 'b')
+        self.make_lineage('good.wtf')
+        self.assertEqual(deploy.main(
+            ['--live-dir', self.live_dir, '--instances', profiles,
+             '--workers', '1']), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
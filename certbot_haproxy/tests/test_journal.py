@@ -0,0 +1,90 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from certbot_haproxy import journal
+
+
+class JournalTest(unittest.TestCase):
+    """Test writing and recovering deploy journals."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'deploy.journal')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_no_journal(self):
+        self.assertEqual(journal.read_records(self.path), [])
+        self.assertIsNone(journal.recover(self.path))
+
+    def test_batched_sync(self):
+        run = journal.Journal(self.path, batch_size=3)
+        run.begin('run-1')
+        self.assertEqual(run.syncs, 1)
+        run.record('stage', 'a.pem', 'aaa')
+        run.record('stage', 'b.pem', 'bbb')
+        self.assertEqual(len(journal.read_records(self.path)), 1)
+        run.record('stage', 'c.pem', 'ccc')
+        self.assertEqual(run.syncs, 2)
+        self.assertEqual(len(journal.read_records(self.path)), 4)
+
+    def test_recover_interrupted(self):
+        run = journal.Journal(self.path)
+        run.begin('run-1')
+        run.record('stage', 'a.pem', 'aaa')
+        run.record('stage', 'b.pem', 'bbb')
+        run.record('commit', 'a.pem', 'aaa')
+        run.sync()
+        interrupted = journal.recover(self.path)
+        self.assertEqual(interrupted.run_id, 'run-1')
+        self.assertEqual(interrupted.staged, {'a.pem': 'aaa', 'b.pem': 'bbb'})
+        self.assertEqual(interrupted.committed, {'a.pem': 'aaa'})
+        self.assertFalse(interrupted.reload_started)
+
+        resumed = journal.Journal(self.path)
+        resumed.begin(interrupted.run_id)
+        resumed.record('commit', 'b.pem', 'bbb')
+        resumed.record('reload')
+        resumed.sync()
+        interrupted = journal.recover(self.path)
+        self.assertEqual(sorted(interrupted.committed), ['a.pem', 'b.pem'])
+        self.assertTrue(interrupted.reload_started)
+
+        resumed.complete()
+        self.assertIsNone(journal.recover(self.path))
+        self.assertEqual(os.path.getsize(self.path), 0)
+
+    def test_torn_end(self):
+        run = journal.Journal(self.path)
+        run.begin('run-1')
+        run.record('commit', 'a.pem', 'aaa')
+        run.sync()
+        with open(self.path, 'ab') as torn:
+            torn.write(b'{"step": "commit", "na')
+        self.assertEqual(len(journal.read_records(self.path)), 2)
+
+        resumed = journal.Journal(self.path)
+        resumed.begin('run-1')
+        resumed.record('commit', 'b.pem', 'bbb')
+        resumed.sync()
+        self.assertEqual(sorted(journal.recover(self.path).committed),
+                         ['a.pem', 'b.pem'])
+
+    def test_new_run_after_completed(self):
+        run = journal.Journal(self.path)
+        run.begin('run-1')
+        run.record('commit', 'a.pem', 'aaa')
+        run.record('done')
+        run.begin('run-2')
+        run.record('stage', 'b.pem', 'bbb')
+        run.sync()
+        interrupted = journal.recover(self.path)
+        self.assertEqual(interrupted.run_id, 'run-2')
+        self.assertEqual(interrupted.committed, {})
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,173 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+from OpenSSL import crypto
+
+from certbot_haproxy import pemcheck
+from certbot_haproxy import util
+
+
+def make_cert(subject, issuer=None, issuer_key=None, days=90, key_type='rsa'):
+    """Create a key and a certificate, self-signed unless an issuer is given."""
+    key = util.generate_key(key_type, 1024 if key_type == 'rsa' else None)
+    cert = crypto.X509()
+    cert.set_version(2)
+    cert.get_subject().commonName = subject
+    cert.set_serial_number(abs(hash(subject)))
+    cert.gmtime_adj_notBefore(-60)
+    cert.gmtime_adj_notAfter(days * 86400)
+    cert.set_pubkey(key)
+    if issuer is None:
+        cert.add_extensions([
+            crypto.X509Extension(b'basicConstraints', True, b'CA:TRUE')])
+        issuer, issuer_key = cert, key
+    cert.set_issuer(issuer.get_subject())
+    cert.sign(issuer_key, 'sha256')
+    return key, cert
+
+
+def pem(*objects):
+    """Dump keys and certificates as one PEM string."""
+    data = b''
+    for obj in objects:
+        if isinstance(obj, crypto.PKey):
+            data += crypto.dump_privatekey(crypto.FILETYPE_PEM, obj)
+        else:
+            data += crypto.dump_certificate(crypto.FILETYPE_PEM, obj)
+    return data
+
+
+class CheckPemTest(unittest.TestCase):
+    """Test the checks of a single combined PEM."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.ca_key, cls.ca = make_cert(u'Test CA')
+        cls.key, cls.cert = make_cert(u'le.wtf', cls.ca, cls.ca_key)
+        cls.other_key, _ = make_cert(u'other.wtf', cls.ca, cls.ca_key)
+
+    def test_valid(self):
+        self.assertEqual(
+            pemcheck.check_pem(pem(self.key, self.cert, self.ca)), [])
+        self.assertEqual(pemcheck.check_pem(pem(self.ca_key, self.ca)), [])
+
+    def test_key_mismatch(self):
+        problems = pemcheck.check_pem(pem(self.other_key, self.cert, self.ca))
+        self.assertEqual(problems,
+                         ["private key does not match the certificate"])
+
+    def test_chain_order(self):
+        problems = pemcheck.check_pem(pem(self.ca_key, self.ca, self.cert))
+        self.assertEqual(len(problems), 1)
+        self.assertIn("out of order", problems[0])
+
+    def test_chain_missing(self):
+        problems = pemcheck.check_pem(pem(self.key, self.cert))
+        self.assertEqual(problems,
+                         ["the chain is missing, only the certificate found"])
+
+    def test_truncated(self):
+        data = pem(self.key, self.cert, self.ca)
+        problems = pemcheck.check_pem(data[:len(data) - 100])
+        self.assertIn("unterminated PEM block, the file may be truncated",
+                      problems)
+
+    def test_no_key(self):
+        self.assertEqual(pemcheck.check_pem(pem(self.cert, self.ca)),
+                         ["expected 1 private key, found 0"])
+
+    def test_expired(self):
+        key, cert = make_cert(u'old.wtf', self.ca, self.ca_key, days=-1)
+        self.assertEqual(pemcheck.check_pem(pem(key, cert, self.ca)),
+                         ["the certificate has expired"])
+
+    def test_ca_file(self):
+        ca_file = tempfile.NamedTemporaryFile(suffix='.pem', delete=False)
+        try:
+            ca_file.write(pem(self.ca))
+            ca_file.close()
+            self.assertEqual(pemcheck.check_pem(
+                pem(self.key, self.cert, self.ca), ca_file=ca_file.name), [])
+            other_ca_key, other_ca = make_cert(u'Other CA')
+            key, cert = make_cert(u'le.wtf', other_ca, other_ca_key)
+            problems = pemcheck.check_pem(
+                pem(key, cert, other_ca), ca_file=ca_file.name)
+            self.assertEqual(len(problems), 1)
+            self.assertIn("chain does not verify", problems[0])
+        finally:
+            os.remove(ca_file.name)
+
+
+class CheckFilesTest(unittest.TestCase):
+    """Test checking many files with a cache."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        ca_key, ca = make_cert(u'Test CA')
+        self.ca = ca
+        self.paths = []
+        for index in range(4):
+            key, cert = make_cert(u'd%d.le.wtf' % index, ca, ca_key)
+            path = os.path.join(self.directory, 'd%d.pem' % index)
+            with open(path, 'wb') as pem_file:
+                pem_file.write(pem(key, cert, ca) if index else pem(key, cert))
+            self.paths.append(path)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_check_files(self):
+        cache_path = os.path.join(self.directory, 'cache.json')
+        cache = pemcheck.CheckCache(cache_path)
+        results = pemcheck.check_files(
+            self.paths, cache=cache, workers=2, chunk_size=1)
+        self.assertEqual([bool(result.problems) for result in results],
+                         [True, False, False, False])
+        self.assertEqual(len(cache.entries), 3)
+        cache.save()
+
+        cache = pemcheck.CheckCache(cache_path)
+        with open(self.paths[1], 'ab') as pem_file:
+            pem_file.write(b'garbage')
+        with patch('certbot_haproxy.pemcheck._check_files_chunk',
+                   side_effect=pemcheck._check_files_chunk) as m_check:
+            results = pemcheck.check_files(self.paths, cache=cache, workers=1)
+        m_check.assert_called_once_with(self.paths[:2], None)
+        self.assertEqual([result.path for result in results], self.paths)
+
+    def test_cache_by_ca_file(self):
+        cache = pemcheck.CheckCache()
+        pemcheck.check_files(self.paths[1:], cache=cache, workers=1)
+        self.assertEqual(len(cache.entries), 3)
+
+        # A pass recorded without a CA file does not vouch for the chain.
+        unused_key, other_ca = make_cert(u'Other CA')
+        ca_file = os.path.join(self.directory, 'other-ca.pem')
+        with open(ca_file, 'wb') as roots:
+            roots.write(pem(other_ca))
+        results = pemcheck.check_files(
+            self.paths[1:], ca_file=ca_file, cache=cache, workers=1)
+        for result in results:
+            self.assertIn("chain does not verify", result.problems[0])
+        self.assertEqual(len(cache.entries), 3)
+
+    def test_ca_file_read_once(self):
+        ca_file = os.path.join(self.directory, 'ca.pem')
+        with open(ca_file, 'wb') as roots:
+            roots.write(pem(self.ca))
+        cache = pemcheck.CheckCache()
+        with patch('certbot_haproxy.pemcheck.ca_digest',
+                   side_effect=pemcheck.ca_digest) as m_ca_digest:
+            results = pemcheck.check_files(
+                self.paths[1:], ca_file=ca_file, cache=cache, workers=1)
+            pemcheck.check_files(
+                self.paths[1:], ca_file=ca_file, cache=cache, workers=1)
+        self.assertEqual([result.problems for result in results], [[]] * 3)
+        self.assertEqual(m_ca_digest.call_count, 2)
+
+
+if __name__ == '__main__':
+    unittest.main()
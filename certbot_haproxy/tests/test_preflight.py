@@ -0,0 +1,62 @@
+import unittest
+
+from acme import challenges
+
+from certbot_haproxy import preflight
+from certbot_haproxy import server
+from certbot_haproxy.tokenstore import TokenStore
+
+
+class PreflightTest(unittest.TestCase):
+    """Test probing domains through a (fake) HAProxy."""
+
+    def setUp(self):
+        self.store = TokenStore()
+        self.manager = server.ServerManager({}, self.store)
+        servers = self.manager.run(0, challenges.HTTP01, listenaddr='127.0.0.1')
+        self.port = servers.getsocknames()[0][1]
+        # Stand-in for HAProxy: requests go straight to the responder.
+        self.address = '127.0.0.1:%d' % self.port
+
+    def tearDown(self):
+        self.manager.stop(self.port)
+
+    def test_parse_address(self):
+        self.assertEqual(preflight.parse_address('127.0.0.1:8080'),
+                         ('127.0.0.1', 8080))
+        self.assertEqual(preflight.parse_address('[::1]:80'), ('::1', 80))
+        self.assertEqual(preflight.parse_address('localhost'),
+                         ('localhost', 80))
+
+    def test_check_routing(self):
+        results = preflight.check_routing(
+            ['le.wtf', 'www.le.wtf'], self.store, address=self.address)
+        self.assertEqual([result.ok for result in results], [True, True])
+        self.assertEqual([result.domain for result in results],
+                         ['le.wtf', 'www.le.wtf'])
+        # The canary is removed again.
+        self.assertEqual(len(self.store), 0)
+
+    def test_wrong_response(self):
+        result = preflight.probe('le.wtf', 'token', b'body', self.address)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 404)
+
+    def test_not_ready(self):
+        self.store.add('token', b'other')
+        result = preflight.probe('le.wtf', 'token', b'body', self.address)
+        self.assertFalse(result.ok)
+        self.assertEqual(result.status, 200)
+
+    def test_connection_refused(self):
+        self.manager.stop(self.port)
+        result = preflight.probe('le.wtf', 'token', b'body', self.address)
+        self.assertFalse(result.ok)
+        self.assertIsNone(result.status)
+        servers = self.manager.run(0, challenges.HTTP01,
+                                   listenaddr='127.0.0.1')
+        self.port = servers.getsocknames()[0][1]
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+from certbot_haproxy import profiling
+
+
+@profiling.profiled('outer')
+def outer(value):
+    return [inner(value) for _ in range(10)]
+
+
+@profiling.profiled('inner')
+def inner(value):
+    return value * 2
+
+
+class ProfilingTest(unittest.TestCase):
+    """Test the sampled profiling hooks."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.env = mock.patch.dict(os.environ, clear=False)
+        self.env.start()
+        for name in (profiling.ENV_DIR, profiling.ENV_RATE):
+            os.environ.pop(name, None)
+
+    def tearDown(self):
+        self.env.stop()
+        shutil.rmtree(self.directory)
+        profiling._settings.directory = None
+        profiling._settings.rate = None
+        profiling._settings.sampled = None
+
+    def test_inactive_by_default(self):
+        profiling.configure()
+        self.assertFalse(profiling.active())
+        self.assertEqual(outer(1), [2] * 10)
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_reports(self):
+        profiling.configure(self.directory, 1.0)
+        self.assertEqual(outer(1), [2] * 10)
+        files = sorted(os.listdir(self.directory))
+        self.assertEqual(len(files), 2)
+        self.assertTrue(files[0].endswith('-outer.alloc.txt'))
+        self.assertTrue(files[1].endswith('-outer.pstats'))
+        with open(os.path.join(self.directory, files[0])) as report:
+            self.assertTrue(report.read().startswith('outer: '))
+
+    def test_environment(self):
+        os.environ[profiling.ENV_DIR] = self.directory
+        profiling.configure()
+        inner(1)
+        inner(2)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_sampled_out(self):
+        profiling.configure(self.directory, 0.0)
+        outer(1)
+        self.assertFalse(profiling.active())
+        self.assertEqual(os.listdir(self.directory), [])
+
+    def test_exception_still_reported(self):
+        @profiling.profiled('failing')
+        def failing():
+            raise ValueError('failed')
+
+        profiling.configure(self.directory, 1.0)
+        self.assertRaises(ValueError, failing)
+        self.assertEqual(len(os.listdir(self.directory)), 2)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,166 @@
+import collections
+import datetime
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from certbot_haproxy import renewalplanner
+from certbot_haproxy.renewalplanner import Renewal
+
+NOW = datetime.datetime(2020, 1, 1, 0, 30)
+
+
+def wave(count, expires, prefix='c'):
+    """Expiries of `count` lineages issued in one bulk wave."""
+    return dict(('%s%03d' % (prefix, index), expires)
+                for index in range(count))
+
+
+class PlanTest(unittest.TestCase):
+    """Test assigning renewal slots."""
+
+    def test_wave_is_spread(self):
+        expires = datetime.datetime(2020, 3, 1, 12)
+        renewals = renewalplanner.plan(wave(50, expires), now=NOW, budget=4)
+        load = collections.Counter(renewal.slot for renewal in renewals)
+        self.assertEqual(max(load.values()), 4)
+        self.assertEqual(len(load), 13)
+        deadline = expires - datetime.timedelta(days=30)
+        # As late as possible: the slot of the deadline and the ones before.
+        self.assertEqual(max(load), datetime.datetime(2020, 1, 31, 12))
+        self.assertEqual(min(load), datetime.datetime(2020, 1, 31))
+        for renewal in renewals:
+            self.assertEqual(renewal.deadline, deadline)
+            self.assertFalse(renewalplanner.is_late(renewal))
+
+    def test_max_early_days(self):
+        expiries = wave(5, datetime.datetime(2020, 1, 31, 5))
+        renewals = renewalplanner.plan(
+            expiries, now=NOW, budget=1, max_early_days=2 / 24.0)
+        # Three fit in the window of two hours before the deadline, the
+        # others are renewed earlier rather than late.
+        self.assertEqual(
+            [renewal.slot for renewal in renewals],
+            [datetime.datetime(2020, 1, 1, hour) for hour in range(1, 6)])
+        self.assertFalse(any(renewalplanner.is_late(renewal)
+                             for renewal in renewals))
+
+    def test_overdue_and_overflow(self):
+        expiries = wave(3, datetime.datetime(2020, 1, 15), 'overdue')
+        expiries.update(wave(5, datetime.datetime(2020, 1, 31, 3), 'full'))
+        renewals = renewalplanner.plan(
+            expiries, now=NOW, budget=2, max_early_days=0)
+        slots = dict((renewal.lineage, renewal.slot) for renewal in renewals)
+        # Overdue lineages are renewed first thing.
+        for name in ('overdue000', 'overdue001'):
+            self.assertEqual(slots[name], datetime.datetime(2020, 1, 1, 1))
+        self.assertEqual(slots['overdue002'], datetime.datetime(2020, 1, 1, 2))
+        # Without early renewal 2 of the wave fit in their window, 1 fits in
+        # an earlier slot and 2 are late, as are the overdue ones.
+        late = [renewal.lineage for renewal in renewals
+                if renewalplanner.is_late(renewal)]
+        self.assertEqual(len(late), 5)
+        self.assertEqual(len([name for name in late
+                              if name.startswith('overdue')]), 3)
+        load = collections.Counter(slots.values())
+        self.assertEqual(max(load.values()), 2)
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, renewalplanner.plan, {}, now=NOW,
+                          budget=0)
+        self.assertEqual(renewalplanner.plan({}, now=NOW), [])
+
+
+class SimulateTest(unittest.TestCase):
+    """Test the load simulation."""
+
+    def test_certbot_times(self):
+        expiries = {
+            'a': datetime.datetime(2020, 3, 1, 12),
+            'b': datetime.datetime(2020, 3, 1, 1),
+            'c': datetime.datetime(2020, 1, 2),
+        }
+        times = renewalplanner.certbot_times(expiries, now=NOW, run_hour=2)
+        self.assertEqual(times['a'], datetime.datetime(2020, 2, 1, 2))
+        self.assertEqual(times['b'], datetime.datetime(2020, 1, 31, 2))
+        self.assertEqual(times['c'], datetime.datetime(2020, 1, 1, 2))
+
+    def test_simulate(self):
+        times = [datetime.datetime(2020, 1, 1, 2, minute)
+                 for minute in range(3)]
+        times.append(datetime.datetime(2020, 1, 2, 2))
+        result = renewalplanner.simulate(
+            times, renewal_cpu_seconds=1, reload_cpu_seconds=10)
+        self.assertEqual(result['renewals'], 4)
+        self.assertEqual(result['reloads'], 2)
+        self.assertEqual(result['peak_renewals'], 3)
+        self.assertEqual(result['mean_renewals'], 2)
+        self.assertEqual(result['peak_cpu_seconds'], 13)
+        self.assertEqual(result['busiest'][0], ['2020-01-01T02:00:00Z', 3])
+        self.assertEqual(renewalplanner.simulate([])['peak_renewals'], 0)
+
+    def test_summarise(self):
+        deadline = datetime.datetime(2020, 2, 1)
+        renewals = [
+            Renewal('a', None, deadline, deadline),
+            Renewal('b', None, deadline, deadline - datetime.timedelta(2)),
+            Renewal('c', None, deadline, deadline + datetime.timedelta(1)),
+        ]
+        self.assertEqual(renewalplanner.summarise(renewals), {
+            'lineages': 3, 'late': 1, 'mean_early_days': 1.0,
+            'max_early_days': 2.0})
+
+
+class ScheduleTest(unittest.TestCase):
+    """Test writing schedules and finding due lineages."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'schedule.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip_and_due(self):
+        expiries = {
+            'a': datetime.datetime(2020, 1, 31, 3),
+            'b': datetime.datetime(2020, 3, 1),
+        }
+        renewals = renewalplanner.plan(expiries, now=NOW)
+        renewalplanner.write_schedule(self.path, renewals)
+        self.assertEqual(renewalplanner.read_schedule(self.path), renewals)
+
+        self.assertEqual(renewalplanner.due(renewals, expiries, now=NOW), [])
+        later = datetime.datetime(2020, 1, 1, 5)
+        self.assertEqual(renewalplanner.due(renewals, expiries, now=later),
+                         ['a'])
+        renewed = dict(expiries, a=datetime.datetime(2020, 3, 31))
+        self.assertEqual(renewalplanner.due(renewals, renewed, now=later), [])
+
+    @patch('certbot_haproxy.renewalplanner.read_expiries')
+    def test_main(self, m_read_expiries):
+        m_read_expiries.return_value = wave(
+            30, datetime.datetime.utcnow() + datetime.timedelta(days=45))
+        with patch('sys.stdout') as m_stdout:
+            self.assertEqual(renewalplanner.main(
+                ['--live-dir', self.directory, '--budget', '5',
+                 '--output', self.path]), 0)
+        output = json.loads(''.join(
+            call[0][0] for call in m_stdout.write.call_args_list))
+        self.assertEqual(output['simulation']['certbot']['peak_renewals'], 30)
+        self.assertEqual(output['simulation']['planned']['peak_renewals'], 5)
+        self.assertEqual(output['summary']['late'], 0)
+        self.assertEqual(len(renewalplanner.read_schedule(self.path)), 30)
+
+        with patch('sys.stdout') as m_stdout:
+            self.assertEqual(renewalplanner.main(
+                ['--live-dir', self.directory, '--due', self.path]), 0)
+        self.assertEqual(m_stdout.write.call_count, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,205 @@
+import asyncio
+import os
+import shutil
+import socketserver
+import tempfile
+import threading
+import time
+import unittest
+
+from mock import patch
+
+from certbot_haproxy import runtime
+
+
+class FakeRuntimeHandler(socketserver.StreamRequestHandler):
+    """Answers runtime API commands like HAProxy does."""
+
+    def handle(self):
+        prompt = False
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line.decode('utf-8').strip()
+            if self.server.delay:
+                time.sleep(self.server.delay)
+            if command == 'quit':
+                return
+            if command == 'prompt':
+                prompt = not prompt
+                output = ''
+            else:
+                output = self.server.answer(command)
+            if prompt:
+                self.wfile.write((output + '\n> ').encode('utf-8'))
+            else:
+                self.wfile.write(output.encode('utf-8'))
+                return
+
+
+class FakeRuntimeServer(socketserver.ThreadingMixIn,
+                        socketserver.UnixStreamServer):
+    """
+        Fake HAProxy runtime API on a UNIX socket, supporting ``show info``
+        and the map commands, with an optional delay per command.
+    """
+    daemon_threads = True
+
+    def __init__(self, path, delay=0):
+        socketserver.UnixStreamServer.__init__(self, path, FakeRuntimeHandler)
+        self.delay = delay
+        self.maps = {}
+        self.commands = []
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """Stop serving."""
+        self.shutdown()
+        self.server_close()
+
+    def answer(self, command):
+        """Output of a command."""
+        self.commands.append(command)
+        words = command.split()
+        if command == 'show info':
+            return 'Name: HAProxy\nVersion: 2.8.0\nNbthread: 4\n'
+        if words[:2] == ['show', 'map'] and len(words) == 3:
+            entries = self.maps.get(words[2])
+            if entries is None:
+                return 'Unknown map identifier. Please use #<id> or <file>.\n'
+            return ''.join('0x%x %s %s\n' % (index, key, value)
+                           for index, (key, value) in enumerate(
+                               sorted(entries.items())))
+        if words[:2] in (['set', 'map'], ['add', 'map']) and len(words) == 5:
+            entries = self.maps.setdefault(words[2], {})
+            if words[0] == 'set' and words[3] not in entries:
+                return 'entry not found.\n'
+            entries[words[3]] = words[4]
+            return ''
+        if words[:2] == ['del', 'map'] and len(words) == 4:
+            self.maps.get(words[2], {}).pop(words[3], None)
+            return ''
+        return 'Unknown command. Please enter one of the following commands.\n'
+
+
+class RuntimeClientTest(unittest.TestCase):
+    """Test the synchronous and asyncio clients against a fake HAProxy."""
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'admin.sock')
+        self.server = FakeRuntimeServer(self.path)
+        self.server.maps['hosts.map'] = {'le.wtf': 'nodes'}
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_parse_address(self):
+        self.assertEqual(runtime.parse_address('/run/admin.sock')[1],
+                         '/run/admin.sock')
+        self.assertEqual(runtime.parse_address('ipv4@127.0.0.1:9999')[1],
+                         ('127.0.0.1', 9999))
+
+    def test_execute(self):
+        with runtime.RuntimeClient(self.path) as client:
+            response = client.execute('show info')
+            self.assertTrue(response.ok)
+            self.assertEqual(response.as_dict()['Version'], '2.8.0')
+            self.assertFalse(client.execute('bogus').ok)
+            # HAProxy reports a missing key in lower case.
+            response = client.execute('set map hosts.map missing.wtf nodes')
+            self.assertEqual(response.text.strip(), 'entry not found.')
+            self.assertFalse(response.ok)
+            self.assertTrue(client.execute('set map hosts.map le.wtf x').ok)
+
+    def test_response_ok(self):
+        for text in ('entry not found.\n', 'Key not found.', 'UNKNOWN command',
+                     'Frontend not found.', "  can't find the server"):
+            self.assertFalse(runtime.Response('x', text, 0).ok, text)
+        for text in ('', '\n', '0x1 le.wtf nodes\n', 'Name: HAProxy\n'):
+            self.assertTrue(runtime.Response('x', text, 0).ok, text)
+
+    def test_execute_many(self):
+        commands = ['add map hosts.map d%d.wtf nodes' % i for i in range(150)]
+        with runtime.RuntimeClient(self.path, max_batch=64) as client:
+            responses = client.execute_many(commands + ['show map hosts.map'])
+            self.assertEqual(len(responses), 151)
+            self.assertTrue(all(response.ok for response in responses))
+            self.assertEqual(len(responses[-1].as_map()), 151)
+            self.assertEqual(client.metrics.summary()['add map']['count'], 150)
+        # One connection: a single prompt command.
+        self.assertEqual(len(self.server.commands), 151)
+
+    def test_pool_reuses_connections(self):
+        client = runtime.RuntimeClient(self.path, pool_size=2)
+        threads = [
+            threading.Thread(target=client.execute_many,
+                             args=(['show info'] * 10,))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(client._pool.qsize(), 2)
+        client.close()
+
+    def test_connection_error(self):
+        self.server.stop()
+        os.remove(self.path)
+        client = runtime.RuntimeClient(self.path)
+        self.assertRaises(runtime.RuntimeAPIError, client.execute, 'show info')
+
+    def test_failed_command_releases_connection(self):
+        client = runtime.RuntimeClient(self.path, pool_size=1, timeout=2)
+        self.assertRaises(ValueError, client.execute, 'set map a b\nc')
+        # Interrupted in the middle of a batch: the connection is not reused,
+        # its slot is.
+        with patch('certbot_haproxy.runtime.Response',
+                   side_effect=KeyboardInterrupt):
+            self.assertRaises(KeyboardInterrupt, client.execute, 'show info')
+        self.assertEqual(client._pool.qsize(), 0)
+        self.assertTrue(client.execute('show info').ok)
+        client.close()
+
+    def test_async_cancel_releases_connection(self):
+        async def _run():
+            client = runtime.AsyncRuntimeClient(self.path, pool_size=1)
+            with self.assertRaises(ValueError):
+                await client.execute('set map a b\nc')
+            await client.execute('show info')
+            _, writer = client._idle[0]
+            self.server.delay = 2
+            task = asyncio.ensure_future(client.execute('show info'))
+            await asyncio.sleep(0.2)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+            self.assertEqual(client._idle, [])
+            self.assertTrue(writer.is_closing())
+            self.server.delay = 0
+            response = await asyncio.wait_for(client.execute('show info'), 2)
+            await client.close()
+            return response
+        self.assertTrue(asyncio.run(_run()).ok)
+
+    def test_async(self):
+        async def _run():
+            async with runtime.AsyncRuntimeClient(self.path) as client:
+                results = await asyncio.gather(
+                    client.execute('show info'),
+                    client.execute_many(['show map hosts.map'] * 3),
+                )
+            return results, client.metrics.summary()
+        (info, maps), summary = asyncio.run(_run())
+        self.assertEqual(info.as_dict()['Name'], 'HAProxy')
+        self.assertEqual(maps[0].as_map(), {'le.wtf': 'nodes'})
+        self.assertEqual(summary['show map']['count'], 3)
+
+
+if __name__ == '__main__':
+    unittest.main()
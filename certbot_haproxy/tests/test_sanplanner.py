@@ -0,0 +1,165 @@
+import datetime
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+from mock import patch
+
+from certbot_haproxy import sanplanner
+from certbot_haproxy import util
+from certbot_haproxy.haproxycfg import DomainACL
+from certbot_haproxy.sanplanner import Domain
+
+
+class PlanTest(unittest.TestCase):
+    """Test grouping domains into multi-SAN certificates."""
+
+    def test_registered_domains_stay_together(self):
+        domains = [
+            Domain(name, 'nodes', None, None) for name in (
+                'a.one.com', 'b.one.com', 'c.one.com',
+                'a.two.com', 'b.two.com', 'three.com',
+            )
+        ]
+        certificates = sanplanner.plan(domains, max_sans=3)
+        self.assertEqual(
+            [certificate.domains for certificate in certificates],
+            [['a.one.com', 'b.one.com', 'c.one.com'],
+             ['a.two.com', 'b.two.com', 'three.com']]
+        )
+        self.assertEqual(certificates[0].name, 'nodes-001')
+        self.assertEqual(certificates[0].affinity, {'backend': 'nodes'})
+
+    def test_max_sans(self):
+        domains = [Domain('d%d.example.com' % i, None, None, None)
+                   for i in range(250)]
+        certificates = sanplanner.plan(domains, affinities=())
+        self.assertEqual(
+            [len(certificate.domains) for certificate in certificates],
+            [100, 100, 50]
+        )
+        self.assertRaises(ValueError, sanplanner.plan, domains, 101)
+
+    def test_affinities(self):
+        early = datetime.datetime(2020, 1, 2)
+        late = datetime.datetime(2020, 6, 1)
+        domains = [
+            Domain('a.com', 'one', 'alice', early),
+            Domain('b.com', 'one', 'alice', late),
+            Domain('c.com', 'one', 'bob', early),
+            Domain('d.com', 'two', 'alice', None),
+        ]
+        certificates = sanplanner.plan(
+            domains, affinities=('backend', 'customer', 'expiry'))
+        self.assertEqual(
+            sorted(certificate.domains for certificate in certificates),
+            [['a.com'], ['b.com'], ['c.com'], ['d.com']]
+        )
+        certificates = sanplanner.plan(domains, affinities=('customer',))
+        self.assertEqual(
+            [certificate.domains for certificate in certificates],
+            [['a.com', 'b.com', 'd.com'], ['c.com']]
+        )
+
+    def test_unique_names(self):
+        domains = [Domain('a.com', 'web_1', None, None),
+                   Domain('b.com', 'web-1', None, None),
+                   Domain('c.com', 'web.1', None, None)]
+        names = [certificate.name for certificate in sanplanner.plan(domains)]
+        self.assertEqual(sorted(names),
+                         ['web-1-001', 'web-1-2-001', 'web.1-001'])
+        domains.append(Domain('d.com', 'WEB-1', None, None))
+        names = [certificate.name for certificate in sanplanner.plan(domains)]
+        self.assertEqual(len(set(names)), 4)
+
+    def test_estimate(self):
+        certificates = sanplanner.plan(
+            [Domain('d%d.com' % i, None, None, None) for i in range(1000)])
+        result = sanplanner.estimate(
+            1000, certificates, cert_memory_kib=1024, cert_load_ms=10,
+            san_memory_bytes=0)
+        self.assertEqual(result['after']['certificates'], 10)
+        self.assertEqual(result['saved_memory_mib'], 990.0)
+        self.assertEqual(result['saved_load_seconds'], 9.9)
+
+
+class CollectDomainsTest(unittest.TestCase):
+    """Test merging domains from configurations and lineages."""
+
+    def setUp(self):
+        self.live_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.live_dir)
+
+    def test_collect(self):
+        os.mkdir(os.path.join(self.live_dir, 'b.example.com'))
+        _, cert = util.create_self_signed_cert(
+            bits=1024, commonName=u'b.example.com')
+        with open(os.path.join(
+                self.live_dir, 'b.example.com', 'cert.pem'), 'wb') as pem:
+            pem.write(cert)
+        lineages = sanplanner.read_lineages(self.live_dir)
+        acls = [DomainACL('http-in', 'a', 'a.example.com', 'nodes', 1)]
+        domains = sanplanner.collect_domains(
+            acls, lineages, {'example.com': 'alice'})
+        self.assertEqual([d.name for d in domains],
+                         ['a.example.com', 'b.example.com'])
+        self.assertEqual(domains[0].backend, 'nodes')
+        self.assertIsNone(domains[0].not_after)
+        self.assertIsNone(domains[1].backend)
+        self.assertIsInstance(domains[1].not_after, datetime.datetime)
+        self.assertEqual(domains[1].customer, 'alice')
+
+    @patch('certbot_haproxy.sanplanner.print')
+    def test_main(self, m_print):
+        config = os.path.join(self.live_dir, 'haproxy.cfg')
+        with open(config, 'w') as config_file:
+            config_file.write(
+                "frontend http-in\n"
+                "    acl a hdr(host) -i aa.example.com\n"
+                "    acl b hdr(host) -i bb.example.com\n"
+                "    use_backend nodes if a or b\n"
+            )
+        self.assertEqual(sanplanner.main(['--haproxy-config', config]), 0)
+        output = json.loads(m_print.call_args[0][0])
+        self.assertEqual(output['certificates'][0]['domains'],
+                         ['aa.example.com', 'bb.example.com'])
+        self.assertEqual(output['estimate']['before']['certificates'], 2)
+        self.assertEqual(output['estimate']['after']['certificates'], 1)
+
+        m_print.reset_mock()
+        self.assertEqual(sanplanner.main(
+            ['--haproxy-config', config, '--format', 'commands']), 0)
+        self.assertEqual(
+            m_print.call_args_list[0][0][0],
+            'certbot certonly --cert-name nodes-001 --domains'
+            ' aa.example.com,bb.example.com')
+        # The estimate goes to stderr, so stdout stays a script.
+        estimate, kwargs = m_print.call_args_list[-1]
+        self.assertIs(kwargs['file'], sys.stderr)
+        self.assertEqual(
+            json.loads(estimate[0])['estimate']['after']['certificates'], 1)
+
+    @patch('certbot_haproxy.sanplanner.print')
+    @patch('certbot_haproxy.sanplanner.read_lineages')
+    def test_main_wildcards(self, m_read_lineages, m_print):
+        m_read_lineages.return_value = {
+            'example.com': (['example.com', '*.example.com'],
+                            datetime.datetime(2020, 1, 1)),
+        }
+        self.assertEqual(sanplanner.main(
+            ['--live-dir', self.live_dir, '--format', 'commands']), 0)
+        self.assertEqual(
+            m_print.call_args_list[0][0][0],
+            'certbot certonly --cert-name none-001 --domains example.com')
+        self.assertEqual(
+            json.loads(m_print.call_args_list[-1][0][0])['wildcards'],
+            ['*.example.com'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,115 @@
+import hashlib
+import socket
+import ssl
+import unittest
+
+import mock
+from cryptography import x509
+from cryptography.hazmat.primitives.asymmetric import ec
+from OpenSSL import crypto
+
+from acme import challenges
+
+from certbot_haproxy import server
+from certbot_haproxy import tlsalpn
+from certbot_haproxy.tokenstore import TokenStore
+
+ACME_IDENTIFIER_OID = x509.ObjectIdentifier('1.3.6.1.5.5.7.1.31')
+
+
+class GenerateCertTest(unittest.TestCase):
+    """Test the generation of tls-alpn-01 challenge certificates."""
+
+    def test_generate_cert(self):
+        key, cert = tlsalpn.generate_cert('le.wtf', u'token.thumbprint')
+        cert = cert.to_cryptography()
+        self.assertIsInstance(key.to_cryptography_key(), ec.EllipticCurvePrivateKey)
+        self.assertEqual(
+            cert.extensions.get_extension_for_class(
+                x509.SubjectAlternativeName).value.get_values_for_type(
+                    x509.DNSName),
+            ['le.wtf'])
+        identifier = cert.extensions.get_extension_for_oid(ACME_IDENTIFIER_OID)
+        self.assertTrue(identifier.critical)
+        self.assertEqual(
+            identifier.value.value,
+            b'\x04\x20' + hashlib.sha256(b'token.thumbprint').digest())
+
+    def test_generate_cert_rsa(self):
+        key, _ = tlsalpn.generate_cert('le.wtf', b'token.thumbprint',
+                                       key_type='rsa')
+        self.assertEqual(key.type(), crypto.TYPE_RSA)
+
+
+class ChallengeCertificatesTest(unittest.TestCase):
+    """Test serving and caching of challenge certificates."""
+
+    def setUp(self):
+        self.generate = mock.MagicMock(side_effect=tlsalpn.generate_cert)
+        self.certificates = tlsalpn.ChallengeCertificates(
+            generate=self.generate)
+
+    def test_add_context(self):
+        self.certificates.add('LE.wtf', 'token.thumbprint')
+        self.assertTrue('le.wtf' in self.certificates)
+        self.assertIsNotNone(self.certificates.context(b'le.wtf'))
+        self.assertIsNone(self.certificates.context(b'other.wtf'))
+        self.assertIsNone(self.certificates.context(None))
+
+    def test_cached_for_order(self):
+        first = self.certificates.add('le.wtf', 'token.thumbprint')
+        self.certificates.discard('le.wtf')
+        self.assertEqual(len(self.certificates), 0)
+        self.assertIsNone(self.certificates.context('le.wtf'))
+        self.assertIs(self.certificates.add('le.wtf', 'token.thumbprint'),
+                      first)
+        self.assertEqual(self.generate.call_count, 1)
+        self.assertIsNot(self.certificates.add('le.wtf', 'other.thumbprint'),
+                         first)
+        self.certificates.clear()
+        self.certificates.add('le.wtf', 'token.thumbprint')
+        self.assertEqual(self.generate.call_count, 3)
+
+
+class TLSALPN01ServerTest(unittest.TestCase):
+    """Test the tls-alpn-01 responder on an ephemeral port."""
+
+    def setUp(self):
+        self.certificates = tlsalpn.ChallengeCertificates()
+        self.cert = self.certificates.add('le.wtf', 'token.thumbprint')
+        self.manager = server.ServerManager(self.certificates, TokenStore())
+        servers = self.manager.run(0, challenges.TLSALPN01,
+                                   listenaddr='127.0.0.1')
+        self.port = servers.getsocknames()[0][1]
+
+    def tearDown(self):
+        for port in list(self.manager.running()):
+            self.manager.stop(port)
+
+    def _handshake(self, server_name, protocols):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+        context.set_alpn_protocols(protocols)
+        sock = socket.create_connection(('127.0.0.1', self.port), timeout=5)
+        with context.wrap_socket(sock, server_hostname=server_name) as tls:
+            return (tls.selected_alpn_protocol(),
+                    tls.getpeercert(binary_form=True))
+
+    def test_handshake(self):
+        protocol, der = self._handshake('le.wtf', ['acme-tls/1'])
+        self.assertEqual(protocol, 'acme-tls/1')
+        self.assertEqual(
+            der, crypto.dump_certificate(crypto.FILETYPE_ASN1, self.cert))
+
+    def test_no_acme_tls_1(self):
+        self.assertRaises((ssl.SSLError, socket.error), self._handshake,
+                          'le.wtf', ['http/1.1'])
+
+    def test_unknown_server_name(self):
+        self.assertRaises((ssl.SSLError, socket.error), self._handshake,
+                          'other.wtf', ['acme-tls/1'])
+
+
+if __name__ == '__main__':
+    unittest.main()  # pragma: no cover
@@ -0,0 +1,112 @@
+import unittest
+from future.moves.urllib.request import urlopen, Request
+from future.moves.urllib.error import HTTPError
+
+from acme import challenges
+
+from certbot_haproxy import server
+from certbot_haproxy.tokenstore import TokenStore, HTTP01_PATH_PREFIX
+
+
+class FakeClock(object):
+    """Manually advanced clock."""
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenStoreTest(unittest.TestCase):
+    """Test lookup and expiry of the challenge token store."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.store = TokenStore(ttl=60, clock=self.clock)
+
+    def test_add_get(self):
+        self.store.add('token', u'token.thumbprint')
+        self.assertEqual(self.store.get('token'), b'token.thumbprint')
+        self.assertEqual(
+            self.store.get_path(HTTP01_PATH_PREFIX + 'token'),
+            b'token.thumbprint'
+        )
+        self.assertIsNone(self.store.get_path('/token'))
+        self.assertIsNone(self.store.get('unknown'))
+        self.assertTrue('token' in self.store)
+        self.assertEqual(len(self.store), 1)
+
+    def test_discard(self):
+        self.store.add('token', b'body')
+        self.store.discard('token')
+        self.store.discard('token')
+        self.assertIsNone(self.store.get('token'))
+        self.assertEqual(len(self.store), 0)
+
+    def test_expire(self):
+        self.store.add('short', b'body', ttl=10)
+        self.store.add('long', b'body')
+        self.clock.now += 10
+        self.assertIsNone(self.store.get('short'))
+        self.assertEqual(self.store.expire(), 1)
+        self.assertEqual(len(self.store), 1)
+        self.clock.now += 50
+        self.assertEqual(self.store.expire(), 1)
+        self.assertEqual(len(self.store), 0)
+
+    def test_replace_extends_ttl(self):
+        self.store.add('token', b'old')
+        self.clock.now += 30
+        self.store.add('token', b'new')
+        self.clock.now += 40
+        self.assertEqual(self.store.expire(), 0)
+        self.assertEqual(self.store.get('token'), b'new')
+
+
+class ServerTest(unittest.TestCase):
+    """Test that the responder serves from the token store."""
+
+    def setUp(self):
+        self.store = TokenStore()
+        self.manager = server.ServerManager({}, self.store)
+        servers = self.manager.run(0, challenges.HTTP01, listenaddr='127.0.0.1')
+        self.port = servers.getsocknames()[0][1]
+
+    def tearDown(self):
+        self.manager.stop(self.port)
+
+    def _get(self, path):
+        return urlopen('http://127.0.0.1:%d%s' % (self.port, path), timeout=5)
+
+    def test_serve_token(self):
+        self.store.add('token', b'token.thumbprint')
+        response = self._get(HTTP01_PATH_PREFIX + 'token')
+        self.assertEqual(response.read(), b'token.thumbprint')
+
+    def test_unknown_token(self):
+        with self.assertRaises(HTTPError) as context:
+            self._get(HTTP01_PATH_PREFIX + 'unknown')
+        self.assertEqual(context.exception.code, 404)
+
+    def test_health(self):
+        self.assertEqual(self._get(server.HEALTH_PATH).read(), b'alive')
+
+    def test_ready(self):
+        with self.assertRaises(HTTPError) as context:
+            self._get(server.READY_PATH)
+        self.assertEqual(context.exception.code, 503)
+        self.store.ready = True
+        self.assertEqual(self._get(server.READY_PATH).read(), b'ready')
+
+    def test_ready_head(self):
+        self.store.ready = True
+        request = Request(
+            'http://127.0.0.1:%d%s' % (self.port, server.READY_PATH),
+            method='HEAD')
+        response = urlopen(request, timeout=5)
+        self.assertEqual(response.status, 200)
+        self.assertEqual(response.read(), b'')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+"""Challenge certificates for the tls-alpn-01 challenge.
+
+For a tls-alpn-01 challenge the CA connects to port 443 of the domain and
+negotiates the ``acme-tls/1`` protocol with ALPN. The responder has to present
+a self-signed certificate for the domain that holds the SHA-256 digest of the
+key authorization in a critical acmeIdentifier extension (RFC 8737).
+
+HAProxy can send those connections to this plugin without decrypting them, by
+routing on the ALPN protocol in a TCP mode frontend::
+
+    frontend https
+        bind :443
+        mode tcp
+        tcp-request inspect-delay 5s
+        tcp-request content accept if { req.ssl_hello_type 1 }
+        use_backend certbot_tls_alpn if { req.ssl_alpn acme-tls/1 }
+        default_backend nodes_tls
+
+    backend certbot_tls_alpn
+        mode tcp
+        server certbot 127.0.0.1:8443
+
+Regular TLS traffic is not affected and the HTTP frontend on port 80, with its
+ACLs, is not involved at all.
+
+The certificates are generated when the challenges are performed, before the
+responder is reported ready, so no key is generated during a handshake. They
+are cached by domain and key authorization for as long as the order lasts, a
+challenge that is performed again reuses its certificate and TLS context.
+"""
+import hashlib
+import logging
+import threading
+from builtins import object
+
+from OpenSSL import crypto
+from OpenSSL import SSL
+
+from certbot_haproxy import util
+
+logger = logging.getLogger(__name__)  # pylint:disable=invalid-name
+
+#: The ALPN protocol of tls-alpn-01 validation requests.
+ACME_TLS_1_PROTOCOL = b"acme-tls/1"
+
+#: Key type of the challenge certificates, EC keys are much cheaper to
+#: generate than RSA keys.
+DEFAULT_KEY_TYPE = 'ec'
+
+
+def generate_cert(domain, key_authorization, key_type=DEFAULT_KEY_TYPE):
+    """
+        Generate the challenge certificate for a domain.
+
+        :param str domain: Domain that is validated.
+        :param str key_authorization: Key authorization of the challenge.
+        :param str key_type: Type of the key, one of `.util.KEY_TYPES`.
+        :returns: The key and the certificate.
+        :rtype: tuple of `OpenSSL.crypto.PKey` and `OpenSSL.crypto.X509`
+    """
+    if not isinstance(key_authorization, bytes):
+        key_authorization = key_authorization.encode('utf-8')
+    key_pem, cert_pem = util.create_self_signed_cert(
+        key_type=key_type,
+        domains=[domain],
+        acme_identifier=hashlib.sha256(key_authorization).digest(),
+        commonName=domain,
+        serialnr=1,
+    )
+    return (crypto.load_privatekey(crypto.FILETYPE_PEM, key_pem),
+            crypto.load_certificate(crypto.FILETYPE_PEM, cert_pem))
+
+
+def select_alpn(connection, offered):  # pylint:disable=unused-argument
+    """
+        ALPN callback that only accepts ``acme-tls/1``.
+
+        :param connection: The TLS connection.
+        :param list offered: Protocols offered by the client.
+        :returns: The selected protocol.
+        :raises OpenSSL.SSL.Error: When the client does not offer it, which
+            aborts the handshake before a certificate is presented.
+    """
+    if ACME_TLS_1_PROTOCOL in offered:
+        return ACME_TLS_1_PROTOCOL
+    raise SSL.Error("Client did not offer %s" % ACME_TLS_1_PROTOCOL.decode())
+
+
+def new_context(key=None, cert=None):
+    """
+        Create a server TLS context that negotiates ``acme-tls/1``.
+
+        :param key: Private key to present, if any.
+        :type key: `OpenSSL.crypto.PKey`
+        :param cert: Certificate to present, if any.
+        :type cert: `OpenSSL.crypto.X509`
+        :rtype: `OpenSSL.SSL.Context`
+    """
+    context = SSL.Context(SSL.SSLv23_METHOD)
+    context.set_options(SSL.OP_NO_SSLv2)
+    context.set_options(SSL.OP_NO_SSLv3)
+    context.set_alpn_select_callback(select_alpn)
+    if key is not None:
+        context.use_privatekey(key)
+        context.use_certificate(cert)
+    return context
+
+
+class _Entry(object):  # pylint:disable=too-few-public-methods
+    """A challenge certificate with its TLS context."""
+    __slots__ = ('key', 'cert', 'context')
+
+    def __init__(self, key, cert):
+        self.key = key
+        self.cert = cert
+        self.context = new_context(key, cert)
+
+
+class ChallengeCertificates(object):
+    """
+        The tls-alpn-01 challenge certificates that are being served.
+
+        Certificates are looked up by the server name a client sends with SNI.
+        Certificates that are no longer served stay cached by domain and key
+        authorization until `clear` is called at the end of the order.
+
+        :param str key_type: Type of the keys to generate.
+        :param generate: Certificate generator, see `generate_cert`.
+    """
+
+    def __init__(self, key_type=DEFAULT_KEY_TYPE, generate=generate_cert):
+        self.key_type = key_type
+        self._generate = generate
+        self._served = {}
+        self._cache = {}
+        self._lock = threading.Lock()
+
+    def add(self, domain, key_authorization):
+        """
+            Serve the challenge certificate for a domain.
+
+            :param str domain: Domain that is validated.
+            :param str key_authorization: Key authorization of the challenge.
+            :returns: The challenge certificate.
+            :rtype: `OpenSSL.crypto.X509`
+        """
+        domain = domain.lower()
+        cache_key = (domain, key_authorization)
+        with self._lock:
+            entry = self._cache.get(cache_key)
+        if entry is None:
+            entry = _Entry(*self._generate(
+                domain, key_authorization, key_type=self.key_type))
+        else:
+            logger.debug("Reusing the challenge certificate for %s", domain)
+        with self._lock:
+            self._cache[cache_key] = entry
+            self._served[domain] = entry
+        return entry.cert
+
+    def context(self, server_name):
+        """
+            The TLS context presenting the certificate for a server name.
+
+            :param server_name: Server name sent by the client.
+            :type server_name: bytes or str
+            :returns: The context, `None` if nothing is served for the name.
+            :rtype: `OpenSSL.SSL.Context`
+        """
+        if server_name is None:
+            return None
+        if isinstance(server_name, bytes):
+            server_name = server_name.decode('ascii', 'replace')
+        entry = self._served.get(server_name.lower())
+        return entry.context if entry is not None else None
+
+    def discard(self, domain):
+        """Stop serving the certificate for a domain, it stays cached."""
+        with self._lock:
+            self._served.pop(domain.lower(), None)
+
+    def clear(self):
+        """Forget all certificates, including the cached ones."""
+        with self._lock:
+            self._served.clear()
+            self._cache.clear()
+
+    def __len__(self):
+        return len(self._served)
+
+    def __contains__(self, domain):
+        return domain.lower() in self._served
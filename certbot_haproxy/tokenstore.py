@@ -0,0 +1,167 @@
+"""Pending challenge token store.
+
+The standalone authenticator keeps the resources it serves in a set of
+`HTTP01Resource` tuples, every request is answered by scanning that set and
+every entry holds on to the complete challenge, response and validation
+objects. That is fine for a handful of domains, but when authorizations for
+tens of thousands of names are staged at once, both the memory footprint and
+the cost of a lookup grow with the number of pending tokens.
+
+The `TokenStore` defined here maps a token directly on its pre-encoded
+response body, so a lookup is a single dictionary access and an entry costs
+little more than the two byte strings it consists of. Entries expire after a
+TTL so tokens of aborted runs do not linger in a long running responder.
+"""
+import heapq
+import threading
+import time
+from builtins import object
+
+from acme import challenges
+
+#: Path prefix under which the http-01 challenge resources are requested.
+HTTP01_PATH_PREFIX = "/" + challenges.HTTP01.URI_ROOT_PATH + "/"
+
+#: Default lifetime in seconds of a token in the store.
+DEFAULT_TTL = 3600
+
+
+class _Entry(object):  # pylint:disable=too-few-public-methods
+    """A pre-encoded response body and the time at which it expires."""
+    __slots__ = ('body', 'expires')
+
+    def __init__(self, body, expires):
+        self.body = body
+        self.expires = expires
+
+
+class TokenStore(object):
+    """
+        Store of pending challenge responses with O(1) lookup and TTL expiry.
+
+        Tokens are stored without the common path prefix, response bodies
+        are stored as `bytes` so they can be written to the socket as-is.
+        Lookups are done from the server threads, mutations from the thread
+        that performs and cleans up the challenges; mutations are serialised
+        by a lock, lookups rely on the atomicity of `dict.get`.
+
+        The `ready` attribute signals that all tokens of the batch that is
+        currently being performed are loaded, the responder reports it on
+        its readiness path.
+
+        :param int ttl: Default lifetime of a token in seconds.
+        :param callable clock: Function returning the current (monotonic)
+            time in seconds.
+    """
+    def __init__(self, ttl=DEFAULT_TTL, clock=time.monotonic):
+        self.ttl = ttl
+        self.clock = clock
+        self.ready = False
+        self._entries = {}
+        self._expiry_heap = []
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def __contains__(self, token):
+        return self.get(token) is not None
+
+    @staticmethod
+    def token_from_path(path):
+        """
+            Strip the http-01 path prefix from a request path.
+
+            :param str path: Request path, e.g.:
+                `/.well-known/acme-challenge/<token>`
+            :returns: The token or `None` if the path is not a challenge path.
+            :rtype: str
+        """
+        if path.startswith(HTTP01_PATH_PREFIX):
+            return path[len(HTTP01_PATH_PREFIX):]
+        return None
+
+    def add(self, token, body, ttl=None):
+        """
+            Add (or replace) a token.
+
+            :param str token: The challenge token (without path prefix).
+            :param body: The response body, `str` values are encoded as UTF-8.
+            :type body: bytes or str
+            :param int ttl: Lifetime of this token, defaults to `self.ttl`.
+        """
+        if not isinstance(body, bytes):
+            body = body.encode('utf-8')
+        expires = self.clock() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._entries[token] = _Entry(body, expires)
+            heapq.heappush(self._expiry_heap, (expires, token))
+
+    def get(self, token):
+        """
+            Look up the response body of a token.
+
+            :param str token: The challenge token (without path prefix).
+            :returns: Response body or `None` when the token is unknown or
+                has expired.
+            :rtype: bytes
+        """
+        entry = self._entries.get(token)
+        if entry is None or entry.expires <= self.clock():
+            return None
+        return entry.body
+
+    def get_path(self, path):
+        """
+            Look up the response body for a request path.
+
+            :param str path: Request path.
+            :returns: Response body or `None`.
+            :rtype: bytes
+        """
+        token = self.token_from_path(path)
+        if token is None:
+            return None
+        return self.get(token)
+
+    def discard(self, token):
+        """
+            Remove a token from the store if it is present.
+
+            :param str token: The challenge token (without path prefix).
+        """
+        with self._lock:
+            self._entries.pop(token, None)
+            if not self._entries:
+                del self._expiry_heap[:]
+
+    def clear(self):
+        """Remove all tokens from the store."""
+        with self._lock:
+            self._entries.clear()
+            del self._expiry_heap[:]
+
+    def expire(self):
+        """
+            Remove all tokens whose TTL has passed.
+
+            Only the expired head of the expiry heap is visited, heap items
+            belonging to tokens that were replaced or discarded in the mean
+            time are dropped on the way.
+
+            :returns: Number of tokens removed.
+            :rtype: int
+        """
+        now = self.clock()
+        removed = 0
+        with self._lock:
+            heap = self._expiry_heap
+            while heap and heap[0][0] <= now:
+                expires, token = heapq.heappop(heap)
+                entry = self._entries.get(token)
+                if entry is not None and entry.expires == expires:
+                    del self._entries[token]
+                    removed += 1
+            if not self._entries:
+                del heap[:]
+        return removed
@@ -2,10 +2,25 @@
     Utility functions.
 """
 from builtins import object
+import binascii
+import datetime
 
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.asymmetric import ec
 from OpenSSL import crypto
 import socket
 
+from certbot_haproxy.profiling import profiled
+
+#: Key types `create_self_signed_cert` can generate.
+KEY_TYPES = ('rsa', 'ec')
+
+#: EC curves by key size.
+EC_CURVES = {256: ec.SECP256R1, 384: ec.SECP384R1}
+
+#: Object identifier of the acmeIdentifier extension (RFC 8737).
+ACME_IDENTIFIER_OID = b'1.3.6.1.5.5.7.1.31'
+
 
 class MemoiseNoArgs(object):  # pylint:disable=too-few-public-methods
     """
@@ -37,13 +52,23 @@ class Memoise(object):  # pylint:disable=too-few-public-methods
         return self.memo[args]
 
 
-def create_self_signed_cert(bits=2048, **kwargs):
+@profiled('util.create_self_signed_cert')
+def create_self_signed_cert(bits=None, key_type='rsa', domains=None,
+                            acme_identifier=None, **kwargs):
     """
         Create a self-signed certificate
+
+        :param int bits: Key size, defaults to 2048 for RSA and 256 for EC
+            keys.
+        :param str key_type: Type of the key, one of `KEY_TYPES`.
+        :param list domains: Domains to put in the subjectAltName extension.
+        :param bytes acme_identifier: SHA-256 digest of a key authorization
+            to put in a critical acmeIdentifier extension, as required for
+            tls-alpn-01 challenge certificates (RFC 8737).
+        :returns: The private key and the certificate, PEM encoded.
+        :rtype: tuple
     """
-    # Generate private/public key pair
-    key = crypto.PKey()
-    key.generate_key(crypto.TYPE_RSA, bits)
+    key = generate_key(key_type, bits)
 
     # Set X.509 attributes and self-sign
     cert = crypto.X509()
@@ -61,14 +86,115 @@ def create_self_signed_cert(bits=2048, **kwargs):
     for attribute, default in attributes.items():
         subject.__setattr__(attribute, kwargs.pop(attribute, default))
 
+    cert.set_version(2)
     cert.set_serial_number(kwargs.pop('serialnr', 1984))
     cert.gmtime_adj_notBefore(0)
     cert.gmtime_adj_notAfter(315360000)  # 10*365*24*60*60
     cert.set_issuer(cert.get_subject())
     cert.set_pubkey(key)
+
+    extensions = []
+    if domains:
+        extensions.append(crypto.X509Extension(
+            b'subjectAltName', False,
+            b', '.join(b'DNS:' + domain.encode('ascii') for domain in domains)
+        ))
+    if acme_identifier is not None:
+        extensions.append(acme_identifier_extension(acme_identifier))
+    if extensions:
+        cert.add_extensions(extensions)
     cert.sign(key, 'sha256')
 
     return (
         crypto.dump_privatekey(crypto.FILETYPE_PEM, key),
         crypto.dump_certificate(crypto.FILETYPE_PEM, cert)
     )
+
+
+def generate_key(key_type='rsa', bits=None):
+    """
+        Generate a private key.
+
+        :param str key_type: Type of the key, one of `KEY_TYPES`.
+        :param int bits: Key size, defaults to 2048 for RSA and 256 for EC
+            keys. EC keys support the sizes in `EC_CURVES`.
+        :rtype: `OpenSSL.crypto.PKey`
+        :raises ValueError: For unsupported key types and sizes.
+    """
+    if key_type == 'rsa':
+        key = crypto.PKey()
+        key.generate_key(crypto.TYPE_RSA, bits or 2048)
+        return key
+    if key_type == 'ec':
+        try:
+            curve = EC_CURVES[bits or 256]
+        except KeyError:
+            raise ValueError("Unsupported EC key size: %s" % bits)
+        return crypto.PKey.from_cryptography_key(
+            ec.generate_private_key(curve(), default_backend()))
+    raise ValueError("Unsupported key type: %s" % key_type)
+
+
+def acme_identifier_extension(key_authorization_digest):
+    """
+        Build the acmeIdentifier extension of a tls-alpn-01 certificate.
+
+        :param bytes key_authorization_digest: SHA-256 digest of the key
+            authorization.
+        :returns: A critical extension holding the digest as a DER encoded
+            OCTET STRING.
+        :rtype: `OpenSSL.crypto.X509Extension`
+    """
+    if len(key_authorization_digest) != 32:
+        raise ValueError("Expected a SHA-256 digest")
+    hex_digest = binascii.hexlify(key_authorization_digest).upper()
+    value = b'DER:04:20:' + b':'.join(
+        hex_digest[index:index + 2] for index in range(0, 64, 2))
+    return crypto.X509Extension(ACME_IDENTIFIER_OID, True, value)
+
+
+def certificate_domains(cert):
+    """
+        Get the domain names a certificate is valid for.
+
+        :param cert: The certificate.
+        :type cert: `OpenSSL.crypto.X509`
+        :returns: Lower-cased DNS names from the subjectAltName extension, or
+            the commonName if the certificate has no such extension.
+        :rtype: list
+    """
+    for index in range(cert.get_extension_count()):
+        extension = cert.get_extension(index)
+        if extension.get_short_name() == b'subjectAltName':
+            return [
+                name.strip()[len('DNS:'):].lower()
+                for name in str(extension).split(',')
+                if name.strip().startswith('DNS:')
+            ]
+    common_name = cert.get_subject().commonName
+    return [common_name.lower()] if common_name else []
+
+
+def certificate_not_after(cert):
+    """
+        Get the expiry date of a certificate.
+
+        :param cert: The certificate.
+        :type cert: `OpenSSL.crypto.X509`
+        :returns: Naive UTC datetime of the notAfter field.
+        :rtype: `datetime.datetime`
+    """
+    return datetime.datetime.strptime(
+        cert.get_notAfter().decode('ascii'), '%Y%m%d%H%M%SZ'
+    )
+
+
+def load_certificate_file(path):
+    """
+        Load the (first) certificate from a PEM file.
+
+        :param str path: Path to a PEM file.
+        :rtype: `OpenSSL.crypto.X509`
+    """
+    with open(path, 'rb') as pem:
+        return crypto.load_certificate(crypto.FILETYPE_PEM, pem.read())
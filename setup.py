@@ -1,10 +1,10 @@
-import sys
-
 from setuptools import setup
 from setuptools import find_packages
 
 own_version = '0.2.0'
-certbot_version = '0.8.1'
+# 0.25.0 is the first release with acme.challenges.TLSALPN01, it already has
+# acme.standalone.BaseDualNetworkedServers and --http-01-address.
+certbot_version = '0.25.0'
 
 # Please update tox.ini when modifying dependency version requirements
 install_requires = [
@@ -16,13 +16,9 @@ install_requires = [
     'zope.component',
     'zope.interface',
     'future',
+    'mock',
 ]
 
-if sys.version_info < (2, 7):
-    install_requires.append('mock<1.1.0')
-else:
-    install_requires.append('mock')
-
 docs_extras = [
     'Sphinx>=1.0',  # autodoc_member_order = 'bysource', autodoc_default_flags
     'sphinx_rtd_theme',
@@ -56,9 +52,8 @@ setup(
         'License :: OSI Approved :: Apache Software License',
         'Operating System :: POSIX :: Linux',
         'Programming Language :: Python',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.6',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
         'Topic :: Internet :: WWW/HTTP',
         'Topic :: Security',
         'Topic :: System :: Installation/Setup',
@@ -67,6 +62,9 @@ setup(
         'Topic :: Utilities',
     ],
 
+    # The token store needs time.monotonic, the runtime API client and the
+    # instance reloads need asyncio with async/await.
+    python_requires='>=3.5',
     packages=find_packages(),
     include_package_data=True,
     install_requires=install_requires,
@@ -77,6 +75,14 @@ setup(
         'certbot.plugins': [
             'haproxy-authenticator = %s' % haproxy_authenticator,
         ],
+        'console_scripts': [
+            'certbot-haproxy-plan-san = certbot_haproxy.sanplanner:main',
+            'certbot-haproxy-deploy = certbot_haproxy.deploy:main',
+            'certbot-haproxy-hostmap = certbot_haproxy.hostmap:main',
+            'certbot-haproxy-fixtures = certbot_haproxy.fixtures:main',
+            'certbot-haproxy-plan-renewal = '
+            'certbot_haproxy.renewalplanner:main',
+        ],
     },
     # test_suite='certbot_haproxy',
 )